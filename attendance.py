@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""attendance.py
+
+Registrations, kept as Attendance records.
+
+An Attendance record is a child of its Conference keyed by the
+attendee's user ID, written and deleted in the registration transaction
+along with the conference's seat count. It is the source of truth: the
+attendees of a conference are an ancestor query, the conferences of a
+user a query on Attendance.userId.
+
+Profile.conferenceKeysToAttend is no longer written. It is still read
+for registrations made before Attendance existed, until
+/tasks/migrate_attendance converts them (convertRegistration()) and
+empties the list.
+
+"""
+
+from google.appengine.ext import ndb
+
+import storage
+from cache import entities
+from layout import movedKey
+from models import Attendance
+from models import Profile
+
+
+def recordKey(conf_key, user_id):
+    """Return the key of user_id's Attendance record for conf_key."""
+    return ndb.Key(Attendance, user_id, parent=conf_key)
+
+
+def recordKeys(conf, user_id):
+    """Return the keys user_id's Attendance record for conf may have:
+    under conf, then (for a conference moved to the flat layout) under
+    its old key, until migrations.py has moved the record over.
+    """
+    keys = [recordKey(conf.key, user_id)]
+    if conf.movedFrom:
+        keys.append(recordKey(ndb.Key(urlsafe=conf.movedFrom), user_id))
+    return keys
+
+
+@ndb.tasklet
+def conferenceKeys_async(prof):
+    """Return the keys of the conferences prof registered for: those of
+    its Attendance records, after those still listed in the profile.
+
+    The Attendance query is eventually consistent, so a registration
+    made moments ago may be missing.
+    """
+    record_keys = yield storage.repo.query(Attendance).filter(
+        'userId', '=', prof.key.id()).fetch_async(keys_only=True)
+    conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
+    for key in record_keys:
+        if key.parent() not in conf_keys:
+            conf_keys.append(key.parent())
+    raise ndb.Return(conf_keys)
+
+
+def conferenceKeys(prof):
+    """Return the keys of the conferences prof registered for."""
+    return conferenceKeys_async(prof).get_result()
+
+
+def convertRegistration(user_id, wsck):
+    """Replace the conference wsck in user_id's profile list by an
+    Attendance record; a no-op once done, or while the conference
+    can't be found (deletion.py removes it from the list then).
+    """
+    conf_key = ndb.Key(urlsafe=wsck)
+    if storage.repo.get(conf_key) is None:
+        conf_key = movedKey(conf_key) or conf_key
+    _convert(ndb.Key(Profile, user_id), wsck, conf_key)
+
+
+@storage.transactional(xg=True)
+def _convert(p_key, wsck, conf_key):
+    prof = storage.repo.get(p_key)
+    if prof is None or wsck not in prof.conferenceKeysToAttend:
+        # converted by an earlier run, or unregistered since
+        return
+    if storage.repo.get(conf_key) is None:
+        return
+    key = recordKey(conf_key, p_key.id())
+    # an existing record keeps its registration time
+    if storage.repo.get(key) is None:
+        storage.putLater(Attendance(key=key, userId=p_key.id()))
+    prof.conferenceKeysToAttend.remove(wsck)
+    storage.putLater(prof)
+    entities.invalidate(p_key)
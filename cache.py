@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Instance-local caching in front of memcache and the datastore.
+
+local keeps small, hot values (announcement, featured speaker, the
+unfiltered conference list) that would otherwise cost a memcache or
+datastore round trip on every request.
+
+entities is a two-tier read-through cache for entities read on almost
+every request (speakers, organizer profiles, conferences): a bounded
+LRU in instance memory, then memcache, then the datastore. Write paths
+call invalidate() with the keys they changed.
+
+Instance memory is never shared between instances, so local entries
+carry a short TTL and memcache and the datastore stay the source of
+truth. Entities handed out by the cache are shared between request
+threads and must be treated as read-only; code that modifies an
+entity loads it with storage.repo.get() as before.
+
+Entities are loaded through the storage repository. A repository whose
+data is private to the process (MemoryRepository) skips the memcache
+tier, which would otherwise mix its entities with other instances'.
+
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import resilience
+import storage
+
+# seconds a value may be served from instance memory
+DEFAULT_TTL = 30
+# entries kept in instance memory per cache
+DEFAULT_MAXSIZE = 1000
+# seconds an entity may be served from memcache
+MEMCACHE_ENTITY_TTL = 600
+MEMCACHE_ENTITY_PREFIX = "ENTITY:"
+# seconds memcache refuses add() for a key after invalidate() deletes it;
+# longer than any read-then-add can take, so a reader that loaded the
+# entity before the write can't put the old copy back
+MEMCACHE_DELETE_LOCK = 10
+
+HOT_CONFERENCES_KEY = "HOT_CONFERENCES"
+
+
+class LRUCache(object):
+
+    """LRUCache -- bounded, thread-safe in-memory store with per-entry TTL"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class EntityCache(object):
+
+    """EntityCache -- instance LRU + memcache read-through for ndb entities"""
+
+    def __init__(self, local_cache, memcache_ttl=MEMCACHE_ENTITY_TTL):
+        self._local = local_cache
+        self._memcache_ttl = memcache_ttl
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def _count(self, name, n=1):
+        if n:
+            with self._lock:
+                self._counts[name] += n
+
+    @staticmethod
+    def _memcacheKey(key):
+        return MEMCACHE_ENTITY_PREFIX + key.urlsafe()
+
+    def get(self, key):
+        """Return the entity for key, or None if it doesn't exist."""
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        """Return entities for keys, in order; None for missing ones."""
+        found = {}
+        for key in set(keys):
+            entity = self._local.get(key)
+            if entity is not None:
+                found[key] = entity
+        self._count('local_hits', len(found))
+
+        pending = [key for key in set(keys) if key not in found]
+        shared = storage.repo.shared
+        if pending and shared:
+            cached = memcache.get_multi(
+                [self._memcacheKey(key) for key in pending])
+            for key in pending:
+                entity = cached.get(self._memcacheKey(key))
+                if entity is not None:
+                    found[key] = entity
+                    self._local.set(key, entity)
+            self._count('memcache_hits', len(cached))
+
+        pending = [key for key in pending if key not in found]
+        if pending:
+            self._count('datastore_loads', len(pending))
+            loaded = {}
+            for key, entity in zip(pending, storage.repo.get_multi(pending)):
+                if entity is not None:
+                    found[key] = loaded[self._memcacheKey(key)] = entity
+                    self._local.set(key, entity)
+            if loaded and shared:
+                # add, not set: invalidate() deletes with a lock period
+                # during which add is refused, so an entity read before a
+                # write never replaces the deletion that followed it
+                memcache.add_multi(loaded, time=self._memcache_ttl)
+        return [found.get(key) for key in keys]
+
+    def invalidate(self, *keys):
+        """Drop keys from both tiers once the current unit of work (see
+        storage.py) has written and the current transaction (if any)
+        has committed.
+        """
+        keys = [key for key in keys if key is not None]
+
+        def drop():
+            for key in keys:
+                self._local.delete(key)
+            if storage.repo.shared:
+                memcache.delete_multi(
+                    [self._memcacheKey(key) for key in keys],
+                    seconds=MEMCACHE_DELETE_LOCK)
+            self._count('invalidations', len(keys))
+        if keys:
+            storage.afterWrite(drop)
+
+    def clear(self):
+        """Drop every entity held in instance memory (not memcache)."""
+        self._local.clear()
+
+    def stats(self):
+        """Return hit/miss counters for this instance."""
+        with self._lock:
+            stats = dict(self._counts)
+        stats['local'] = self._local.stats()
+        return stats
+
+
+local = LRUCache()
+entities = EntityCache(LRUCache())
+
+
+def _keep(key, value, fallback):
+    """Return the value to keep for key, given what memcache returned."""
+    if value is not None:
+        resilience.record('memcache', True)
+    elif fallback is not None:
+        resilience.countFallback('memcache')
+        value = fallback()
+    value = value or ""
+    local.set(key, value)
+    return value
+
+
+def memcacheValue(key, fallback=None):
+    """Return a string value from memcache, via the instance cache.
+
+    fallback() gives the value when memcache doesn't have it or is
+    down (see resilience.py); without one that value is "".
+    """
+    value = local.get(key)
+    if value is None:
+        if resilience.available('memcache'):
+            value = memcache.get(key)
+        value = _keep(key, value, fallback)
+    return value
+
+
+@ndb.tasklet
+def memcacheValue_async(key, fallback=None):
+    """Like memcacheValue(), without blocking on memcache."""
+    value = local.get(key)
+    if value is None:
+        if resilience.available('memcache'):
+            value = yield ndb.get_context().memcache_get(key)
+        value = _keep(key, value, fallback)
+    raise ndb.Return(value)
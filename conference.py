@@ -14,6 +14,11 @@ updated by Prasanna Shevade
 """
 
 
+import functools
+import itertools
+import logging
+import os
+import uuid
 from datetime import datetime
 
 import endpoints
@@ -22,21 +27,26 @@ from protorpc import message_types
 from protorpc import remote
 
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import Attendance
+from models import AttendeeForms
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import ProfileForms
 from models import StringMessage
 from models import BooleanMessage
+from models import ChangesForm
 from models import Conference
 from models import ConferenceForm
+from models import DeletedForm
+from models import DeletionForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import DashboardForm
 from models import SessionQueryForm
 from models import SessionQueryForms
 from models import TeeShirtSize
@@ -44,16 +54,54 @@ from models import Session
 from models import SessionForm
 from models import SessionInputForm
 from models import SessionForms
-from models import TypeOfSession
+from models import UnavailableException
 from models import Speaker
+from models import Tombstone
+from models import dayBucket
+from models import minuteOfDay
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
+from cache import HOT_CONFERENCES_KEY
+from cache import entities
+from cache import local
+from cache import memcacheValue
+from cache import memcacheValue_async
+
+from mappers import copyConferenceToForm
+from mappers import copyDeletionJobToForm
+from mappers import copyProfileToAttendeeForm
+from mappers import copyProfileToForm
+from mappers import copySessionToForm
+from mappers import copySpeakerToForm
+
+import attendance
+import deletion
+import outbox
+import profiling
+import resilience
+from layout import conferenceKeyOf
+from layout import conferencesQuery
+from layout import movedKey
+from layout import movedKeys
+from layout import newConferenceKey
+from layout import newSessionKey
+from layout import sessionsQuery
+from featured import scheduleFeaturedSpeaker
+import schedule
+import storage
+import sync
+import throttle
+from deadline import fetchWithin
+from upcoming import upcomingSessions
+
 from utils import getUserId
 
+from warmup import timeFirstResponse
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
@@ -63,6 +111,16 @@ ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
 # memcache key for featured speaker
 MEMCACHE_FEATURED_KEY = "FEATURED_SPEAKER"
 
+# largest unfiltered conference list kept in instance memory
+HOT_CONFERENCES_LIMIT = 100
+
+# conferences returned by getDashboard (the web client's first page)
+DASHBOARD_CONFERENCES = 20
+
+# attendees returned per page by getConferenceAttendees
+ATTENDEES_PAGE_SIZE = 20
+ATTENDEES_MAX_PAGE_SIZE = 100
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -101,6 +159,44 @@ FIELDS_SESSION =    {
             'TYPE_OF_SESSION': 'type_of_session',
             }
 
+# logged for every filtered query, read back by tools/indexadvisor.py
+QUERY_SHAPE_LOG = 'query shape: %s ancestor=%s eq=%s ineq=%s'
+
+
+def _logQueryShape(kind, ancestor, equalities, inequality_field):
+    """Log the properties a query filters on (not their values)."""
+    logging.info(QUERY_SHAPE_LOG, kind, 'yes' if ancestor else 'no',
+                 ','.join(sorted(set(equalities))), inequality_field or '')
+
+
+def _distinct(items):
+    """Return the entities in items without the missing (None) and
+    repeated ones, in order."""
+    seen = set()
+    found = []
+    for entity in items:
+        if entity is not None and entity.key not in seen:
+            seen.add(entity.key)
+            found.append(entity)
+    return found
+
+
+def _retried(func):
+    """Run func, a datastore operation, through resilience.call(); answer
+    HTTP 503 if the datastore stays unavailable."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return resilience.call('datastore', func, *args, **kwargs)
+        except resilience.Contention:
+            # the wording is what tools/loadtest.py counts as contention
+            raise UnavailableException(
+                'There was too much contention, please try again.')
+        except resilience.Unavailable:
+            raise UnavailableException(
+                'The datastore is busy, please try again shortly.')
+    return wrapper
+
 # Request message to get conference by conference key
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -113,6 +209,14 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# Request message to get one page of a conference's attendees
+CONF_ATTENDEES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
 # Request message to get all session in a conference, by conference key
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -130,6 +234,7 @@ SESSION_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
 SESSION_GET_BY_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageToken=messages.StringField(2),
 )
 
 # Request messsage to get all sessions in a conference that user has in wishlist
@@ -138,6 +243,13 @@ SESSION_GET_BY_WISHLIST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# Request message for one page of the upcoming sessions feed
+UPCOMING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+)
+
 # Request message to get session by key
 SESSION_GET_BY_KEY = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -151,12 +263,35 @@ SESSION_GET_BY_CONFERENCE_DATE = endpoints.ResourceContainer(
     date=messages.StringField(2),
 )
 
+# Request message to get all sessions in a conference within a time window
+SESSION_GET_BY_TIME_WINDOW = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    startTime=messages.StringField(2),
+    endTime=messages.StringField(3),
+    date=messages.StringField(4),
+)
+
 # Request message to get all profiles who have this session in wishlist
 PROFILE_GET_BY_SESSION_IN_WISHLISHT = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionKey=messages.StringField(2),
 )
 
+# Request message to get the progress of a deletion
+DELETION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeDeletionKey=messages.StringField(1),
+)
+
+# Request message to get one page of changes since a sync token
+CHANGES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    since=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -166,24 +301,48 @@ PROFILE_GET_BY_SESSION_IN_WISHLISHT = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+# - - - Admission control - - - - - - - - - - - - - - - - -
+
+    def _admit(self, endpoint, units=1):
+        """Charge the caller's bucket for a call to endpoint; raises
+        ThrottledException when it is empty (see throttle.py)."""
+        user = endpoints.get_current_user()
+        if user:
+            caller = getUserId(user)
+        else:
+            caller = 'ip:%s' % os.environ.get('REMOTE_ADDR', '')
+        throttle.admit(caller, endpoint, units)
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return copyConferenceToForm(conf, displayName=displayName)
+
+    def _getConference(self, wsck):
+        """Return Conference by websafe key (following a move to the flat
+        layout), or None if there is none.
+        """
+        key = ndb.Key(urlsafe=wsck)
+        conf = entities.get(key)
+        if not conf:
+            moved = movedKey(key)
+            if moved:
+                conf = entities.get(moved)
+        return conf
+
+    @staticmethod
+    def _getSession(wssk):
+        """Return Session by websafe key (following a move to the flat
+        layout), or None if there is none.
+        """
+        key = ndb.Key(urlsafe=wssk)
+        session = storage.repo.get(key)
+        if not session:
+            moved = movedKey(key)
+            if moved:
+                session = storage.repo.get(moved)
+        return session
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
@@ -219,34 +378,46 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        # generate Conference key; a child of the organizer's Profile
+        # unless the flat layout is switched on (see layout.py)
+        c_key = newConferenceKey(user_id)
         data['key'] = c_key
+        data['flatLayout'] = c_key.parent() is None
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                      'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email')
+        storage.repo.put(Conference(**data))
+        local.delete(HOT_CONFERENCES_KEY)
+        outbox.enqueue('conference_created', user.email(),
+                       name=request.name,
+                       city=request.city,
+                       startDate=request.startDate or '',
+                       endDate=request.endDate or '',
+                       topics=', '.join(request.topics),
+                       maxAttendees=request.maxAttendees)
         return request
 
-    @ndb.transactional()
+    @_retried
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        # the conference may have moved to the flat layout; looked up
+        # here, like the organizer below, so that the transaction only
+        # touches the conference's entity group
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = self._updateConference(movedKey(conf_key) or conf_key,
+                                      request, user_id)
+        prof = entities.get(ndb.Key(Profile, user_id))
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
+    @storage.transactional()
+    def _updateConference(self, conf_key, request, user_id):
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = storage.repo.get(conf_key)
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -270,9 +441,11 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        storage.putLater(conf)
+        entities.invalidate(conf.key)
+        storage.repo.callOnCommit(
+            lambda: local.delete(HOT_CONFERENCES_KEY))
+        return conf
 
     @endpoints.method(ConferenceForm, ConferenceForm,
         path='conference',
@@ -295,14 +468,56 @@ class ConferenceApi(remote.Service):
         """Return requested conference (by websafeConferenceKey)."""
         # get Conference object from request; bail if not found
         print "****** inside get conference, how'd we get here?"
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        prof = entities.get(ndb.Key(Profile, conf.organizerUserId))
         # return ConferenceForm
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
+    @endpoints.method(CONF_GET_REQUEST, DeletionForm,
+        path='conference/{websafeConferenceKey}/delete',
+        http_method='POST', name='deleteConference')
+    def deleteConference(self, request):
+        """Delete a conference (organizer only); its sessions and the
+        registrations & wishlists naming it are removed in the background."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        conf = self._getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        job = deletion.deleteConference(conf.key, user_id)
+        if not job:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        return copyDeletionJobToForm(job)
+
+    @endpoints.method(DELETION_GET_REQUEST, DeletionForm,
+        path='deletion/{websafeDeletionKey}',
+        http_method='GET', name='getDeletion')
+    def getDeletion(self, request):
+        """Return the progress of a conference or session deletion."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        try:
+            key = ndb.Key(urlsafe=request.websafeDeletionKey)
+        except Exception:
+            raise endpoints.BadRequestException('Invalid websafeDeletionKey.')
+        job = storage.repo.get(key) if key.kind() == 'DeletionJob' else None
+        if not job or job.requestedBy != getUserId(user):
+            raise endpoints.NotFoundException(
+                'No deletion found with key: %s' % request.websafeDeletionKey)
+        return copyDeletionJobToForm(job)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
         path='getConferencesCreated',
         http_method='POST', name='getConferencesCreated')
@@ -314,9 +529,9 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # query by organizer, which works for either key layout
+        confs = conferencesQuery(user_id)
+        prof = entities.get(ndb.Key(Profile, user_id))
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
@@ -324,23 +539,26 @@ class ConferenceApi(remote.Service):
 
     def _getQuery(self, request):
         """Return formatted query from the submitted filters."""
-        q = Conference.query()
+        q = storage.repo.query(Conference)
         # Format the filters, separate into the normal filters and
         # the extra inequality filters
         inequality_filter, filters = self._formatFilters(request.filters)
         # If exists, sort on inequality filter first
         if not inequality_filter:
-            q = q.order(Conference.name)
+            q = q.order('name')
         else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+            q = q.order(inequality_filter)
+            q = q.order('name')
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
                 filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+            q = q.filter(filtr["field"], filtr["operator"], filtr["value"])
+        _logQueryShape('Conference', False,
+                       [f["field"] for f in filters if f["operator"] == "="],
+                       inequality_filter)
+        # key last, so != queries can be continued from a cursor
+        return q.order('__key__')
 
     def _formatFilters(self, filters, SESS_OR_CONF='conf'):
         """Parse, check validity and format user supplied filters."""
@@ -378,47 +596,97 @@ class ConferenceApi(remote.Service):
         else:
             return (inequality_field, formatted_filters, extra_inequality_filters)
 
-    @endpoints.method(ConferenceQueryForms, ConferenceForms,
-        path='queryConferences',
-        http_method='POST', name='queryConferences')
-    def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-        print "Here are the conferences: ", conferences
-        for conf in conferences:
-            print "here is the conf: ",conf.name, conf.organizerUserId
+    @staticmethod
+    def _conferenceForms(conferences):
+        """Return ConferenceForm per Conference, with organizer names."""
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        print "These are the organizers: ", organisers
-        profiles = ndb.get_multi(organisers)
-        print "These are the profiles: ", profiles
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId) for conf in conferences))
+        profiles = entities.get_multi(organisers)
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            print "Here is profiel: ", profile
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
+        return [copyConferenceToForm(conf, displayName=names.get(conf.organizerUserId))
+                for conf in conferences]
 
+    @staticmethod
+    def _cacheHotConferences():
+        """Build the unfiltered conference list & keep it in instance
+        memory; used by queryConferences() & instance warmup.
+        """
+        confs = storage.repo.query(Conference).order('name').fetch(HOT_CONFERENCES_LIMIT + 1)
+        forms = ConferenceApi._conferenceForms(confs)
+        # too long to hold in memory, query it every time
+        if len(confs) <= HOT_CONFERENCES_LIMIT:
+            local.set(HOT_CONFERENCES_KEY, forms)
+        return forms
+
+    @endpoints.method(ConferenceQueryForms, ConferenceForms,
+        path='queryConferences',
+        http_method='POST', name='queryConferences')
+    def queryConferences(self, request):
+        """Query for conferences."""
+        if not request.filters and not request.pageToken:
+            forms = local.get(HOT_CONFERENCES_KEY)
+            if forms is None:
+                forms = self._cacheHotConferences()
+            if len(forms) <= HOT_CONFERENCES_LIMIT:
+                return ConferenceForms(items=list(forms))
+        try:
+            conferences, token, partial = fetchWithin(
+                self._getQuery(request), page_token=request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                   conferences]
-        )
+        return ConferenceForms(items=self._conferenceForms(conferences),
+                               nextPageToken=token, partial=partial)
+
+# - - - Sync - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(CHANGES_GET_REQUEST, ChangesForm,
+        path='changes',
+        http_method='GET', name='getChangesSince')
+    def getChangesSince(self, request):
+        """Return one page of conferences, sessions & speakers changed or
+        deleted since a sync token (everything without one)."""
+        try:
+            page = sync.changes(since=request.since,
+                                page_token=request.pageToken,
+                                page_size=request.pageSize)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        form = ChangesForm(nextPageToken=page.nextPageToken,
+                           syncToken=page.syncToken,
+                           fullSync=page.full)
+        if page.kind is Conference:
+            form.conferences = self._conferenceForms(page.entities)
+        elif page.kind is Session:
+            # resolve the page's conferences & speakers in two batches
+            conf_keys = list(set(conferenceKeyOf(s) for s in page.entities))
+            confs = dict(zip(conf_keys, entities.get_multi(conf_keys)))
+            speaker_keys = list(set(ndb.Key(urlsafe=s.speaker_key)
+                                    for s in page.entities))
+            speakers = dict(zip(speaker_keys, entities.get_multi(speaker_keys)))
+            form.sessions = [
+                copySessionToForm(session, conf=confs[conferenceKeyOf(session)],
+                                  speaker=speakers[ndb.Key(urlsafe=session.speaker_key)])
+                for session in page.entities if confs[conferenceKeyOf(session)]]
+        elif page.kind is Speaker:
+            form.speakers = [copySpeakerToForm(speaker) for speaker in page.entities]
+        elif page.kind is Tombstone:
+            form.deleted = [DeletedForm(kind=tomb.kindName, websafeKey=tomb.key.id())
+                            for tomb in page.entities]
+        return form
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
-        """Copy relevant fields from Profile to ProfileForm."""
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+    def _copyProfileToForm(self, prof, conf_keys):
+        """Copy relevant fields from Profile to ProfileForm; conf_keys
+        are the conferences it registered for (attendance.py)."""
+        return copyProfileToForm(
+            prof, conferenceKeys=[key.urlsafe() for key in conf_keys])
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
@@ -430,7 +698,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = storage.repo.get(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -438,7 +706,7 @@ class ConferenceApi(remote.Service):
                 displayName=user.nickname(),
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),)
-            profile.put()
+            storage.putLater(profile)
         return profile      # return Profile
 
     def _doProfile(self, save_request=None):
@@ -448,6 +716,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            changed = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -457,10 +726,13 @@ class ConferenceApi(remote.Service):
                             setattr(prof, field, str(val).upper())
                         else:
                             setattr(prof, field, val)
-                        prof.put()
+                        changed = True
+            if changed:
+                storage.putLater(prof)
+            entities.invalidate(prof.key)
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        return self._copyProfileToForm(prof, attendance.conferenceKeys(prof))
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
         path='profile',
@@ -472,6 +744,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(ProfileMiniForm, ProfileForm,
         path='profile',
         http_method='POST', name='saveProfile')
+    @storage.unitOfWork
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -484,57 +757,174 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        confs = storage.repo.query(Conference).filter(
+            'seatsAvailable', '<=', 5).filter(
+            'seatsAvailable', '>', 0).fetch(projection=[Conference.name])
         if confs:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = ANNOUNCEMENT_TPL % (
                 ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
+            # If there are no sold out conferences, store an empty
+            # announcement, so that a miss means memcache lost it
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        resilience.record('memcache',
+                          memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement))
+        local.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         return announcement
 
+    @staticmethod
+    def _rebuildAnnouncement():
+        """Return the announcement from the datastore, for when memcache
+        doesn't have it; "" if the datastore is unavailable too."""
+        return resilience.read('datastore', ConferenceApi._cacheAnnouncement,
+                               lambda: "")
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
         path='conference/announcement/get',
         http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=memcacheValue(
+            MEMCACHE_ANNOUNCEMENTS_KEY, fallback=self._rebuildAnnouncement))
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
         path='sessions/featuredspeaker/get',
         http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_FEATURED_KEY) or "")
+        featured = memcacheValue(MEMCACHE_FEATURED_KEY)
+        if isinstance(featured, dict):
+            featured = featured.get('announcement', '')
+        return StringMessage(data=featured or "")
+
+# - - - Dashboard - - - - - - - - - - - - - - - - - - - - -
+
+    @ndb.tasklet
+    def _profileAndConferences_async(self, user):
+        """Return the user's Profile (created if needed) and the
+        conferences they registered for."""
+        prof, = yield storage.repo.get_multi_async(
+            [ndb.Key(Profile, getUserId(user))])
+        if not prof:
+            prof = self._getProfileFromUser()
+        conf_keys = yield attendance.conferenceKeys_async(prof)
+        confs = yield storage.repo.get_multi_async(conf_keys)
+        missing = [key for key, conf in zip(conf_keys, confs) if not conf]
+        if missing:
+            # moved to the flat layout, as in getConferencesToAttend
+            confs += yield storage.repo.get_multi_async(
+                filter(None, movedKeys(missing)))
+        raise ndb.Return(prof, conf_keys, _distinct(confs))
+
+    @endpoints.method(message_types.VoidMessage, DashboardForm,
+        path='dashboard',
+        http_method='GET', name='getDashboard')
+    def getDashboard(self, request):
+        """Return profile, conferences to attend, announcement, featured
+        speaker & first conferences in one call (profile parts only when
+        signed in)."""
+        # start every read before waiting on any of them
+        user = endpoints.get_current_user()
+        mine = self._profileAndConferences_async(user) if user else None
+        announcement = memcacheValue_async(
+            MEMCACHE_ANNOUNCEMENTS_KEY, fallback=self._rebuildAnnouncement)
+        featured = memcacheValue_async(MEMCACHE_FEATURED_KEY)
+        hot = local.get(HOT_CONFERENCES_KEY)
+        listed = None
+        if hot is None:
+            listed = storage.repo.query(Conference).order('name').fetch_async(
+                DASHBOARD_CONFERENCES + 1)
+
+        prof, conf_keys, attending = mine.get_result() if mine else (None, [], [])
+        if hot is None:
+            listed = listed.get_result()
+            # one batch of organizer names for both lists
+            forms = self._conferenceForms(attending + listed)
+            attending_forms = forms[:len(attending)]
+            hot = forms[len(attending):]
+        else:
+            attending_forms = self._conferenceForms(attending)
+        featured = featured.get_result()
+        if isinstance(featured, dict):
+            featured = featured.get('announcement', '')
+        return DashboardForm(
+            profile=self._copyProfileToForm(prof, conf_keys) if prof else None,
+            conferencesToAttend=attending_forms,
+            announcement=announcement.get_result(),
+            featuredSpeaker=featured or "",
+            conferences=list(hot[:DASHBOARD_CONFERENCES]),
+            moreConferences=len(hot) > DASHBOARD_CONFERENCES)
+
+    @staticmethod
+    def _publicDashboard():
+        """Return the signed-out dashboard from the instance & memcache
+        caches; embedded in the landing page by landing.py.
+        """
+        hot = local.get(HOT_CONFERENCES_KEY)
+        if hot is None:
+            hot = ConferenceApi._cacheHotConferences()
+        featured = memcacheValue(MEMCACHE_FEATURED_KEY)
+        if isinstance(featured, dict):
+            featured = featured.get('announcement', '')
+        return DashboardForm(
+            announcement=memcacheValue(
+                MEMCACHE_ANNOUNCEMENTS_KEY,
+                fallback=ConferenceApi._rebuildAnnouncement),
+            featuredSpeaker=featured or "",
+            conferences=list(hot[:DASHBOARD_CONFERENCES]),
+            moreConferences=len(hot) > DASHBOARD_CONFERENCES)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference.
+
+        A datastore timeout can come after the commit was applied, so
+        on a retry being in the requested state already means success.
+        """
+        tries = itertools.count()
+
+        @_retried
+        def attempt():
+            return self._changeRegistration(request, reg,
+                                            retry=next(tries) > 0)
+        return attempt()
+
+    @storage.transactional(xg=True)
+    def _changeRegistration(self, request, reg, retry):
         retval = None
         prof = self._getProfileFromUser() # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = storage.repo.get(ndb.Key(urlsafe=wsck))
+        if not conf:
+            # the conference may have moved to the flat layout
+            moved = movedKey(ndb.Key(urlsafe=wsck))
+            conf = storage.repo.get(moved) if moved else None
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        wsck = conf.key.urlsafe()
+        record_keys = attendance.recordKeys(conf, prof.key.id())
+        # a registration from before Attendance records existed is only
+        # in the profile, which may still list a moved conference by
+        # its old key
+        listed = [key for key in (wsck, conf.movedFrom)
+                  if key and key in prof.conferenceKeysToAttend]
+        registered = bool(listed) or any(
+            record is not None for record in storage.repo.get_multi(record_keys))
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registered and retry:
+                # registered by the try that timed out
+                return BooleanMessage(data=True)
+            if registered:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -544,25 +934,40 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            storage.putLater(Attendance(key=record_keys[0], userId=prof.key.id()))
+            # queued with the transaction: no email if registration fails
+            outbox.enqueue('registration', prof.mainEmail, transactional=True,
+                           displayName=prof.displayName,
+                           name=conf.name,
+                           city=conf.city,
+                           startDate=str(conf.startDate or ''),
+                           endDate=str(conf.endDate or ''))
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                if listed:
+                    for key in listed:
+                        prof.conferenceKeysToAttend.remove(key)
+                    storage.putLater(prof)
+                    entities.invalidate(prof.key)
                 conf.seatsAvailable += 1
+                storage.repo.delete_multi(record_keys)
                 retval = True
             else:
-                retval = False
-
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+                # unless unregistered by the try that timed out
+                retval = retry
+
+        # write things back to the datastore (one batch with the
+        # attendance record, at commit) & return
+        storage.putLater(conf)
+        entities.invalidate(conf.key)
+        storage.afterWrite(lambda: local.delete(HOT_CONFERENCES_KEY))
         return BooleanMessage(data=retval)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -571,21 +976,51 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        conf_keys = attendance.conferenceKeys(prof)
+        conferences = entities.get_multi(conf_keys)
+        missing = [key for key, conf in zip(conf_keys, conferences) if not conf]
+        if missing:
+            # moved to the flat layout before the migration rewrote the
+            # profile's keys (see migrations.py)
+            moved = dict(zip(missing, movedKeys(missing)))
+            conferences = entities.get_multi(
+                [moved.get(key) or key for key in conf_keys])
+        # a deleted conference stays listed until deletion.py removes
+        # it; one that is moving may be found under both keys
+        conferences = _distinct(conferences)
+        # return set of ConferenceForm objects per Conference
+        return ConferenceForms(items=self._conferenceForms(conferences))
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+    @endpoints.method(CONF_ATTENDEES_REQUEST, AttendeeForms,
+        path='conference/{websafeConferenceKey}/attendees',
+        http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return one page of a conference's attendees (organizer only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
 
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-                               for conf in conferences])
+        conf = self._getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+
+        page_size = min(request.pageSize or ATTENDEES_PAGE_SIZE, ATTENDEES_MAX_PAGE_SIZE)
+        try:
+            cursor = storage.repo.cursor(request.pageToken) if request.pageToken else None
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
+        att_keys, next_cursor, more = storage.repo.query(Attendance, ancestor=conf.key).fetch_page(
+            page_size, start_cursor=cursor, keys_only=True)
+        # resolve the whole page of profiles in one batch
+        profiles = storage.repo.get_multi([ndb.Key(Profile, key.id()) for key in att_keys])
+        return AttendeeForms(
+            items=[copyProfileToAttendeeForm(prof) for prof in profiles if prof],
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None)
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
         path='conference/{websafeConferenceKey}',
@@ -606,15 +1041,10 @@ class ConferenceApi(remote.Service):
         http_method='GET', name='filterPlayground')
     def filterPlayground(self, request):
         """Filter Playground"""
-        q = Conference.query()
-        # field = "city"
-        # operator = "="
-        # value = "London"
-        # f = ndb.query.FilterNode(field, operator, value)
-        # q = q.filter(f)
-        q = q.filter(Conference.city=="London")
-        q = q.filter(Conference.topics=="Medical Innovations")
-        q = q.filter(Conference.month==6)
+        q = storage.repo.query(Conference)
+        q = q.filter('city', '=', 'London')
+        q = q.filter('topics', '=', 'Medical Innovations')
+        q = q.filter('month', '=', 6)
 
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, "") for conf in q]
@@ -627,91 +1057,103 @@ class ConferenceApi(remote.Service):
         http_method='GET', name='getProfilesBySessionWishlist')
     def getProfilesBySessionWishList(self, request):
         """ Return all profiles who want to attend a particular session. """
-        session = ndb.Key(urlsafe=request.sessionKey).get()
+        self._admit('getProfilesBySessionWishlist')
+        session = storage.repo.get(ndb.Key(urlsafe=request.sessionKey))
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.sessionKey)
-        profiles = Profile.query().filter(Profile.session_wish_list == session.key.urlsafe())
+        profiles = storage.repo.query(Profile).filter(
+            'session_wish_list', '=', session.key.urlsafe()).fetch()
+        # every profile's registrations at once
+        conf_keys = [attendance.conferenceKeys_async(profile)
+                     for profile in profiles]
 
         return ProfileForms(
-            profiles=[self._copyProfileToForm(profile) for profile in profiles])
+            profiles=[self._copyProfileToForm(profile, keys.get_result())
+                      for profile, keys in zip(profiles, conf_keys)])
 
     @endpoints.method(SESSION_GET_BY_CONFERENCE_DATE, SessionForms,
         path='conference/{websafeConferenceKey}/{date}/sessions',
         http_method='GET', name='getConferenceSessionsByDate')
     def getConferenceSessionsByDate(self, request):
         """ Return the sessions that occur on a conference's particular date """
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         date = datetime.strptime(request.date[:10], "%Y-%m-%d")
         if not conf:
             raise endpoints.NotFoundException(
                 'No conf found with key: %s' % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).filter(Session.date==date)
         return SessionForms(
-            items=[self._copySessionToForm(session, conf) for session in sessions]
+            items=schedule.sessionForms(conf, date=date.strftime("%Y-%m-%d"))
         )
 
 
+    @endpoints.method(SESSION_GET_BY_TIME_WINDOW, SessionForms,
+        path='conference/{websafeConferenceKey}/sessions/window',
+        http_method='GET', name='getConferenceSessionsByTimeWindow')
+    def getConferenceSessionsByTimeWindow(self, request):
+        """ Return a conference's sessions held between startTime and endTime
+            (HH:MM) on any day, or only on date (YYYY-MM-DD) if given.
+        """
+        conf = self._getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conf found with key: %s' % request.websafeConferenceKey)
+        try:
+            start = minuteOfDay(datetime.strptime(request.startTime, "%H:%M"))
+            end = minuteOfDay(datetime.strptime(request.endTime, "%H:%M"))
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                "'startTime' and 'endTime' must be given as HH:MM")
+        day = None
+        if request.date:
+            try:
+                day = dayBucket(datetime.strptime(request.date[:10], "%Y-%m-%d"))
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "'date' must be given as YYYY-MM-DD")
+        # The start of the window is the single index-backed inequality;
+        # a session can't end before it starts, so the end check only
+        # has to look at what that range returns.
+        sessions = sessionsQuery(conf).filter(
+            'start_minute', '>=', start).filter('start_minute', '<=', end)
+        if day is not None:
+            sessions = sessions.filter('day', '=', day)
+        sessions = sessions.order('start_minute')
+        items = [session for session in sessions if session.end_minute <= end]
+        items.sort(key=lambda session: (session.day, session.start_minute))
+        return SessionForms(
+            items=[self._copySessionToForm(session, conf) for session in items]
+        )
+
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/sessions',
         http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Return requested conference (by websafeSessionKey)."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conf found with key: %s' % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key)
-        return SessionForms(
-            items=[self._copySessionToForm(session, conf) for session in sessions]
-        )
+        return SessionForms(items=schedule.sessionForms(conf))
 
-    def _copySessionToForm(self, session, conf):
+    def _copySessionToForm(self, session, conf, speaker=None):
         """ Copy items from the Session object to the SessionForm object """
-        sf = SessionForm()
-        speaker = ndb.Key(urlsafe=session.speaker_key).get()
-        print "This is the session's speaker: ", speaker
-        for field in sf.all_fields():
-            print "This is the field: ", field.name
-            if hasattr(session, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'date':
-                    setattr(sf, field.name, getattr(session, field.name).strftime("%Y-%m-%d"))
-                elif field.name == 'start_time':
-                    setattr(sf, field.name, getattr(session, field.name).strftime("%H:%M"))
-                elif field.name == 'type_of_session':
-                    try:
-                        setattr(sf, field.name, getattr(TypeOfSession, getattr(session, field.name)))
-                    except AttributeError:
-                        setattr(sf, field.name, getattr(TypeOfSession, 'NOT_SPECIFIED'))
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
-            elif field.name == "conf_websafekey":
-                setattr(sf, field.name, conf.key.urlsafe())
-            elif field.name == "sess_websafekey":
-                setattr(sf, field.name, session.key.urlsafe())
-            elif field.name == 'speaker_name':
-                setattr(sf, field.name, speaker.name)
-            elif field.name == 'speaker_email':
-                setattr(sf, field.name, speaker.email)
-            elif field.name == 'speaker_speciality':
-                setattr(sf, field.name, speaker.speciality)
-        sf.check_initialized()
-        return sf
+        if speaker is None:
+            speaker = entities.get(ndb.Key(urlsafe=session.speaker_key))
+        return copySessionToForm(session, conf=conf, speaker=speaker)
 
     @endpoints.method(SESSION_GET_BY_TYPE_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/sessions/type/{typeOfSession}',
         http_method='GET', name='getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
         """ Return a Conference's session that are all a certain type """
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conf found with key: %s' % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).filter(Session.type_of_session==request.typeOfSession)
         return SessionForms(
-            items=[self._copySessionToForm(session, conf) for session in sessions]
+            items=schedule.sessionForms(conf, type_of_session=request.typeOfSession)
         )
 
     @endpoints.method(SESSION_GET_BY_SPEAKER, SessionForms,
@@ -719,53 +1161,129 @@ class ConferenceApi(remote.Service):
         http_method='GET', name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """ Return sessions across all conferences for a particular speaker. """
-        conferences = Conference.query()
+        self._admit('getSessionsBySpeaker')
+        speakers = storage.repo.query(Speaker).filter('name', '=', request.speaker).fetch()
+        if not speakers:
+            return SessionForms(items=[])
+        speaker_set = dict((speaker.key.urlsafe(), speaker) for speaker in speakers)
+        # one query by speaker, whatever conference (or layout) a session is in
+        # (ordered by key, so the IN query can be continued from a cursor)
+        query = storage.repo.query(Session).filter(
+            'speaker_key', 'in', speaker_set.keys()).order('__key__')
+        try:
+            sessions, token, partial = fetchWithin(query, page_token=request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
+        conf_keys = list(set(conferenceKeyOf(session) for session in sessions))
+        confs = dict(zip(conf_keys, entities.get_multi(conf_keys)))
         items = []
-        speaker_set = Speaker.query().filter(Speaker.name==request.speaker)
-        for speaker in speaker_set:
-            for conf in conferences:
-                sessions = Session.query(ancestor=conf.key).filter(Session.speaker_key==speaker.key.urlsafe())
-                for session in sessions:
-                    items.append(self._copySessionToForm(session, conf))
-        return SessionForms(items=items)
+        for session in sessions:
+            conf = confs[conferenceKeyOf(session)]
+            if conf:
+                items.append(self._copySessionToForm(
+                    session, conf, speaker_set[session.speaker_key]))
+        return SessionForms(items=items, nextPageToken=token, partial=partial)
 
     @endpoints.method(SESSION_GET_BY_KEY, BooleanMessage,
         path='sessions/addToWishList/{sessionKey}',
         http_method='POST', name='addSessionToWishlist')
+    @storage.unitOfWork
     def addSessionToWishlist(self, request):
         """ Add a session to the user's wishlist. """
         prof = self._getProfileFromUser()
-        session = ndb.Key(urlsafe=request.sessionKey).get()
+        session = self._getSession(request.sessionKey)
         # print "the session's parent is: ", session.parent
         if not session:
             raise endpoints.NotFoundException('No session with that key: %s' % request.sessionKey)
             return BooleanMessage(data=False)
-        if request.sessionKey in prof.session_wish_list:
+        # the wishlist may still name a moved session by its old key
+        if {request.sessionKey, session.key.urlsafe()} & set(prof.session_wish_list):
             raise ConflictException("You have already expressed your desire to be at this session!")
         else:
-            prof.session_wish_list.append(request.sessionKey)
-            prof.put()
+            prof.session_wish_list.append(session.key.urlsafe())
+            storage.putLater(prof)
+            entities.invalidate(prof.key)
         return BooleanMessage(data=True)
 
+    @endpoints.method(SESSION_GET_BY_KEY, DeletionForm,
+        path='sessions/{sessionKey}/delete',
+        http_method='POST', name='deleteSession')
+    def deleteSession(self, request):
+        """Delete a session (conference organizer only); wishlists naming
+        it are updated in the background."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        session = self._getSession(request.sessionKey)
+        conf = entities.get(conferenceKeyOf(session)) if session else None
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.sessionKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner of the conference can delete its sessions.')
+        job = deletion.deleteSession(session.key, user_id)
+        if not job:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.sessionKey)
+        return copyDeletionJobToForm(job)
+
+    @endpoints.method(UPCOMING_GET_REQUEST, SessionForms,
+        path='sessions/upcoming',
+        http_method='GET', name='getUpcomingSessions')
+    def getUpcomingSessions(self, request):
+        """Return the next sessions, in time order, across the conferences
+        the user is registered for."""
+        prof = self._getProfileFromUser()
+        conf_keys = attendance.conferenceKeys(prof)
+        try:
+            forms, token = upcomingSessions(conf_keys, page_size=request.pageSize,
+                                            page_token=request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
+        return SessionForms(items=forms, nextPageToken=token)
+
+    @endpoints.method(message_types.VoidMessage, StringMessage,
+        path='profile/calendar',
+        http_method='GET', name='getWishlistCalendar')
+    @storage.unitOfWork
+    def getWishlistCalendar(self, request):
+        """Return the path of the user's wishlist calendar feed."""
+        prof = self._getProfileFromUser()
+        if not prof.calendarToken:
+            prof.calendarToken = uuid.uuid4().hex
+            storage.putLater(prof)
+            entities.invalidate(prof.key)
+        return StringMessage(data='/ical/wishlist/%s.ics' % prof.calendarToken)
+
     @endpoints.method(SESSION_GET_BY_WISHLIST, SessionForms,
         path='conference/{websafeConferenceKey}/sessions/users/wishlist',
         http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """ Return all the sessions a user is going to attend in a conference. """
         profile = self._getProfileFromUser()
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException('No conference with that key: %s', request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key)
+        wishlist = set(profile.session_wish_list)
+        if conf.movedFrom or conf.movingTo:
+            # moved sessions keep their old key in wishlists until the
+            # migration rewrites them
+            wishlist.update(key.urlsafe() for key in movedKeys(
+                [ndb.Key(urlsafe=wssk) for wssk in wishlist]) if key)
+        sessions = sessionsQuery(conf)
         items = []
         for session in sessions:
-            if session.key.urlsafe() in profile.session_wish_list:
+            if session.key.urlsafe() in wishlist:
                 items.append(self._copySessionToForm(session, conf))
         return SessionForms(items=items)
 
     @endpoints.method(SessionInputForm, SessionForm,
         path='sessions',
         http_method='POST', name='createSession')
+    @storage.unitOfWork
     def createSession(self, request):
         """Create new session. """
         return self._createSessionObject(request)
@@ -789,17 +1307,17 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException("Session 'start time' field required")
         # Let's get the conference object from the websafe key, as entered by the user
         wsck = request.conf_websafekey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = self._getConference(wsck)
         # Let's get the speaker, as per the email address that user entered
         # check if speaker object exists:
         print "The email is: ", request.speaker_email
         speaker_key = ndb.Key(Speaker, request.speaker_email)
-        speaker = speaker_key.get()
+        speaker = storage.repo.get(speaker_key)
         # if speaker object does not exist, check if the speaker has a user profile already
         if not speaker:
             print "That speaker doesn't exist, so we will make one."
             sp_key = ndb.Key(Profile, request.speaker_email)
-            speaker_profile = sp_key.get()
+            speaker_profile = storage.repo.get(sp_key)
             # If the speaker doesn't have a user profile yet
             if not speaker_profile:
                 sp_key_urlsafe = ""
@@ -811,7 +1329,8 @@ class ConferenceApi(remote.Service):
                               email=request.speaker_email,
                               speciality=request.speaker_speciality,
                               user_profile_key=sp_key_urlsafe)
-            speaker.put()
+            storage.putLater(speaker)
+            entities.invalidate(speaker.key)
         # Get the urlsafe key, which we put in the session object (to id the speaker entity)
         speaker_key = speaker.key.urlsafe()
 
@@ -841,39 +1360,38 @@ class ConferenceApi(remote.Service):
         if data['start_time']:
             data['start_time'] = datetime.strptime(data['start_time'][:10], "%H:%M")
 
-        # The following code makes the session a child of the conference
-        # Get the Key instance form the urlsafe key
-        c_key = ndb.Key(urlsafe=wsck)
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        data['key'] = s_key
+        # The session is a child of the conference in the legacy layout,
+        # a root entity pointing at it otherwise (see layout.py)
+        data['key'] = newSessionKey(conf)
+        data['conferenceKey'] = conf.movingTo or conf.key
         sess = Session(**data)
-        sess.put()
-        # Let's figure out if this speaker should be featured in the announcements:
-        # Count how many sessions the speaker is to speak in.
-        speakers_count = Session.query(ancestor=conf.key).filter(Session.speaker_key == sess.speaker_key).count()
-        # Send the speaker name and count to the task to set featured speakers
-        taskqueue.add(params={'speaker': speaker.name, 'count': speakers_count},
-                      url='/tasks/set_featured_speaker')
+        storage.putLater(sess)
+        # a new speaker and the session in one batch; written before the
+        # schedule, which may read them back
+        storage.flush()
+        schedule.addSession(conf, sess, speaker)
+        # Let's figure out if this speaker should be featured in the announcements;
+        # a burst of session writes shares one recomputation task.
+        scheduleFeaturedSpeaker(conf.key)
         return self._copySessionToForm(sess, conf)
 
-    def _getSessionsQuery(self, inequality_field, filter_set, conf_key):
+    def _getSessionsQuery(self, inequality_field, filter_set, conf):
         """ Return formatted query from the submitted filters for Sessions. 
             This is the function where we query all equality filters and
             the first inequality filter. We can only do one inequality
             operation for one filter query.
         """
         # Get query object for all sessions for a particular conference
-        s = Session.query(ancestor=conf_key)
+        s = sessionsQuery(conf)
         # If we don't have an inequality filter,
         # If we have an inequality filter, then order by that property first
         # This is a requirement in ndb. First order by the property that we
         # are going to do the inequality filtering.
         if not inequality_field:
-            s = s.order(Session.name)
+            s = s.order('name')
         else:
-            s = s.order(ndb.GenericProperty(inequality_field))
-            s = s.order(Session.name)
+            s = s.order(inequality_field)
+            s = s.order('name')
         for filtr in filter_set:
             # format the values in the filter (for date, time, and duration which is an int)
             if filtr["field"] == "start_time":
@@ -888,10 +1406,14 @@ class ConferenceApi(remote.Service):
             else:
                 value = filtr["value"]
                 print "Post formatting, the filters are: ", filtr
-            # Get the filter node for that particular filter
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], value)
-            s = s.filter(formatted_query)
-        return s
+            s = s.filter(filtr["field"], filtr["operator"], value)
+        equalities = [f["field"] for f in filter_set if f["operator"] == "="]
+        if conf.flatLayout:
+            equalities.append('conferenceKey')
+        _logQueryShape('Session', not conf.flatLayout, equalities,
+                       inequality_field)
+        # key last, so != queries can be continued from a cursor
+        return s.order('__key__')
 
     def _getExtraInequalityFiltering(self, filters, session_list):
         """ Filter for the extra inequality filters. Since we cannot do 
@@ -984,25 +1506,29 @@ class ConferenceApi(remote.Service):
     def querySessions(self, request):
         """ Query sessions based on filters. """
         print "We are in query sessions"
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException('No conference exists with key: %s' % request.websafeConferenceKey)
         # sessions = Session.query(ancestor=conf.key)
         print "got the conf"
         inequality_field, filters, extra_inequality_filters = self._formatFilters(request.filters, 'sess')
+        # every inequality beyond the first is filtered in memory
+        self._admit('querySessions', 1 + len(extra_inequality_filters))
         print "Got the filters: ", filters
-        sessions_list = []
-        sessions = self._getSessionsQuery(inequality_field, filters, conf.key)
-        # Get the sessions objects
-        print "We are out of the first query"
-        print "the sessions query as returned: ", sessions
-        for session in sessions:
-            print "The session's startimes in the first result: ", session.start_time
-            sessions_list.append(session)
-
-        sessions_list = self._getExtraInequalityFiltering(extra_inequality_filters, sessions_list)
+        sessions = self._getSessionsQuery(inequality_field, filters, conf)
+        # Get the sessions objects, applying the extra inequality
+        # filters a batch at a time
+        try:
+            sessions_list, token, partial = fetchWithin(
+                sessions, page_token=request.pageToken,
+                keep=lambda batch: self._getExtraInequalityFiltering(
+                    extra_inequality_filters, batch))
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
         return SessionForms(
-            items=[self._copySessionToForm(session, conf) for session in sessions_list]
+            items=[self._copySessionToForm(session, conf) for session in sessions_list],
+            nextPageToken=token, partial=partial
         )
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = timeFirstResponse(profiling.wrap(
+    endpoints.api_server([ConferenceApi]))) # register API
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""deadline.py
+
+Time-boxed query execution for the listing endpoints.
+
+fetchWithin() runs a query a batch at a time and stops before its time
+budget runs out, returning what it has, a page token to continue from
+and a partial flag. A broad filter then returns a useful first part
+well inside the request deadline instead of running into it, and the
+client resends the same query with the page token for the rest.
+
+Queries continued from a page token must be the same query, ordered by
+key last; ndb only produces cursors for IN and != queries when they
+are. Page tokens are the storage repository's cursors.
+
+"""
+
+import time
+
+import storage
+
+# seconds of a request spent on one query, of the 60s request deadline
+QUERY_TIME_BUDGET = 10
+QUERY_BATCH_SIZE = 100
+
+
+def fetchWithin(query, page_token=None, budget=QUERY_TIME_BUDGET,
+                batch_size=QUERY_BATCH_SIZE, keep=None):
+    """Return (results, next page token, partial) for query.
+
+    Batches are fetched until the query is exhausted or the next batch
+    would likely overrun budget seconds; partial is True and the token
+    set when stopped early. keep filters each batch in memory. Raises
+    ValueError on a bad page token.
+    """
+    cursor = storage.repo.cursor(page_token) if page_token else None
+    start = time.time()
+    slowest = 0
+    results = []
+    while True:
+        began = time.time()
+        batch, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+        results.extend(keep(batch) if keep else batch)
+        if not (more and cursor):
+            return results, None, False
+        now = time.time()
+        slowest = max(slowest, now - began)
+        if now + slowest > start + budget:
+            return results, cursor.urlsafe(), True
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""deletion.py
+
+Deleting conferences and sessions along with everything that refers to
+them.
+
+deleteConference() and deleteSession() remove the entity itself right
+away, in one transaction with its tombstone for the changes feed
+(sync.py), a DeletionJob that records progress and the first
+/tasks/cascade_delete task. The task (main.CascadeDeleteHandler) calls
+runBatch() and chains itself until the job is done; the organizer can
+follow the job through the getDeletion endpoint.
+
+A conference job runs these phases, one batch per task:
+
+1. sessions, flatSessions: the conference's sessions (children in the
+   legacy layout, root entities pointing at it in the flat one), read
+   keys-only. A batch is first removed from every wishlist naming it,
+   then deleted, leaving tombstones.
+2. registrations: profiles still listing the conference in
+   conferenceKeysToAttend have it removed.
+3. attendance: the conference's Attendance records are deleted.
+4. finish: the schedule document is deleted, the featured speaker is
+   recomputed (dropped if it came from this conference) and the
+   announcement of nearly sold out conferences is rebuilt.
+
+A session is dropped from its conference's schedule at once; its job
+removes it from wishlists, then has the featured speaker recomputed.
+
+Batches read what is left rather than following a cursor, and every
+step can be re-run, so a retried task simply continues.
+
+"""
+
+from google.appengine.api import taskqueue
+
+import featured
+import schedule
+import storage
+import sync
+from cache import HOT_CONFERENCES_KEY
+from cache import entities
+from cache import local
+from layout import conferenceKeyOf
+from models import Attendance
+from models import DeletionJob
+from models import Profile
+from models import Session
+
+DELETE_BATCH_SIZE = 100
+# most values a single IN filter may hold
+IN_FILTER_LIMIT = 30
+
+CONFERENCE_PHASES = ('sessions', 'flatSessions', 'registrations',
+                     'attendance', 'finish')
+SESSION_PHASES = ('wishlists', 'finish')
+
+
+def _start(target, conf_key, user_id, phases):
+    """Record the deletion of target and queue its first batch."""
+    job = DeletionJob(target=target, conferenceKey=conf_key,
+                      requestedBy=user_id, phase=phases[0])
+    # written now rather than with the unit of work: the task needs its key
+    storage.repo.put(job)
+    sync.recordDeletions([target])
+    storage.repo.addTask(taskqueue.Task(params={'job': job.key.urlsafe()},
+                                        url='/tasks/cascade_delete'))
+    return job
+
+
+@storage.transactional(xg=True)
+def deleteConference(conf_key, user_id):
+    """Delete a conference and start removing what refers to it; return
+    the DeletionJob, or None if it was already gone.
+    """
+    if storage.repo.get(conf_key) is None:
+        return None
+    job = _start(conf_key, conf_key, user_id, CONFERENCE_PHASES)
+    storage.repo.delete_multi([conf_key])
+    entities.invalidate(conf_key)
+    storage.afterWrite(lambda: local.delete(HOT_CONFERENCES_KEY))
+    return job
+
+
+def deleteSession(session_key, user_id):
+    """Delete a session and start removing what refers to it; return
+    the DeletionJob, or None if it was already gone.
+    """
+    job = _deleteSession(session_key, user_id)
+    if job:
+        schedule.removeSessions(job.conferenceKey, [session_key.urlsafe()])
+    return job
+
+
+@storage.transactional(xg=True)
+def _deleteSession(session_key, user_id):
+    session = storage.repo.get(session_key)
+    if session is None:
+        return None
+    job = _start(session_key, conferenceKeyOf(session), user_id,
+                 SESSION_PHASES)
+    storage.repo.delete_multi([session_key])
+    return job
+
+
+@storage.transactional()
+def _removeFromProfile(p_key, field, wskeys):
+    prof = storage.repo.get(p_key)
+    if prof is None:
+        return False
+    values = getattr(prof, field)
+    kept = [wsk for wsk in values if wsk not in wskeys]
+    if len(kept) == len(values):
+        return False
+    setattr(prof, field, kept)
+    storage.putLater(prof)
+    entities.invalidate(p_key)
+    return True
+
+
+def _scrubProfiles(field, wskeys):
+    """Remove wskeys from field (a repeated Profile property) in up to
+    DELETE_BATCH_SIZE profiles per IN filter; return (profiles changed,
+    whether more may be left).
+    """
+    p_keys = set()
+    left = False
+    for i in range(0, len(wskeys), IN_FILTER_LIMIT):
+        found = storage.repo.query(Profile).filter(
+            field, 'in', wskeys[i:i + IN_FILTER_LIMIT]).fetch(
+                DELETE_BATCH_SIZE, keys_only=True)
+        p_keys.update(found)
+        left = left or len(found) == DELETE_BATCH_SIZE
+    wskeys = set(wskeys)
+    changed = sum(1 for p_key in p_keys
+                  if _removeFromProfile(p_key, field, wskeys))
+    return changed, left
+
+
+def _deleteSessions(job, query):
+    keys = query.fetch(DELETE_BATCH_SIZE, keys_only=True)
+    if not keys:
+        return False
+    changed, left = _scrubProfiles('session_wish_list',
+                                   [key.urlsafe() for key in keys])
+    job.profilesUpdated += changed
+    if left:
+        # delete the batch once no wishlist names it
+        return True
+    sync.recordDeletions(keys)
+    storage.repo.delete_multi(keys)
+    job.sessionsDeleted += len(keys)
+    return len(keys) == DELETE_BATCH_SIZE
+
+
+def _sessions(job):
+    return _deleteSessions(
+        job, storage.repo.query(Session, ancestor=job.target))
+
+
+def _flatSessions(job):
+    return _deleteSessions(job, storage.repo.query(Session).filter(
+        'conferenceKey', '=', job.target))
+
+
+def _registrations(job):
+    changed, left = _scrubProfiles('conferenceKeysToAttend',
+                                   [job.target.urlsafe()])
+    job.profilesUpdated += changed
+    return left
+
+
+def _attendance(job):
+    keys = storage.repo.query(Attendance, ancestor=job.target).fetch(
+        DELETE_BATCH_SIZE, keys_only=True)
+    storage.repo.delete_multi(keys)
+    return len(keys) == DELETE_BATCH_SIZE
+
+
+def _wishlists(job):
+    changed, left = _scrubProfiles('session_wish_list',
+                                   [job.target.urlsafe()])
+    job.profilesUpdated += changed
+    return left
+
+
+def _finish(job):
+    if job.target.kind() == 'Conference':
+        doc_key = schedule.scheduleKey(job.target)
+        storage.repo.delete_multi([doc_key])
+        entities.invalidate(doc_key)
+        featured.cacheFeaturedSpeaker(job.target.urlsafe())
+        # imported here so main.py can load this module without the API
+        from conference import ConferenceApi
+        ConferenceApi._cacheAnnouncement()
+    else:
+        # again, in case the request failed right after the deletion
+        schedule.removeSessions(job.conferenceKey, [job.target.urlsafe()])
+        featured.scheduleFeaturedSpeaker(job.conferenceKey)
+    return False
+
+
+PHASES = {
+    'sessions': _sessions,
+    'flatSessions': _flatSessions,
+    'registrations': _registrations,
+    'attendance': _attendance,
+    'wishlists': _wishlists,
+    'finish': _finish,
+}
+
+
+def runBatch(job_key):
+    """Run one batch of a deletion job; return whether more are left."""
+    job = storage.repo.get(job_key)
+    if job is None or job.done:
+        return False
+    if PHASES[job.phase](job):
+        storage.repo.put(job)
+        return True
+    phases = (CONFERENCE_PHASES if job.target.kind() == 'Conference'
+              else SESSION_PHASES)
+    i = phases.index(job.phase) + 1
+    if i < len(phases):
+        job.phase = phases[i]
+    else:
+        job.done = True
+    storage.repo.put(job)
+    return not job.done
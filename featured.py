@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""featured.py
+
+Featured speaker announcement.
+
+createSession calls scheduleFeaturedSpeaker(), which queues at most one
+named task per conference per FEATURED_BUCKET_SECONDS, so bulk agenda
+entry causes a single recomputation. The task (main.SetFeaturedSpeaker)
+runs cacheFeaturedSpeaker(), which deletion.py also calls once a
+conference is deleted.
+
+"""
+
+import collections
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from cache import local
+
+MEMCACHE_FEATURED_KEY = "FEATURED_SPEAKER"
+ANNOUNCEMENT_TPL = ('Check out this session by %s!')
+# session writes within one bucket share a featured speaker task
+FEATURED_BUCKET_SECONDS = 10
+FEATURED_CAS_RETRIES = 5
+
+
+def cacheFeaturedSpeaker(wsck):
+    """Create featured speaker announcement & assign to memcache; used by
+    the coalesced /tasks/set_featured_speaker task.
+
+    Counts are read from the conference's current schedule, never taken
+    from the task, and the memcache entry is only replaced through
+    compare-and-set, so concurrent tasks can't overwrite a better or a
+    newer result with a stale one.
+    """
+    # imported here so main.py can load this module without the API
+    from google.appengine.ext import ndb
+    import schedule
+    import storage
+
+    conf_key = ndb.Key(urlsafe=wsck)
+    doc = storage.repo.get(schedule.scheduleKey(conf_key))
+    if doc is None:
+        conf = storage.repo.get(conf_key)
+        # a deleted conference has no speaker left to feature
+        doc = schedule.build(conf) if conf else None
+
+    counts = collections.Counter()
+    names = {}
+    for day in (doc and doc.days) or []:
+        for entry in day['sessions']:
+            counts[entry['speaker_key']] += 1
+            if entry.get('speaker_name'):
+                names[entry['speaker_key']] = entry['speaker_name']
+    missing = [key for key in counts if key and key not in names]
+    if missing:
+        # entries without a speaker name: read it from the Speakers
+        speakers = storage.repo.get_multi(
+            [ndb.Key(urlsafe=key) for key in missing])
+        names.update((key, speaker.name) for key, speaker
+                     in zip(missing, speakers) if speaker and speaker.name)
+    # a speaker without a name can't be announced
+    speaker_key, count = ([(key, n) for key, n in counts.most_common()
+                           if key in names] or [(None, 0)])[0]
+
+    client = memcache.Client()
+    for _ in range(FEATURED_CAS_RETRIES):
+        current = client.gets(MEMCACHE_FEATURED_KEY)
+        exists = current is not None
+        if not isinstance(current, dict):
+            # missing, or a plain string left by an older version
+            current = None
+        # a conference can always revise its own featured speaker,
+        # otherwise it has to match or beat the current count
+        if current and current.get('conference') != wsck and \
+                count < current.get('count', 0):
+            return
+        if count > 1:
+            featured = {
+                'announcement': ANNOUNCEMENT_TPL % names[speaker_key],
+                'speaker': names[speaker_key],
+                'count': count,
+                'conference': wsck,
+            }
+        elif current and current.get('conference') == wsck:
+            # this conference no longer has a speaker worth featuring
+            featured = {}
+        else:
+            return
+        if not exists:
+            stored = client.add(MEMCACHE_FEATURED_KEY, featured)
+        else:
+            stored = client.cas(MEMCACHE_FEATURED_KEY, featured)
+        if stored:
+            local.set(MEMCACHE_FEATURED_KEY, featured)
+            return
+    logging.warning('Featured speaker not updated: too much contention')
+
+
+def scheduleFeaturedSpeaker(conf_key):
+    """Queue one featured speaker recomputation per conference per
+    FEATURED_BUCKET_SECONDS, however many sessions are written in it.
+    """
+    now = time.time()
+    bucket = int(now // FEATURED_BUCKET_SECONDS)
+    try:
+        taskqueue.add(
+            name='featured-speaker-%s-%d' % (conf_key.urlsafe(), bucket),
+            params={'websafeConferenceKey': conf_key.urlsafe()},
+            url='/tasks/set_featured_speaker',
+            # run once the bucket has closed, so it sees all its writes
+            countdown=(bucket + 1) * FEATURED_BUCKET_SECONDS - now + 1)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
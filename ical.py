@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""ical.py
+
+iCalendar (RFC 5545) feeds of a conference's agenda and of a user's
+session wishlist, served by main.py:
+
+    /ical/conference/<websafeConferenceKey>.ics
+    /ical/wishlist/<calendarToken>.ics
+
+Calendar apps can't sign in, so a wishlist feed is addressed by the
+profile's calendarToken, an unguessable ID handed out by the
+getWishlistCalendar endpoint.
+
+Feeds are generated: sessions are read ICAL_BATCH_SIZE at a time, each
+batch's speakers (and conferences) are resolved in one cache lookup,
+and every event is written out as soon as it is formatted, so a feed
+never exists as a list of sessions.
+
+Each feed has a version, sent as its ETag: for an agenda a hash of its
+conference's name and city (which the feed shows) and the time its
+schedule document (schedule.py) last changed, for a wishlist a hash of
+the listed sessions and their conferences' and schedules' versions.
+Registrations change a conference but not its feeds, so they don't
+change the version.
+Calendar apps poll with If-None-Match, and an unchanged feed is
+answered with 304 from cached reads only.
+
+"""
+
+import hashlib
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+import storage
+from cache import entities
+from layout import conferenceKeyOf
+from layout import movedKey
+from layout import sessionsQuery
+from models import Profile
+from schedule import getSchedule
+from schedule import scheduleKey
+
+ICAL_BATCH_SIZE = 50
+PRODID = '-//Conference Central//Agenda//EN'
+UID_DOMAIN = 'conference-central'
+# longest content line, in octets, before it is folded
+LINE_LIMIT = 75
+
+
+def _escape(text):
+    """Escape a TEXT value."""
+    return (text or u'').replace('\\', '\\\\').replace(';', '\\;').replace(
+        ',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _line(name, value):
+    """Return one CRLF-terminated content line, folded to LINE_LIMIT."""
+    line = (u'%s:%s' % (name, value)).encode('utf-8')
+    folded = []
+    while len(line) > LINE_LIMIT:
+        cut = LINE_LIMIT
+        # never split a multi-byte character
+        while cut and (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        folded.append(line[:cut])
+        line = ' ' + line[cut:]
+    folded.append(line)
+    return '\r\n'.join(folded) + '\r\n'
+
+
+def _stamp(value):
+    return value.strftime('%Y%m%dT%H%M%SZ')
+
+
+def _event(session, conf, speaker):
+    """Return the VEVENT of a session."""
+    start = datetime.combine(session.date.date(), session.start_time.time())
+    lines = [
+        _line('BEGIN', 'VEVENT'),
+        _line('UID', '%s@%s' % (session.key.urlsafe(), UID_DOMAIN)),
+        _line('DTSTAMP', _stamp(session.updated or datetime.utcnow())),
+        # floating time: the conference's own local time
+        _line('DTSTART', start.strftime('%Y%m%dT%H%M%S')),
+    ]
+    if session.duration:
+        end = start + timedelta(minutes=session.duration)
+        lines.append(_line('DTEND', end.strftime('%Y%m%dT%H%M%S')))
+    lines.append(_line('SUMMARY', _escape(session.name)))
+    description = [session.highlights or u'']
+    if speaker:
+        description.append(u'Speaker: %s' % speaker.name)
+    lines.append(_line('DESCRIPTION', _escape(u'\n'.join(description))))
+    if conf and conf.city:
+        lines.append(_line('LOCATION', _escape(conf.city)))
+    lines.append(_line('END', 'VEVENT'))
+    return ''.join(lines)
+
+
+def _calendar(name, events):
+    """Yield a VCALENDAR named name around events."""
+    yield ''.join([
+        _line('BEGIN', 'VCALENDAR'),
+        _line('VERSION', '2.0'),
+        _line('PRODID', PRODID),
+        _line('CALSCALE', 'GREGORIAN'),
+        _line('X-WR-CALNAME', _escape(name)),
+    ])
+    for event in events:
+        yield event
+    yield _line('END', 'VCALENDAR')
+
+
+def _speakers(sessions):
+    keys = list(set(ndb.Key(urlsafe=session.speaker_key)
+                    for session in sessions))
+    return dict(zip(keys, entities.get_multi(keys)))
+
+
+def _scheduleVersion(schedule):
+    updated = getattr(schedule, 'updated', None)
+    return updated.isoformat() if updated else '0'
+
+
+def _conferenceVersion(conf):
+    """Return the conference fields a feed shows, as a version."""
+    if not conf:
+        return ''
+    return u'%s|%s' % (conf.name, conf.city or u'')
+
+
+# - - - conference agenda - - - - - - - - - - - - - - - - - - -
+
+def conferenceForKey(websafe_key):
+    """Return the conference with websafe_key (following a move to the
+    flat layout), or None.
+    """
+    try:
+        key = ndb.Key(urlsafe=websafe_key)
+    except Exception:
+        return None
+    if key.kind() != 'Conference':
+        return None
+    conf = entities.get(key)
+    if not conf:
+        moved = movedKey(key)
+        conf = entities.get(moved) if moved else None
+    return conf
+
+
+def agendaVersion(conf):
+    """Return the version (ETag) of a conference's agenda feed."""
+    return hashlib.sha1((u'%s:%s:%s' % (
+        conf.key.urlsafe(), _scheduleVersion(getSchedule(conf)),
+        _conferenceVersion(conf))).encode('utf-8')).hexdigest()
+
+
+def agenda(conf):
+    """Yield a conference's agenda as iCalendar text."""
+    def events():
+        query = sessionsQuery(conf)
+        cursor, more = None, True
+        while more:
+            batch, cursor, more = query.fetch_page(
+                ICAL_BATCH_SIZE, start_cursor=cursor)
+            speakers = _speakers(batch)
+            for session in batch:
+                yield _event(session, conf, speakers.get(
+                    ndb.Key(urlsafe=session.speaker_key)))
+            more = more and cursor
+    return _calendar(conf.name, events())
+
+
+# - - - wishlist - - - - - - - - - - - - - - - - - - - - - - - -
+
+def profileForToken(token):
+    """Return the profile whose calendarToken is token, or None."""
+    if not token:
+        return None
+    return storage.repo.query(Profile).filter(
+        'calendarToken', '=', token).get()
+
+
+def _batches(keys):
+    for i in range(0, len(keys), ICAL_BATCH_SIZE):
+        yield keys[i:i + ICAL_BATCH_SIZE]
+
+
+def _wishlistKeys(prof):
+    keys = []
+    for websafe_key in prof.session_wish_list:
+        try:
+            keys.append(ndb.Key(urlsafe=websafe_key))
+        except Exception:
+            # a malformed entry shouldn't break the whole feed
+            continue
+    return keys
+
+
+def wishlistVersion(prof):
+    """Return the version (ETag) of a profile's wishlist feed."""
+    keys = _wishlistKeys(prof)
+    conf_keys = set(key.parent() for key in keys if key.parent())
+    # sessions in the flat layout don't name their conference in the key
+    flat = [key for key in keys if not key.parent()]
+    for batch in _batches(flat):
+        conf_keys.update(conferenceKeyOf(session)
+                         for session in storage.repo.get_multi(batch)
+                         if session)
+    conf_keys = sorted(conf_keys)
+    confs = entities.get_multi(conf_keys)
+    schedules = entities.get_multi([scheduleKey(key) for key in conf_keys])
+    digest = hashlib.sha1()
+    digest.update(','.join(sorted(prof.session_wish_list)))
+    for conf_key, conf, schedule in zip(conf_keys, confs, schedules):
+        digest.update((u'%s:%s:%s' % (
+            conf_key.urlsafe(), _scheduleVersion(schedule),
+            _conferenceVersion(conf))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def wishlist(prof):
+    """Yield a profile's wishlist as iCalendar text."""
+    def events():
+        for keys in _batches(_wishlistKeys(prof)):
+            batch = [session for session in storage.repo.get_multi(keys)
+                     if session]
+            conf_keys = list(set(conferenceKeyOf(s) for s in batch))
+            confs = dict(zip(conf_keys, entities.get_multi(conf_keys)))
+            speakers = _speakers(batch)
+            for session in batch:
+                yield _event(session, confs.get(conferenceKeyOf(session)),
+                             speakers.get(ndb.Key(urlsafe=session.speaker_key)))
+    return _calendar(u'%s: wishlist' % (prof.displayName or u'My'), events())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""identity.py
+
+Resolution of OAuth bearer tokens and emails to user IDs, used by
+utils.getUserId.
+
+A token is looked up in instance memory, then memcache, and only then
+sent to Google's tokeninfo endpoint. Lookups are asynchronous (ndb
+tasklets) with a short deadline and no retry sleeps, so a slow tokeninfo
+response costs a request at most FETCH_DEADLINE seconds. Resolved tokens
+are cached until shortly before they expire; tokens are kept hashed.
+
+The network call goes through the module-level `fetcher`; set it to a
+LocalTokenInfo to resolve tokens from a dict instead (tests, offline
+development).
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+import urllib
+import uuid
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+import storage
+from cache import LRUCache
+from models import Profile
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+# seconds to wait for tokeninfo
+FETCH_DEADLINE = 2
+# seconds a token is trusted when tokeninfo gives no expiry
+DEFAULT_TOKEN_TTL = 300
+# stop trusting a token this many seconds before it expires
+EXPIRY_MARGIN = 30
+# seconds a token may be served from instance memory
+LOCAL_TOKEN_TTL = 300
+MEMCACHE_TOKEN_PREFIX = 'TOKEN:'
+
+tokens = LRUCache(ttl=LOCAL_TOKEN_TTL)
+
+
+class TokenInfoFetcher(object):
+
+    """TokenInfoFetcher -- asks Google's tokeninfo endpoint"""
+
+    def __init__(self, deadline=FETCH_DEADLINE):
+        self.deadline = deadline
+
+    @ndb.tasklet
+    def fetch_async(self, token_type, token):
+        """Return (status code, tokeninfo dict or None); status is None
+        if tokeninfo could not be reached in time.
+        """
+        url = TOKENINFO_URL % (token_type, urllib.quote(token, safe=''))
+        try:
+            resp = yield ndb.get_context().urlfetch(url, deadline=self.deadline)
+        except urlfetch.Error:
+            logging.warning('tokeninfo (%s) failed', token_type, exc_info=True)
+            raise ndb.Return(None, None)
+        try:
+            info = json.loads(resp.content)
+        except ValueError:
+            info = None
+        raise ndb.Return(resp.status_code, info)
+
+
+class LocalTokenInfo(object):
+
+    """LocalTokenInfo -- stand-in answering from a dict of token -> tokeninfo"""
+
+    def __init__(self, infos=None):
+        self.infos = dict(infos or {})
+        self.calls = 0
+
+    def fetch_async(self, token_type, token):
+        self.calls += 1
+        info = self.infos.get(token)
+        future = ndb.Future()
+        if info is None:
+            future.set_result((400, {'error': 'invalid_token'}))
+        else:
+            future.set_result((200, info))
+        return future
+
+
+fetcher = TokenInfoFetcher()
+
+
+def _tokenHash(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+@ndb.tasklet
+def resolveToken_async(token):
+    """Return the user ID for an OAuth token, or '' if it can't be
+    resolved.
+    """
+    digest = _tokenHash(token)
+    user_id = tokens.get(digest)
+    if user_id is not None:
+        raise ndb.Return(user_id)
+
+    ctx = ndb.get_context()
+    cached = yield ctx.memcache_get(MEMCACHE_TOKEN_PREFIX + digest)
+    if cached:
+        user_id, expires = cached
+        ttl = expires - time.time()
+        if ttl > 0:
+            tokens.set(digest, user_id, ttl=min(ttl, LOCAL_TOKEN_TTL))
+            raise ndb.Return(user_id)
+
+    # an id_token unless the request was authorized with an access token;
+    # ask about both at once when unsure instead of retrying in turn
+    if 'OAUTH_USER_ID' in os.environ:
+        token_types = ['access_token']
+    else:
+        token_types = ['id_token', 'access_token']
+    futures = [fetcher.fetch_async(token_type, token)
+               for token_type in token_types]
+    for future in futures:
+        status, info = yield future
+        if status == 200 and info and info.get('user_id'):
+            user_id = info['user_id']
+            ttl = int(info.get('expires_in', DEFAULT_TOKEN_TTL)) - EXPIRY_MARGIN
+            if ttl > 0:
+                tokens.set(digest, user_id, ttl=min(ttl, LOCAL_TOKEN_TTL))
+                yield ctx.memcache_set(MEMCACHE_TOKEN_PREFIX + digest,
+                                       (user_id, time.time() + ttl), time=ttl)
+            raise ndb.Return(user_id)
+    raise ndb.Return('')
+
+
+def resolveToken(token):
+    """Return the user ID for an OAuth token, or '' if it can't be
+    resolved.
+    """
+    return resolveToken_async(token).get_result()
+
+
+def userIdForEmail(email):
+    """Return the ID of the profile with email, or a new unique ID."""
+    p_key = storage.repo.query(Profile).filter(
+        'mainEmail', '=', email).get(keys_only=True)
+    if p_key:
+        return p_key.id()
+    return str(uuid.uuid1().get_hex())
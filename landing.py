@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""landing.py
+
+The landing page (/), served with the first conferences already in it.
+
+templates/index.html is filled in with the signed-out dashboard twice:
+as markup the browser can show while the Google API client and Angular
+are still loading, and as JSON (window.CONFERENCE_DASHBOARD) that the
+dashboard service in app.js hands out instead of making its first
+getDashboard call. The JSON is encoded the way Cloud Endpoints encodes
+the getDashboard response, so the client can't tell the two apart.
+
+The dashboard comes from the same instance and memcache caches as
+getDashboard, and the rendered page is kept in instance memory for
+local's TTL, so most page views cost no RPC at all.
+
+"""
+
+import cgi
+import os
+
+from endpoints import protojson
+
+from cache import local
+from conference import ConferenceApi
+
+INDEX_HTML = os.path.join(os.path.dirname(__file__), 'templates', 'index.html')
+LANDING_PAGE_KEY = 'LANDING_PAGE'
+
+# placeholders in index.html, harmless comments where nothing is filled in
+DATA_MARKER = '<!-- prerender:data -->'
+CONFERENCES_MARKER = '<!-- prerender:conferences -->'
+
+DATA_TPL = '<script>window.CONFERENCE_DASHBOARD = %s;</script>'
+# ng-non-bindable: conference names are shown as typed, never as
+# Angular expressions; ng-view replaces the whole block once it starts
+CONFERENCES_TPL = '''<div class="prerendered" ng-non-bindable>
+    %(announcement)s
+    <h3>Conferences</h3>
+    <table class="table table-striped">
+        <thead>
+        <tr><th>Name</th><th>City</th><th>Start Date</th><th>Registered/Open</th></tr>
+        </thead>
+        <tbody>
+        %(rows)s
+        </tbody>
+    </table>
+    <a href="#/conference">%(more)s</a>
+</div>'''
+ROW_TPL = ('<tr><td><a href="#/conference/detail/%s">%s</a></td>'
+           '<td>%s</td><td>%s</td><td>%d / %d</td></tr>')
+ANNOUNCEMENT_TPL = '<p class="text-info">%s</p>'
+
+_encoder = protojson.EndpointsProtoJson()
+
+
+def _text(value):
+    return cgi.escape(value or '', quote=True)
+
+
+def renderConferences(dashboard):
+    """Return the markup shown before the web client takes over."""
+    rows = []
+    for conf in dashboard.conferences:
+        max_attendees = conf.maxAttendees or 0
+        rows.append(ROW_TPL % (
+            _text(conf.websafeKey), _text(conf.name), _text(conf.city),
+            _text((conf.startDate or '')[:10]),
+            max_attendees - (conf.seatsAvailable or 0), max_attendees))
+    announcements = filter(None, [dashboard.announcement,
+                                  dashboard.featuredSpeaker])
+    return CONFERENCES_TPL % {
+        'announcement': '\n    '.join(ANNOUNCEMENT_TPL % _text(text)
+                                      for text in announcements),
+        'rows': '\n        '.join(rows),
+        'more': ('All conferences' if dashboard.moreConferences
+                 else 'Search conferences'),
+    }
+
+
+def renderData(dashboard):
+    """Return a script tag setting window.CONFERENCE_DASHBOARD."""
+    data = _encoder.encode_message(dashboard)
+    # '</script>' in a name mustn't end the tag early
+    return DATA_TPL % data.replace('</', '<\\/')
+
+
+def landingPage():
+    """Return the landing page HTML, rendering it if not cached."""
+    page = local.get(LANDING_PAGE_KEY)
+    if page is None:
+        dashboard = ConferenceApi._publicDashboard()
+        with open(INDEX_HTML) as f:
+            page = f.read().decode('utf-8')
+        page = page.replace(DATA_MARKER, renderData(dashboard))
+        page = page.replace(CONFERENCES_MARKER, renderConferences(dashboard))
+        local.set(LANDING_PAGE_KEY, page)
+    return page
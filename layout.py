@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""layout.py
+
+Key layout of Conferences and Sessions.
+
+Legacy layout: a Conference is a child of its organizer's Profile and
+its Sessions are children of the Conference, so all of an organizer's
+conferences share one entity group and all of a conference's sessions
+share another, each limited to about one write per second.
+
+Flat layout (FLAT_ENTITY_GROUPS in settings.py): Conferences and
+Sessions are root entities. Ownership lives in properties instead,
+Conference.organizerUserId and Session.conferenceKey, and each
+Conference records its layout in Conference.flatLayout. Attendance
+records and the schedule document stay children of their Conference,
+which is the group registration already writes.
+
+Code that creates or looks up these entities goes through the helpers
+below, so the two layouts can coexist while migrations.py moves
+existing data. While a legacy conference moves (Conference.movingTo is
+set), its sessions are found and created as in the flat layout, under
+the conference's new key. The helpers use the storage repository
+(storage.py).
+
+"""
+
+from google.appengine.ext import ndb
+
+import storage
+from models import Conference
+from models import KeyMigration
+from models import Profile
+from models import Session
+from settings import FLAT_ENTITY_GROUPS
+
+
+def newConferenceKey(user_id):
+    """Return a fresh key for a conference organized by user_id."""
+    if FLAT_ENTITY_GROUPS:
+        return ndb.Key(Conference, storage.repo.allocateIds(Conference)[0])
+    p_key = ndb.Key(Profile, user_id)
+    c_id = storage.repo.allocateIds(Conference, parent=p_key)[0]
+    return ndb.Key(Conference, c_id, parent=p_key)
+
+
+def newSessionKey(conf):
+    """Return a fresh key for a session of conf, in conf's layout."""
+    if conf.flatLayout or conf.movingTo:
+        return ndb.Key(Session, storage.repo.allocateIds(Session)[0])
+    s_id = storage.repo.allocateIds(Session, parent=conf.key)[0]
+    return ndb.Key(Session, s_id, parent=conf.key)
+
+
+def conferencesQuery(user_id):
+    """Return query for the conferences organized by user_id."""
+    return storage.repo.query(Conference).filter(
+        'organizerUserId', '=', user_id)
+
+
+def sessionsQuery(conf):
+    """Return query for the sessions of conf.
+
+    Ancestor queries (legacy layout) are strongly consistent; property
+    queries (flat layout, or a legacy conference that is moving) may
+    miss a session written moments ago.
+    """
+    if conf.flatLayout or conf.movingTo:
+        return storage.repo.query(Session).filter(
+            'conferenceKey', '=', conf.movingTo or conf.key)
+    return storage.repo.query(Session, ancestor=conf.key)
+
+
+def conferenceKeyOf(session):
+    """Return the key of the conference a session belongs to."""
+    # a legacy session's conferenceKey is its conference's new key
+    # while the conference moves
+    return session.key.parent() or session.conferenceKey
+
+
+def movedKey(key):
+    """Return where the entity at key was moved to, or None."""
+    return movedKeys([key])[0]
+
+
+def movedKeys(keys):
+    """Return where the entities at keys were moved to (None for those
+    that weren't), in order."""
+    records = storage.repo.get_multi(
+        [ndb.Key(KeyMigration, key.urlsafe()) for key in keys])
+    return [record.newKey if record else None for record in records]
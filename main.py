@@ -8,8 +8,14 @@ $Id$
 
 created by wesc on 2014 may 24
 
-UPDATED to include the SetFeaturedSpeaker class and the _cacheFeaturedSpeaker 
-function to enable storing a featured speaker in memcache.
+UPDATED to include the SetFeaturedSpeaker class, which runs
+featured.cacheFeaturedSpeaker to store a featured speaker in memcache.
+
+Task and cron handlers retry transient datastore errors themselves
+(resilience.py) before failing the task back to the queue.
+
+The API module (endpoints, protorpc) is only imported by the handlers
+that need it, so task handlers start fast on a cold instance.
 
 - Prasanna Shevade
 
@@ -17,61 +23,303 @@ function to enable storing a featured speaker in memcache.
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from conference import ConferenceApi
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+import featured
+import outbox
+import profiling
+import resilience
+import warmup
+from cache import entities
+from cache import local
+
+# sessions re-put per backfill task
+BACKFILL_BATCH_SIZE = 100
+# profiles converted per attendance migration task
+MIGRATION_BATCH_SIZE = 100
+# conferences looked at per flat layout migration task when searching
+# for the next one to move
+FLATTEN_SCAN_SIZE = 100
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Import the API & prime instance caches (/_ah/warmup)."""
+        warmup.warm()
+        self.response.set_status(200)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return this instance's cache hit/miss counters (admin only)."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'entities': entities.stats(),
+            'local': local.stats(),
+        }))
+
+
+class LandingPageHandler(webapp2.RequestHandler):
+    def get(self):
+        """Serve index.html with the first conferences rendered in (/)."""
+        import landing
+        self.response.headers['Cache-Control'] = 'public, max-age=60'
+        self.response.write(landing.landingPage())
 
-MEMCACHE_SPEAKER_NAME_KEY = "FEATURED_SPEAKER_NAME"
-MEMCACHE_SPEAKER_COUNT_KEY = "FEATURED_SPEAKER_COUNT"
-MEMCACHE_FEATURED_KEY = "FEATURED_SPEAKER"
-ANNOUNCEMENT_TPL = ('Check out this session by %s!')
+
+class CalendarHandler(webapp2.RequestHandler):
+    def sendFeed(self, version, feed, cache_control):
+        """Answer with feed (an iterable of text), or 304 if the client
+        already has this version."""
+        etag = '"%s"' % version
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = cache_control
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        for chunk in feed():
+            self.response.out.write(chunk)
+
+
+class ConferenceCalendarHandler(CalendarHandler):
+    def get(self, websafe_key):
+        """Serve a conference's agenda as iCalendar (/ical/conference/...)."""
+        import ical
+        conf = ical.conferenceForKey(websafe_key)
+        if not conf:
+            self.abort(404)
+        self.sendFeed(ical.agendaVersion(conf), lambda: ical.agenda(conf),
+                      'public, max-age=300')
+
+
+class WishlistCalendarHandler(CalendarHandler):
+    def get(self, token):
+        """Serve a user's wishlist as iCalendar (/ical/wishlist/...)."""
+        import ical
+        prof = ical.profileForToken(token)
+        if not prof:
+            self.abort(404)
+        self.sendFeed(ical.wishlistVersion(prof), lambda: ical.wishlist(prof),
+                      'private, max-age=300')
+
+
+class ProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the kept request profiles, newest first (admin only)."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(profiling.recentProfiles()))
+
+
+class ThrottleStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return admission control counters (admin only)."""
+        import throttle
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(throttle.stats()))
+
+
+class ResilienceStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return retry, fallback and circuit breaker counters (admin only)."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(resilience.stats()))
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @resilience.retried('datastore')
     def get(self):
         """Set Announcement in Memcache."""
+        from conference import ConferenceApi
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
 
+class PruneTombstonesHandler(webapp2.RequestHandler):
+    @resilience.retried('datastore')
+    def get(self):
+        """Delete tombstones the changes feed no longer serves."""
+        import sync
+        logging.info('Pruned %d tombstones', sync.pruneTombstones())
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Move a confirmation queued before the outbox existed into it."""
+        outbox.enqueue('conference_created_legacy',
+                       self.request.get('email'),
+                       conferenceInfo=self.request.get('conferenceInfo'))
+
+
+class DrainOutboxHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send queued emails within the send budget."""
+        outbox.drain()
+        self.response.set_status(204)
+
+
+class FlattenEntityGroupsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving data to the flat key layout (admin only)."""
+        from settings import FLAT_ENTITY_GROUPS
+        if not FLAT_ENTITY_GROUPS:
+            self.response.set_status(409)
+            self.response.write('Switch on FLAT_ENTITY_GROUPS in settings.py '
+                                'and deploy before migrating.')
+            return
+        taskqueue.add(params={'phase': 'conferences'},
+                      url='/tasks/flatten_entity_groups')
+        self.response.set_status(202)
+
+    @resilience.retried('datastore')
+    def post(self):
+        """Move one batch of one legacy conference, or find the next one
+        to move; once all are moved rewrite one batch of profiles. Chain
+        a task for what's left.
+        """
+        from google.appengine.datastore.datastore_query import Cursor
+        from google.appengine.ext import ndb
+        import migrations
+        from models import Conference
+        from models import Profile
+        phase = self.request.get('phase')
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        if phase == 'conferences':
+            wsck = self.request.get('conference')
+            if wsck and not migrations.flattenStep(ndb.Key(urlsafe=wsck)):
+                self._chain(phase, cursor, conference=wsck)
+                return
+            confs = Conference.query().iter(
+                limit=FLATTEN_SCAN_SIZE, start_cursor=cursor,
+                produce_cursors=True)
+            seen = 0
+            for conf in confs:
+                seen += 1
+                if not conf.flatLayout:
+                    # the cursor is where to look once it has moved
+                    self._chain(phase, confs.cursor_after(),
+                                conference=conf.key.urlsafe())
+                    return
+            if seen == FLATTEN_SCAN_SIZE:
+                self._chain(phase, confs.cursor_after())
+            else:
+                self._chain('profiles', None)
+        else:
+            profiles, next_cursor, more = Profile.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+            migrations.rewriteProfiles(profiles)
+            if more and next_cursor:
+                self._chain(phase, next_cursor)
+
+    def _chain(self, phase, cursor, **params):
+        params['phase'] = phase
+        if cursor:
+            params['cursor'] = cursor.urlsafe()
+        taskqueue.add(params=params, url='/tasks/flatten_entity_groups')
 
 
 class SetFeaturedSpeaker(webapp2.RequestHandler):
 
+    @resilience.retried('datastore')
     def post(self):
-        """Set the featured speaker here"""
-        _cacheFeaturedSpeaker(self.request.get('speaker'), self.request.get('count'))
+        """Recompute the featured speaker from one conference's sessions."""
+        wsck = self.request.get('websafeConferenceKey')
+        if not wsck:
+            # queued by an older version with a precomputed count
+            logging.info('Ignoring featured speaker task without conference')
+            return
+        featured.cacheFeaturedSpeaker(wsck)
 
 
-def _cacheFeaturedSpeaker(speaker, count):
-    """Create featured speaker announcement & assign to memcache; used by
-    """
-    print "Inside cacheFeaturedSpeaker"
-    exisiting_speaker_count = memcache.get(MEMCACHE_SPEAKER_COUNT_KEY)
-    print "this is the existing speaker count: ", exisiting_speaker_count
-    if count >= exisiting_speaker_count and count > 1:
-        featured_speaker = ANNOUNCEMENT_TPL % speaker
-        memcache.set(MEMCACHE_FEATURED_KEY, featured_speaker)
-        memcache.set(MEMCACHE_SPEAKER_NAME_KEY, speaker)
-        memcache.set(MEMCACHE_SPEAKER_COUNT_KEY, count)
+class CascadeDeleteHandler(webapp2.RequestHandler):
+    @resilience.retried('datastore')
+    def post(self):
+        """Run one batch of a conference or session deletion (see
+        deletion.py), then chain a task for the next batch.
+        """
+        from google.appengine.ext import ndb
+        import deletion
+        job = self.request.get('job')
+        if deletion.runBatch(ndb.Key(urlsafe=job)):
+            taskqueue.add(params={'job': job}, url='/tasks/cascade_delete')
+
+
+class BackfillSessionSlotsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the time slot backfill (admin only, see app.yaml)."""
+        taskqueue.add(url='/tasks/backfill_session_slots')
+        self.response.set_status(202)
+
+    @resilience.retried('datastore')
+    def post(self):
+        """Re-put one batch of Sessions so their computed time slot
+        properties are written, then chain a task for the next batch.
+        """
+        from google.appengine.datastore.datastore_query import Cursor
+        from google.appengine.ext import ndb
+        from models import Session
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(sessions)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_session_slots')
+
+
+class MigrateAttendanceHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the attendance migration (admin only, see app.yaml)."""
+        taskqueue.add(url='/tasks/migrate_attendance')
+        self.response.set_status(202)
+
+    @resilience.retried('datastore')
+    def post(self):
+        """Convert the registrations kept in one batch of Profiles'
+        conferenceKeysToAttend to Attendance records, then chain the
+        next batch. Each conference is converted in a transaction that
+        checks the profile still lists it, so re-running a batch is
+        harmless (see attendance.py).
+        """
+        from google.appengine.datastore.datastore_query import Cursor
+        import attendance
+        from models import Profile
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        for prof in profiles:
+            for wsck in list(prof.conferenceKeysToAttend):
+                attendance.convertRegistration(prof.key.id(), wsck)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/migrate_attendance')
 
 
 app = webapp2.WSGIApplication([
+    ('/', LandingPageHandler),
+    ('/ical/conference/([^/]+)\.ics', ConferenceCalendarHandler),
+    ('/ical/wishlist/([^/]+)\.ics', WishlistCalendarHandler),
+    ('/_ah/warmup', WarmupHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/throttle_stats', ThrottleStatsHandler),
+    ('/admin/profiles', ProfilesHandler),
+    ('/admin/resilience_stats', ResilienceStatsHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/drain_outbox', DrainOutboxHandler),
+    ('/crons/prune_tombstones', PruneTombstonesHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeaker),
+    ('/tasks/cascade_delete', CascadeDeleteHandler),
+    ('/tasks/backfill_session_slots', BackfillSessionSlotsHandler),
+    ('/tasks/migrate_attendance', MigrateAttendanceHandler),
+    ('/tasks/flatten_entity_groups', FlattenEntityGroupsHandler),
 ], debug=True)
+app = warmup.timeFirstResponse(profiling.wrap(app))
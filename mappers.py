@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""mappers.py
+
+Precompiled entity -> ProtoRPC message copiers.
+
+Each mapper works out, once at import time, which message fields are
+copied straight from a model property, which need a conversion (dates,
+times, enums) and which are filled from extra context (websafe keys,
+organizer name, speaker details). Copying an entity is then a single
+pass over that plan, with no hasattr/all_fields() work per entity.
+
+"""
+
+from models import AttendeeForm
+from models import Conference
+from models import ConferenceForm
+from models import DeletionForm
+from models import DeletionJob
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import Speaker
+from models import SpeakerForm
+from models import TeeShirtSize
+from models import TypeOfSession
+
+
+class EntityMapper(object):
+
+    """EntityMapper -- copier compiled for one model/message pair"""
+
+    def __init__(self, model, message, converters=None, extras=None):
+        converters = converters or {}
+        extras = extras or {}
+        plan = []
+        for field in message.all_fields():
+            name = field.name
+            if name in extras:
+                plan.append((name, None, extras[name]))
+            elif name in model._properties:
+                plan.append((name, name, converters.get(name)))
+        self._message = message
+        self._plan = tuple(plan)
+        # only pay for check_initialized() when the message can fail it
+        self._check = any(field.required for field in message.all_fields())
+
+    def __call__(self, entity, **context):
+        """Copy entity into a new message; context feeds the extras."""
+        msg = self._message()
+        for name, attr, convert in self._plan:
+            if attr is None:
+                value = convert(entity, context)
+            else:
+                value = getattr(entity, attr)
+                if convert is not None and value is not None:
+                    value = convert(value)
+            if value is not None:
+                setattr(msg, name, value)
+        if self._check:
+            msg.check_initialized()
+        return msg
+
+
+def _enumConverter(enum, default=None):
+    """Return converter from a stored enum name to the enum value."""
+    def convert(value):
+        try:
+            return getattr(enum, value)
+        except AttributeError:
+            if default is None:
+                raise
+            return default
+    return convert
+
+
+def _speakerField(name):
+    """Return extra that reads one field of the session's speaker."""
+    def extra(session, context):
+        speaker = context.get('speaker')
+        return getattr(speaker, name) if speaker else None
+    return extra
+
+
+copyConferenceToForm = EntityMapper(
+    Conference, ConferenceForm,
+    converters={
+        'startDate': str,
+        'endDate': str,
+    },
+    extras={
+        'websafeKey': lambda conf, context: conf.key.urlsafe(),
+        'organizerDisplayName':
+            lambda conf, context: context.get('displayName') or None,
+    })
+
+copyProfileToForm = EntityMapper(
+    Profile, ProfileForm,
+    converters={
+        'teeShirtSize': _enumConverter(TeeShirtSize),
+    },
+    extras={
+        # from the Attendance records as well (attendance.py)
+        'conferenceKeysToAttend':
+            lambda prof, context: context['conferenceKeys'],
+    })
+
+copyProfileToAttendeeForm = EntityMapper(
+    Profile, AttendeeForm,
+    converters={
+        'teeShirtSize': _enumConverter(TeeShirtSize),
+    })
+
+copySessionToForm = EntityMapper(
+    Session, SessionForm,
+    converters={
+        'date': lambda value: value.strftime("%Y-%m-%d"),
+        'start_time': lambda value: value.strftime("%H:%M"),
+        'type_of_session': _enumConverter(TypeOfSession,
+                                          TypeOfSession.NOT_SPECIFIED),
+    },
+    extras={
+        'conf_websafekey':
+            lambda session, context: context['conf'].key.urlsafe(),
+        'sess_websafekey': lambda session, context: session.key.urlsafe(),
+        'speaker_name': _speakerField('name'),
+        'speaker_email': _speakerField('email'),
+        'speaker_speciality': _speakerField('speciality'),
+    })
+
+copySpeakerToForm = EntityMapper(
+    Speaker, SpeakerForm,
+    extras={
+        'websafeKey': lambda speaker, context: speaker.key.urlsafe(),
+    })
+
+copyDeletionJobToForm = EntityMapper(
+    DeletionJob, DeletionForm,
+    extras={
+        'websafeKey': lambda job, context: job.key.urlsafe(),
+        'kind': lambda job, context: job.target.kind(),
+        'websafeTargetKey': lambda job, context: job.target.urlsafe(),
+    })
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Online migration of Conferences and Sessions to the flat key layout
+(see layout.py), run in batches by the /tasks/flatten_entity_groups
+task chain in main.py.
+
+Every conference is moved in this order, one batch per task
+(flattenStep()) so a large conference doesn't outlast a request:
+
+1. A KeyMigration record for the conference fixes its new key, so a
+   retried task continues the same move.
+2. The sessions still under the conference are pointed at the new key
+   (Session.conferenceKey), in batches. The transaction that finds none
+   left sets Conference.movingTo, from when on layout.sessionsQuery()
+   queries Session.conferenceKey instead of the ancestor, and new
+   sessions are created as root entities. No session moves before the
+   instance caches of the unmarked conference have expired.
+3. Sessions are copied to root keys (KeyMigration record first, then
+   the copy, then the old session is deleted, leaving a tombstone for
+   the changes feed) in batches. Both the old session and its copy
+   point at the new key, so a session is never missed by the query
+   meanwhile (it may briefly be listed twice).
+4. The conference is copied and the old one deleted in one transaction,
+   so a concurrent registration either lands before the move or
+   follows the KeyMigration record to the new conference.
+5. Attendance records move under the new conference, one transaction
+   each, and the schedule document is rewritten with the new keys.
+   Registration reads and deletes a user's record under both keys
+   meanwhile (attendance.recordKeys()), so an unregistration is never
+   undone by the move.
+
+After all conferences, rewriteProfiles() maps the websafe keys kept in
+Profile.conferenceKeysToAttend and Profile.session_wish_list. Until it
+has, registration matches a moved conference under both keys (the old
+one is kept in Conference.movedFrom) and the attended conferences are
+looked up through the KeyMigration records. Every step can be re-run
+safely.
+
+"""
+
+import logging
+import time
+
+from google.appengine.ext import ndb
+
+import schedule
+import sync
+from cache import DEFAULT_TTL
+from cache import HOT_CONFERENCES_KEY
+from cache import entities
+from cache import local
+from layout import movedKey
+from models import Attendance
+from models import Conference
+from models import KeyMigration
+from models import Session
+
+SESSION_BATCH_SIZE = 100
+ATTENDANCE_BATCH_SIZE = 100
+
+
+def _copyEntity(entity, key, **overrides):
+    """Return a copy of entity stored at key (computed values excluded)."""
+    values = dict((name, getattr(entity, name))
+                  for name, prop in entity._properties.items()
+                  if not isinstance(prop, ndb.ComputedProperty))
+    values.update(overrides)
+    return entity.__class__(key=key, **values)
+
+
+def flattenStep(old_key):
+    """Move one batch of the legacy conference at old_key (and what is
+    under it) to the flat layout; return True once all of it has moved.
+
+    Each call does a bounded amount of work, so the task chain moves a
+    large conference over as many requests as it takes.
+    """
+    new_key = movedKey(old_key)
+    old = old_key.get()
+    if new_key is None:
+        if old is None:
+            # deleted before its move started
+            return True
+        new_key = ndb.Key(Conference, Conference.allocate_ids(size=1)[0])
+        KeyMigration(id=old_key.urlsafe(), newKey=new_key).put()
+
+    if old is not None:
+        if old.movingTo != new_key:
+            if _pointSessions(old_key, new_key):
+                # instances that cached the conference before it was
+                # marked query its sessions by ancestor until their copy
+                # expires; don't move any session away before that
+                time.sleep(DEFAULT_TTL)
+            return False
+        if _moveSessions(old_key, new_key) or _repointSessions(old_key, new_key):
+            return False
+        # if a session was added under the old key meanwhile, the next
+        # call moves it first
+        _moveConference(old_key, new_key)
+        return False
+    if _moveAttendance(old_key, new_key):
+        return False
+    new_conf = new_key.get()
+    if new_conf:
+        _moveSchedule(old_key, new_conf)
+
+    entities.invalidate(old_key, new_key)
+    local.delete(HOT_CONFERENCES_KEY)
+    logging.info('Moved conference %s to %s', old_key, new_key)
+    return True
+
+
+@ndb.transactional()
+def _pointSessions(old_key, new_key):
+    """Point one batch of the sessions under the legacy conference at
+    its new key, and once none is left mark the conference as moving;
+    return whether it was marked.
+    """
+    conf = old_key.get()
+    if conf is None:
+        return False
+    sessions = []
+    # ancestor and equality filters only: no composite index needed
+    for current in (None, old_key):
+        if len(sessions) < SESSION_BATCH_SIZE:
+            sessions += Session.query(
+                Session.conferenceKey == current, ancestor=old_key).fetch(
+                    SESSION_BATCH_SIZE - len(sessions))
+    for session in sessions:
+        session.conferenceKey = new_key
+    if len(sessions) == SESSION_BATCH_SIZE:
+        ndb.put_multi(sessions)
+        return False
+    # the sessions and the conference share an entity group, so no
+    # session can be missed between the last batch and this
+    conf.movingTo = new_key
+    ndb.put_multi(sessions + [conf])
+    entities.invalidate(old_key)
+    return True
+
+
+def _moveSessions(old_key, new_key):
+    """Move one batch of sessions; return how many there were."""
+    sessions = Session.query(ancestor=old_key).fetch(SESSION_BATCH_SIZE)
+    if not sessions:
+        return 0
+    moved = ndb.get_multi([ndb.Key(KeyMigration, s.key.urlsafe())
+                           for s in sessions])
+    pending = [s for s, m in zip(sessions, moved) if m is None]
+    if pending:
+        first, last = Session.allocate_ids(size=len(pending))
+        records = [KeyMigration(id=s.key.urlsafe(),
+                                newKey=ndb.Key(Session, session_id))
+                   for s, session_id in zip(pending, range(first, last + 1))]
+        ndb.put_multi(records)
+        moved = ndb.get_multi([ndb.Key(KeyMigration, s.key.urlsafe())
+                               for s in sessions])
+    ndb.put_multi([_copyEntity(s, m.newKey, conferenceKey=new_key)
+                   for s, m in zip(sessions, moved)])
+    sync.recordDeletions([s.key for s in sessions])
+    ndb.delete_multi([s.key for s in sessions])
+    return len(sessions)
+
+
+def _repointSessions(old_key, new_key):
+    """Point one batch of flat sessions created while this conference
+    was still legacy at the new key; return how many there were.
+    """
+    keys = [key for key in Session.query(
+        Session.conferenceKey == old_key).fetch(
+            SESSION_BATCH_SIZE, keys_only=True)
+        if key.parent() is None]
+    sessions = [s for s in ndb.get_multi(keys)
+                if s and s.conferenceKey == old_key]
+    for session in sessions:
+        session.conferenceKey = new_key
+    ndb.put_multi(sessions)
+    return len(sessions)
+
+
+@ndb.transactional(xg=True)
+def _moveConference(old_key, new_key):
+    conf = old_key.get()
+    if conf is None:
+        # moved by an earlier run
+        return new_key.get()
+    if Session.query(ancestor=old_key).get(keys_only=True):
+        return None
+    new_conf = _copyEntity(conf, new_key, flatLayout=True,
+                           movedFrom=old_key.urlsafe(), movingTo=None)
+    new_conf.put()
+    sync.recordDeletions([old_key])
+    old_key.delete()
+    return new_conf
+
+
+def _moveAttendance(old_key, new_key):
+    """Move one batch of attendance records; return how many there were."""
+    keys = Attendance.query(ancestor=old_key).fetch(
+        ATTENDANCE_BATCH_SIZE, keys_only=True)
+    for key in keys:
+        _moveRecord(key, ndb.Key(Attendance, key.id(), parent=new_key))
+    return len(keys)
+
+
+@ndb.transactional(xg=True)
+def _moveRecord(old_key, new_key):
+    # unregistering deletes the record under both keys in a transaction
+    # (attendance.recordKeys()), so it either finds this one moved or
+    # keeps it from being copied back
+    record = old_key.get()
+    if record is None:
+        return
+    if new_key.get() is None:
+        _copyEntity(record, new_key).put()
+    old_key.delete()
+
+
+def _moveSchedule(old_key, new_conf):
+    old = schedule.scheduleKey(old_key).get()
+    if old is None:
+        # built on first read otherwise; a no-op if already there
+        schedule.getSchedule(new_conf)
+        return
+    entries = [entry for day in old.days or [] for entry in day['sessions']]
+    moved = ndb.get_multi([ndb.Key(KeyMigration, entry['sess_websafekey'])
+                           for entry in entries])
+    for entry, record in zip(entries, moved):
+        entry['conf_websafekey'] = new_conf.key.urlsafe()
+        if record:
+            entry['sess_websafekey'] = record.newKey.urlsafe()
+    doc = _copyEntity(old, schedule.scheduleKey(new_conf.key))
+    doc.put()
+    old.key.delete()
+    entities.invalidate(old.key, doc.key)
+
+
+def rewriteProfiles(profiles):
+    """Map moved conference and session keys kept in profiles."""
+    wskeys = set()
+    for prof in profiles:
+        wskeys.update(prof.conferenceKeysToAttend)
+        wskeys.update(prof.session_wish_list)
+    wskeys = list(wskeys)
+    records = ndb.get_multi([ndb.Key(KeyMigration, wsk) for wsk in wskeys])
+    mapping = dict((wsk, record.newKey.urlsafe())
+                   for wsk, record in zip(wskeys, records) if record)
+    if not mapping:
+        return
+    for prof in profiles:
+        if any(wsk in mapping for wsk in
+               prof.conferenceKeysToAttend + prof.session_wish_list):
+            _rewriteProfile(prof.key, mapping)
+
+
+@ndb.transactional()
+def _rewriteProfile(p_key, mapping):
+    prof = p_key.get()
+    prof.conferenceKeysToAttend = [mapping.get(wsk, wsk)
+                                   for wsk in prof.conferenceKeysToAttend]
+    prof.session_wish_list = [mapping.get(wsk, wsk)
+                              for wsk in prof.session_wish_list]
+    prof.put()
+    entities.invalidate(p_key)
@@ -25,6 +25,24 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class ThrottledException(endpoints.ServiceException):
+
+    """ThrottledException -- exception mapped to HTTP 503 response
+
+    Endpoints v1 turns statuses it doesn't know, 429 among them, into
+    404, so the wait goes into the message as 'Retry-After: N'.
+    """
+
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
+class UnavailableException(endpoints.ServiceException):
+
+    """UnavailableException -- exception mapped to HTTP 503 response"""
+
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
 class Profile(ndb.Model):
 
     """Profile -- User profile object"""
@@ -34,6 +52,19 @@ class Profile(ndb.Model):
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     session_wish_list = ndb.StringProperty(repeated=True)
+    # addresses the wishlist's calendar feed (ical.py); set on first use
+    calendarToken = ndb.StringProperty()
+
+
+class Attendance(ndb.Model):
+
+    """Attendance -- a user's registration for a Conference.
+
+    Child of the Conference, keyed by the attendee's user ID.
+    """
+
+    userId = ndb.StringProperty()
+    registered = ndb.DateTimeProperty(auto_now_add=True)
 
 
 class ProfileMiniForm(messages.Message):
@@ -62,6 +93,23 @@ class ProfileForms(messages.Message):
     profiles = messages.MessageField(ProfileForm, 1, repeated=True)
 
 
+class AttendeeForm(messages.Message):
+
+    """AttendeeForm -- Conference attendee outbound form message"""
+
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+    teeShirtSize = messages.EnumField('TeeShirtSize', 3)
+
+
+class AttendeeForms(messages.Message):
+
+    """AttendeeForms -- one page of Conference attendees"""
+
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class StringMessage(messages.Message):
 
     """StringMessage-- outbound (single) string message"""
@@ -89,6 +137,16 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # root entity with root Sessions (see layout.py)
+    flatLayout      = ndb.BooleanProperty(default=False)
+    # websafe key before the move to the flat layout, which profiles
+    # keep until the migration rewrites them (see migrations.py)
+    movedFrom       = ndb.StringProperty()
+    # set on a legacy conference while it moves: its new key, which
+    # all of its sessions point at meanwhile (see migrations.py)
+    movingTo        = ndb.KeyProperty(kind='Conference')
+    # stamped on every put, for the changes feed (sync.py)
+    updated         = ndb.DateTimeProperty(auto_now=True)
 
 
 class ConferenceForm(messages.Message):
@@ -111,9 +169,15 @@ class ConferenceForm(messages.Message):
 
 class ConferenceForms(messages.Message):
 
-    """ConferenceForms -- multiple Conference outbound form message"""
+    """ConferenceForms -- multiple Conference outbound form message
+
+    partial: the query was stopped before its end; resend it with
+    nextPageToken for the rest.
+    """
 
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    partial = messages.BooleanField(3)
 
 
 class TeeShirtSize(messages.Enum):
@@ -161,9 +225,24 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
 
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageToken = messages.StringField(2)
 
 
 # -- Final Project Models -- #
+def dayBucket(value):
+    """Return a date/datetime as a sortable YYYYMMDD integer."""
+    if value is None:
+        return None
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def minuteOfDay(value):
+    """Return the minutes since midnight of a time/datetime."""
+    if value is None:
+        return None
+    return value.hour * 60 + value.minute
+
+
 class Session(ndb.Model):
 
     """ Session -- Sessions object for a Conference. """
@@ -176,6 +255,32 @@ class Session(ndb.Model):
     type_of_session = ndb.StringProperty(default='NOT_SPECIFIED')
     date = ndb.DateTimeProperty(required=True)
     start_time = ndb.DateTimeProperty(required=True)
+    # owning Conference, also when the session isn't its child
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    # stamped on every put, for the changes feed (sync.py)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # Compact time slot, recomputed on every put(), so that time of day
+    # ranges can be queried across days with a single index
+    day = ndb.ComputedProperty(lambda self: dayBucket(self.date))
+    start_minute = ndb.ComputedProperty(
+        lambda self: minuteOfDay(self.start_time))
+    end_minute = ndb.ComputedProperty(
+        lambda self: None if self.start_time is None else
+        minuteOfDay(self.start_time) + (self.duration or 0))
+
+
+class ConferenceSchedule(ndb.Model):
+
+    """ConferenceSchedule -- precomputed agenda of a Conference.
+
+    Child of its Conference. days is a list of {"date": ..., "sessions":
+    [...]} sorted by date, each day's sessions sorted by start time and
+    holding the SessionForm fields (plus speaker_key) of every session.
+    """
+
+    days = ndb.JsonProperty(compressed=True)
+    # version of the agenda's calendar feed (ical.py)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 
 class SessionForm(messages.Message):
@@ -215,9 +320,15 @@ class SessionInputForm(messages.Message):
 
 class SessionForms(messages.Message):
 
-    """For returning mulitple SessionForm objects"""
+    """For returning mulitple SessionForm objects
+
+    partial: the query was stopped before its end; resend it with
+    nextPageToken for the rest.
+    """
 
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    partial = messages.BooleanField(3)
 
 
 class SessionQueryForm(messages.Message):
@@ -235,6 +346,7 @@ class SessionQueryForms(messages.Message):
 
     websafeConferenceKey = messages.StringField(1)
     filters = messages.MessageField(SessionQueryForm, 2, repeated=True)
+    pageToken = messages.StringField(3)
 
 
 class Speaker(ndb.Model):
@@ -246,3 +358,107 @@ class Speaker(ndb.Model):
     speciality = ndb.StringProperty()
     # If the user exists, add the key
     user_profile_key = ndb.StringProperty()
+    # stamped on every put, for the changes feed (sync.py)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class DashboardForm(messages.Message):
+
+    """DashboardForm -- what the web client shows on load, in one call"""
+
+    profile = messages.MessageField('ProfileForm', 1)
+    conferencesToAttend = messages.MessageField('ConferenceForm', 2,
+                                                repeated=True)
+    announcement = messages.StringField(3)
+    featuredSpeaker = messages.StringField(4)
+    conferences = messages.MessageField('ConferenceForm', 5, repeated=True)
+    moreConferences = messages.BooleanField(6)
+
+
+class SpeakerForm(messages.Message):
+
+    """SpeakerForm -- Speaker outbound form message"""
+
+    name = messages.StringField(1)
+    email = messages.StringField(2)
+    speciality = messages.StringField(3)
+    websafeKey = messages.StringField(4)
+
+
+class Tombstone(ndb.Model):
+
+    """Tombstone -- a deleted Conference, Session or Speaker, kept for
+    the changes feed. Keyed by the deleted entity's websafe key.
+    """
+
+    kindName = ndb.StringProperty()
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class DeletedForm(messages.Message):
+
+    """DeletedForm -- an entity removed since the last sync"""
+
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+
+
+class ChangesForm(messages.Message):
+
+    """ChangesForm -- one page of the changes feed.
+
+    Pass nextPageToken back while it is set; once it isn't, keep
+    syncToken and pass it as since on the next sync. fullSync means the
+    pages hold everything, and local data should be replaced.
+    """
+
+    conferences = messages.MessageField('ConferenceForm', 1, repeated=True)
+    sessions = messages.MessageField('SessionForm', 2, repeated=True)
+    speakers = messages.MessageField(SpeakerForm, 3, repeated=True)
+    deleted = messages.MessageField(DeletedForm, 4, repeated=True)
+    nextPageToken = messages.StringField(5)
+    syncToken = messages.StringField(6)
+    fullSync = messages.BooleanField(7)
+
+
+class KeyMigration(ndb.Model):
+
+    """KeyMigration -- records where an entity moved when its key changed.
+
+    Keyed by the old websafe key.
+    """
+
+    newKey = ndb.KeyProperty()
+
+
+class DeletionJob(ndb.Model):
+
+    """DeletionJob -- progress of a conference or session deletion.
+
+    The Conference or Session itself is gone once the job exists; the
+    /tasks/cascade_delete chain (deletion.py) removes what refers to it.
+    """
+
+    target = ndb.KeyProperty()
+    # the target's conference (the target itself for a conference)
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    requestedBy = ndb.StringProperty()
+    phase = ndb.StringProperty()
+    sessionsDeleted = ndb.IntegerProperty(default=0)
+    profilesUpdated = ndb.IntegerProperty(default=0)
+    done = ndb.BooleanProperty(default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class DeletionForm(messages.Message):
+
+    """DeletionForm -- progress of a deletion"""
+
+    websafeKey = messages.StringField(1)
+    kind = messages.StringField(2)
+    websafeTargetKey = messages.StringField(3)
+    phase = messages.StringField(4)
+    sessionsDeleted = messages.IntegerField(5)
+    profilesUpdated = messages.IntegerField(6)
+    done = messages.BooleanField(7)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""outbox.py
+
+Outbound email pipeline.
+
+Writers call enqueue(), which adds one small task to the "outbox" pull
+queue (transactionally when asked, so a rolled back registration sends
+nothing). The /crons/drain_outbox job leases messages in batches,
+renders them with templates compiled once at import time, and hands
+them to a mail transport within a per-minute send budget. Failed
+messages go back on the queue with exponential backoff and are dropped
+after MAX_ATTEMPTS.
+
+The dev server uses LocalMailTransport, which only logs and remembers
+what would have been sent; see MAIL_TRANSPORT in settings.py.
+
+"""
+
+import collections
+import json
+import logging
+import os
+import string
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+import storage
+from settings import MAIL_TRANSPORT
+
+OUTBOX_QUEUE = 'outbox'
+# messages leased per batch, and how long a lease lasts (seconds)
+LEASE_BATCH = 50
+LEASE_SECONDS = 60
+# messages sent per minute across all instances
+SEND_RATE_PER_MINUTE = 100
+MEMCACHE_BUDGET_KEY = 'OUTBOX_SENT:%d'
+# retry backoff (seconds) doubles per attempt up to MAX_BACKOFF
+BASE_BACKOFF = 30
+MAX_BACKOFF = 3600
+MAX_ATTEMPTS = 8
+# stop draining after this many seconds so the cron request can finish
+DRAIN_DEADLINE = 30
+
+TEMPLATES = {
+    'conference_created': (
+        'You created a new Conference!',
+        'Hi, you have created the following conference:\r\n\r\n'
+        '$name\r\n$city, $startDate - $endDate\r\n'
+        'Topics: $topics\r\nMax attendees: $maxAttendees\r\n'),
+    'conference_created_legacy': (
+        'You created a new Conference!',
+        'Hi, you have created a following conference:\r\n\r\n'
+        '$conferenceInfo'),
+    'registration': (
+        'You are registered for $name',
+        'Hi $displayName, you are registered for the following '
+        'conference:\r\n\r\n$name\r\n$city, $startDate - $endDate\r\n'),
+}
+
+# compile each template once, not per message
+_COMPILED = dict(
+    (name, (string.Template(subject), string.Template(body)))
+    for name, (subject, body) in TEMPLATES.items())
+
+
+class AppEngineMailTransport(object):
+
+    """AppEngineMailTransport -- delivers through the App Engine Mail API"""
+
+    def send(self, sender, to, subject, body):
+        mail.send_mail(sender, to, subject, body)
+
+
+class LocalMailTransport(object):
+
+    """LocalMailTransport -- stand-in that logs and keeps recent messages"""
+
+    def __init__(self, keep=100):
+        self.sent = collections.deque(maxlen=keep)
+
+    def send(self, sender, to, subject, body):
+        logging.info('outbox (local): to=%s subject=%r', to, subject)
+        self.sent.append((sender, to, subject, body))
+
+
+def _defaultTransport():
+    name = MAIL_TRANSPORT
+    if name == 'auto':
+        dev = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+        name = 'local' if dev else 'appengine'
+    if name == 'local':
+        return LocalMailTransport()
+    return AppEngineMailTransport()
+
+
+transport = _defaultTransport()
+
+
+def enqueue(template, to, transactional=False, **params):
+    """Queue one email rendered from TEMPLATES[template] with params."""
+    if template not in _COMPILED:
+        raise ValueError('Unknown email template: %s' % template)
+    payload = json.dumps({'template': template, 'to': to, 'params': params})
+    task = taskqueue.Task(payload=payload, method='PULL')
+    if transactional:
+        storage.repo.addTask(task, OUTBOX_QUEUE)
+    else:
+        taskqueue.Queue(OUTBOX_QUEUE).add(task)
+
+
+def render(template, params):
+    """Return (subject, body) for a queued message."""
+    subject, body = _COMPILED[template]
+    return subject.safe_substitute(params), body.safe_substitute(params)
+
+
+def _reserveBudget(wanted, unmetered):
+    """Reserve up to wanted sends from this minute's budget.
+
+    Return (budget key, sends granted). If memcache is unavailable the
+    key is None, and wanted is granted only if unmetered is true.
+    """
+    key = MEMCACHE_BUDGET_KEY % int(time.time() // 60)
+    used = memcache.incr(key, wanted, initial_value=0)
+    if used is None:
+        return None, wanted if unmetered else 0
+    granted = max(0, min(wanted, SEND_RATE_PER_MINUTE - (used - wanted)))
+    if granted < wanted:
+        memcache.decr(key, wanted - granted)
+    return key, granted
+
+
+def _backoff(attempt):
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** max(attempt - 1, 0))
+
+
+def drainBatch(unmetered=False):
+    """Lease, render and send one batch; return number of messages leased.
+
+    unmetered lets the batch go out when memcache is down and the send
+    budget can't be checked.
+    """
+    key, budget = _reserveBudget(LEASE_BATCH, unmetered)
+    if not budget:
+        return 0
+    queue = taskqueue.Queue(OUTBOX_QUEUE)
+    tasks = queue.lease_tasks(LEASE_SECONDS, budget)
+    if key and len(tasks) < budget:
+        # refund the minute the sends were reserved from
+        memcache.decr(key, budget - len(tasks))
+    sender = 'noreply@%s.appspotmail.com' % (
+        app_identity.get_application_id())
+    done = []
+    for task in tasks:
+        try:
+            message = json.loads(task.payload)
+            subject, body = render(message['template'], message['params'])
+            transport.send(sender, message['to'], subject, body)
+            done.append(task)
+        except Exception:
+            # retry_count counts the leases so far, this one included
+            if task.retry_count >= MAX_ATTEMPTS:
+                logging.exception('outbox: dropping %s after %d attempts',
+                                  task.name, task.retry_count)
+                done.append(task)
+            else:
+                logging.warning('outbox: send of %s failed, retrying',
+                                task.name, exc_info=True)
+                queue.modify_task_lease(task, _backoff(task.retry_count))
+    if done:
+        queue.delete_tasks(done)
+    return len(tasks)
+
+
+def drain(deadline=DRAIN_DEADLINE):
+    """Send batches until the queue is empty, the budget is used up or
+    deadline seconds have passed; return number of messages leased.
+    """
+    start = time.time()
+    total = 0
+    while time.time() - start < deadline:
+        # without memcache, send a single batch per drain at most
+        leased = drainBatch(unmetered=not total)
+        total += leased
+        if leased < LEASE_BATCH:
+            break
+    return total
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""profiling.py
+
+Opt-in CPU profiles of single requests, for the API (conference.api)
+and the handlers in main.py.
+
+wrap() puts a WSGI app behind a hook that runs a request under cProfile
+when either
+
+- it carries the PROFILE_HEADER header and comes from an admin of the
+  app (or anyone on the dev server), or
+- it is picked at random, at settings.PROFILE_SAMPLE_RATE.
+
+Everything else goes straight to the app; with the rate at 0 the cost
+is one dict lookup and a random() call per request.
+
+A profile is cut down to the PROFILE_TOP_FUNCTIONS functions with the
+most cumulative time, with their callers, and kept in memcache in a
+ring of PROFILE_KEEP slots shared by all instances. /admin/profiles
+(main.py) lists them, newest first.
+
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import StringIO
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+from settings import PROFILE_SAMPLE_RATE
+
+PROFILE_HEADER = 'HTTP_X_CONFERENCE_PROFILE'
+PROFILE_KEEP = 50
+PROFILE_TOP_FUNCTIONS = 30
+MEMCACHE_PROFILE_KEY = 'PROFILE:%d'
+MEMCACHE_PROFILE_COUNTER = 'PROFILE_COUNTER'
+# a ring slot left alone this long is dropped
+PROFILE_TTL = 24 * 3600
+
+
+def _requested(environ):
+    if PROFILE_HEADER not in environ:
+        return False
+    if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+        return True
+    try:
+        return users.is_current_user_admin()
+    except Exception:
+        return False
+
+
+def _summary(profiler):
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats('cumulative')
+    stats.print_stats(PROFILE_TOP_FUNCTIONS)
+    stats.print_callers(PROFILE_TOP_FUNCTIONS)
+    return out.getvalue()
+
+
+def _save(environ, reason, elapsed, profiler):
+    record = {
+        'path': environ.get('PATH_INFO'),
+        'method': environ.get('REQUEST_METHOD'),
+        'reason': reason,
+        'time': time.time(),
+        'ms': int(elapsed * 1000),
+        'instance': os.environ.get('INSTANCE_ID'),
+        'stats': _summary(profiler),
+    }
+    slot = memcache.incr(MEMCACHE_PROFILE_COUNTER, initial_value=0)
+    if slot is None:
+        logging.warning('profile of %s not kept', record['path'])
+        return
+    memcache.set(MEMCACHE_PROFILE_KEY % (slot % PROFILE_KEEP), record,
+                 time=PROFILE_TTL)
+
+
+def recentProfiles():
+    """Return the kept profiles, newest first."""
+    records = memcache.get_multi(
+        [MEMCACHE_PROFILE_KEY % slot for slot in range(PROFILE_KEEP)])
+    return sorted(records.values(), key=lambda record: record['time'],
+                  reverse=True)
+
+
+def wrap(app):
+    """Wrap a WSGI app so requests can be profiled."""
+    def profiled(environ, start_response):
+        if _requested(environ):
+            reason = 'header'
+        elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            reason = 'sample'
+        else:
+            return app(environ, start_response)
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(app, environ, start_response)
+        finally:
+            try:
+                _save(environ, reason, time.time() - start, profiler)
+            except Exception:
+                # never fail the request over its profile
+                logging.exception('could not save profile')
+    return profiled
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""resilience.py
+
+Retries, backoff and circuit breaking for datastore and memcache calls.
+
+call() runs an operation and retries it when it fails with one of its
+backend's transient errors (timeouts, internal errors), up to
+RETRY_ATTEMPTS tries in all. The operation must be safe to repeat: a
+read, or a transaction that copes with finding its own changes, since
+a commit can time out after it was applied (see registration in
+conference.py). Before retry n+1 it sleeps a random time between 0 and
+RETRY_BASE_DELAY * 2**n seconds, capped at RETRY_MAX_DELAY, so callers
+that failed together don't all come back together.
+
+Each backend has a circuit breaker per instance. After BREAKER_FAILURES
+failures in a row it opens: calls fail at once with Unavailable (or are
+answered by their fallback, see read()) instead of adding load to a
+backend that is struggling. Once every BREAKER_RESET_SECONDS one call is
+let through as a trial, and its success closes the breaker again.
+
+Unavailable is also raised once the retries run out. The API answers it
+with HTTP 503; task handlers let it fail the task, which the queue
+retries later.
+
+Contention (TransactionFailedError) is not retried here: ndb has already
+retried the transaction by the time it is raised, and retrying the lot
+again only adds to the contention. Nor does it count against the
+breaker, since a busy entity group says nothing about the datastore as
+a whole. call() raises it as Contention, a kind of Unavailable.
+
+Memcache doesn't raise when it is down, it misses. Writers report
+whether memcache took a value with record(), and readers ask
+available() before going to it; see cache.memcacheValue().
+
+Calls, retries, failures, fallbacks and calls refused by an open
+breaker are counted per instance, and reported with each breaker's
+state at /admin/resilience_stats.
+
+"""
+
+import collections
+import functools
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.runtime import apiproxy_errors
+
+from settings import BREAKER_FAILURES
+from settings import BREAKER_RESET_SECONDS
+from settings import RETRY_ATTEMPTS
+from settings import RETRY_BASE_DELAY
+from settings import RETRY_MAX_DELAY
+
+TRANSIENT_ERRORS = {
+    'datastore': (datastore_errors.Timeout,
+                  datastore_errors.InternalError,
+                  apiproxy_errors.DeadlineExceededError),
+    'memcache': (apiproxy_errors.DeadlineExceededError,),
+}
+
+# errors that mean others were writing the same entities
+CONTENTION_ERRORS = {
+    'datastore': (datastore_errors.TransactionFailedError,),
+    'memcache': (),
+}
+
+_lock = threading.Lock()
+_counts = collections.defaultdict(collections.Counter)
+
+
+class Unavailable(Exception):
+
+    """Unavailable -- a backend kept failing, or its breaker is open"""
+
+
+class Contention(Unavailable):
+
+    """Contention -- a transaction failed after ndb's own retries"""
+
+
+def _count(backend, outcome):
+    with _lock:
+        _counts[backend][outcome] += 1
+
+
+class CircuitBreaker(object):
+
+    """CircuitBreaker -- stops calls to a backend after repeated failures"""
+
+    def __init__(self, name, failures=BREAKER_FAILURES,
+                 reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self._failures = failures
+        self._reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.failed = 0
+        # when the breaker opened or last let a trial through; None
+        # while closed
+        self.opened = None
+
+    def allow(self):
+        """Return whether a call may go to the backend now."""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened < self._reset_seconds:
+                return False
+            # half open: one trial call per reset period
+            self.opened = time.time()
+            return True
+
+    def success(self):
+        with self._lock:
+            closed = self.opened is not None
+            self.failed = 0
+            self.opened = None
+        if closed:
+            logging.info('circuit breaker for %s closed', self.name)
+
+    def failure(self):
+        with self._lock:
+            self.failed += 1
+            opened = self.opened is None and self.failed >= self._failures
+            if opened or self.opened is not None:
+                self.opened = time.time()
+        if opened:
+            _count(self.name, 'opened')
+            logging.warning('circuit breaker for %s opened after %d failures',
+                            self.name, self._failures)
+
+    def state(self):
+        with self._lock:
+            return {'open': self.opened is not None, 'failed': self.failed}
+
+
+breakers = dict((backend, CircuitBreaker(backend))
+                for backend in TRANSIENT_ERRORS)
+
+
+def backoff(attempt):
+    """Return the seconds to sleep before retry attempt + 1."""
+    return random.uniform(
+        0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def call(backend, func, *args, **kwargs):
+    """Return func(*args, **kwargs), retried on backend's transient
+    errors; raise Unavailable once they run out or while the backend's
+    breaker is open.
+    """
+    breaker = breakers[backend]
+    _count(backend, 'calls')
+    for attempt in range(RETRY_ATTEMPTS):
+        if not breaker.allow():
+            _count(backend, 'rejected')
+            raise Unavailable('%s is unavailable' % backend)
+        if attempt:
+            _count(backend, 'retries')
+        try:
+            result = func(*args, **kwargs)
+        except TRANSIENT_ERRORS[backend] as e:
+            breaker.failure()
+            _count(backend, 'failures')
+            logging.warning('%s: %s failed (try %d of %d): %r', backend,
+                            getattr(func, '__name__', func), attempt + 1,
+                            RETRY_ATTEMPTS, e)
+            if attempt + 1 == RETRY_ATTEMPTS:
+                raise Unavailable('%s is unavailable: %r' % (backend, e))
+            time.sleep(backoff(attempt))
+        except CONTENTION_ERRORS[backend] as e:
+            # the backend answered; the entities are busy, not it
+            breaker.success()
+            _count(backend, 'contention')
+            logging.warning('%s: %s failed: %r', backend,
+                            getattr(func, '__name__', func), e)
+            raise Contention('%s is busy: %r' % (backend, e))
+        except Exception:
+            # any other error is an answer from the backend
+            breaker.success()
+            raise
+        else:
+            breaker.success()
+            return result
+
+
+def retried(backend):
+    """Decorator running a function through call()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call(backend, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read(backend, func, fallback):
+    """Return func() through call(), or fallback() if backend is
+    unavailable."""
+    try:
+        return call(backend, func)
+    except Unavailable:
+        _count(backend, 'fallbacks')
+        return fallback()
+
+
+def available(backend):
+    """Return whether backend's breaker lets a call through."""
+    if breakers[backend].allow():
+        return True
+    _count(backend, 'rejected')
+    return False
+
+
+def record(backend, ok):
+    """Report a call made without call(), e.g. a memcache write."""
+    if ok:
+        breakers[backend].success()
+    else:
+        breakers[backend].failure()
+        _count(backend, 'failures')
+
+
+def countFallback(backend):
+    """Count a value got elsewhere because backend didn't have it."""
+    _count(backend, 'fallbacks')
+
+
+def stats():
+    """Return this instance's counts and breaker states per backend."""
+    with _lock:
+        counts = dict((backend, dict(c)) for backend, c in _counts.items())
+    return dict((backend, {'counts': counts.get(backend, {}),
+                           'breaker': breaker.state()})
+                for backend, breaker in breakers.items())
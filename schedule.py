@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""schedule.py
+
+Materialized per-conference agenda.
+
+Each Conference has one ConferenceSchedule child holding every session
+with its speaker fields, grouped by day and sorted by start time. The
+session listing endpoints slice it in memory instead of running an
+ancestor query and re-reading every speaker on each call.
+
+The document is kept current incrementally: createSession inserts the
+new entry and removeSessions() drops entries. Speakers are never
+updated once created, so their fields don't need patching. A missing
+document (conferences older than this module, or a lost write) is
+rebuilt from the sessions on first read. Reads go through the two-tier
+entity cache, and everything through the storage repository.
+
+"""
+
+import bisect
+
+from google.appengine.ext import ndb
+
+import storage
+from cache import entities
+from layout import sessionsQuery
+from mappers import copySessionToForm
+from models import ConferenceSchedule
+from models import SessionForm
+from models import TypeOfSession
+
+SCHEDULE_ID = 1
+
+
+def scheduleKey(conf_key):
+    """Return the key of a conference's schedule document."""
+    return ndb.Key(ConferenceSchedule, SCHEDULE_ID, parent=conf_key)
+
+
+def _entry(session, conf, speaker):
+    """Return the schedule entry (SessionForm fields) for a session."""
+    form = copySessionToForm(session, conf=conf, speaker=speaker)
+    entry = {}
+    for field in SessionForm.all_fields():
+        value = getattr(form, field.name)
+        if value is not None:
+            entry[field.name] = value
+    if form.type_of_session is not None:
+        entry['type_of_session'] = form.type_of_session.name
+    entry['speaker_key'] = session.speaker_key
+    return entry
+
+
+def _sortKey(entry):
+    # the key breaks ties, so the order is total (see upcoming.py)
+    return (entry.get('start_time'), entry.get('name') or '',
+            entry['sess_websafekey'])
+
+
+def _insert(days, entry):
+    """Insert entry into its day, keeping days and sessions sorted."""
+    dates = [day['date'] for day in days]
+    i = bisect.bisect_left(dates, entry['date'])
+    if i == len(days) or days[i]['date'] != entry['date']:
+        days.insert(i, {'date': entry['date'], 'sessions': []})
+    sessions = days[i]['sessions']
+    keys = [_sortKey(other) for other in sessions]
+    sessions.insert(bisect.bisect_right(keys, _sortKey(entry)), entry)
+
+
+def build(conf, include=None):
+    """Build a conference's schedule from its sessions and store it,
+    unless another request stored one first.
+
+    include is a session just written, which a flat layout (non-ancestor)
+    query might not return yet. Sessions and speakers are read outside
+    the transaction, which only touches the schedule document: a
+    document that appeared in the meantime is kept, since
+    createSession and removeSessions maintain it from then on, and only
+    gets include added. So every createSession that found no document
+    ends up in whichever one is stored.
+    """
+    sessions = sessionsQuery(conf).fetch()
+    if include and include.key not in [session.key for session in sessions]:
+        sessions.append(include)
+    speakers = entities.get_multi(
+        [ndb.Key(urlsafe=session.speaker_key) for session in sessions])
+    days = []
+    added = None
+    for session, speaker in zip(sessions, speakers):
+        entry = _entry(session, conf, speaker)
+        _insert(days, entry)
+        if include and session.key == include.key:
+            added = entry
+    return _storeBuilt(conf.key, days, added)
+
+
+@storage.transactional()
+def _storeBuilt(conf_key, days, added):
+    schedule = storage.repo.get(scheduleKey(conf_key))
+    if schedule is None:
+        schedule = ConferenceSchedule(key=scheduleKey(conf_key), days=days)
+    elif added is None or added['sess_websafekey'] in [
+            entry['sess_websafekey']
+            for day in schedule.days or [] for entry in day['sessions']]:
+        return schedule
+    else:
+        days = schedule.days or []
+        _insert(days, added)
+        schedule.days = days
+    storage.putLater(schedule)
+    entities.invalidate(schedule.key)
+    return schedule
+
+
+def getSchedule(conf):
+    """Return the schedule document of a conference."""
+    schedule = entities.get(scheduleKey(conf.key))
+    if schedule is None:
+        schedule = build(conf)
+    return schedule
+
+
+def sessionForms(conf, date=None, type_of_session=None):
+    """Return SessionForm per scheduled session, optionally only those on
+    date (YYYY-MM-DD) and/or of type_of_session (a TypeOfSession name).
+    """
+    forms = []
+    for day in getSchedule(conf).days or []:
+        if date and day['date'] != date:
+            continue
+        for entry in day['sessions']:
+            if type_of_session and \
+                    entry.get('type_of_session') != type_of_session:
+                continue
+            forms.append(entryForm(entry))
+    return forms
+
+
+def entryForm(entry):
+    """Return the SessionForm of a schedule entry."""
+    fields = dict(entry)
+    del fields['speaker_key']
+    if 'type_of_session' in fields:
+        fields['type_of_session'] = TypeOfSession(fields['type_of_session'])
+    return SessionForm(**fields)
+
+
+def addSession(conf, session, speaker):
+    """Insert a newly created session into its conference's schedule."""
+    schedule = _insertSession(conf, session, speaker)
+    if schedule is None:
+        # sessions queries may not be ancestor queries, so build outside
+        # of the transaction
+        schedule = build(conf, include=session)
+    return schedule
+
+
+@storage.transactional()
+def _insertSession(conf, session, speaker):
+    schedule = storage.repo.get(scheduleKey(conf.key))
+    if schedule is None:
+        return None
+    days = schedule.days or []
+    _insert(days, _entry(session, conf, speaker))
+    schedule.days = days
+    storage.putLater(schedule)
+    entities.invalidate(schedule.key)
+    return schedule
+
+
+@storage.transactional()
+def removeSessions(conf_key, session_keys):
+    """Drop sessions (by websafe key) from a conference's schedule."""
+    schedule = storage.repo.get(scheduleKey(conf_key))
+    if schedule is None:
+        return
+    session_keys = set(session_keys)
+    days = []
+    for day in schedule.days or []:
+        day['sessions'] = [entry for entry in day['sessions']
+                           if entry['sess_websafekey'] not in session_keys]
+        if day['sessions']:
+            days.append(day)
+    schedule.days = days
+    storage.putLater(schedule)
+    entities.invalidate(schedule.key)
+
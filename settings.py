@@ -16,3 +16,46 @@ WEB_CLIENT_ID = '830852601-23j11dvs686j8q13ott102n9ql72cllj.apps.googleuserconte
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# How outbound email is delivered: 'appengine' (Mail API), 'local' (log
+# only, see outbox.LocalMailTransport) or 'auto' (local on the dev server)
+MAIL_TRANSPORT = 'auto'
+
+# Create new Conferences and Sessions as root entities instead of children
+# of the organizer's Profile / the Conference (see layout.py). Run the
+# /tasks/flatten_entity_groups migration once this is switched on.
+FLAT_ENTITY_GROUPS = False
+
+# Admission control (throttle.py): each caller gets a bucket of
+# THROTTLE_CAPACITY tokens per endpoint below, refilled at
+# THROTTLE_REFILL_PER_SECOND. A call costs THROTTLE_COSTS[endpoint] tokens
+# (querySessions: per inequality filter); other endpoints are not limited.
+THROTTLE_CAPACITY = 30
+THROTTLE_REFILL_PER_SECOND = 0.5
+THROTTLE_COSTS = {
+    'getSessionsBySpeaker': 3,
+    'getProfilesBySessionWishlist': 3,
+    'querySessions': 2,
+}
+
+# Where the API keeps its data (storage.py): 'ndb' (the datastore) or
+# 'memory' (process memory, for tests & benchmarks without the SDK stubs;
+# each call then sleeps MEMORY_STORAGE_LATENCY seconds)
+STORAGE_BACKEND = 'ndb'
+MEMORY_STORAGE_LATENCY = 0.0
+
+# Fraction of requests run under cProfile (profiling.py), e.g. 0.001; admins
+# can also ask for one with an X-Conference-Profile header. Read at
+# /admin/profiles.
+PROFILE_SAMPLE_RATE = 0.0
+
+# Transient datastore errors (resilience.py): an operation is tried up to
+# RETRY_ATTEMPTS times, sleeping a random time of up to RETRY_BASE_DELAY
+# * 2**n seconds (at most RETRY_MAX_DELAY) before retry n+1. After
+# BREAKER_FAILURES failures in a row a backend is left alone for
+# BREAKER_RESET_SECONDS on this instance. Counts at /admin/resilience_stats.
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 1.0
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECONDS = 30
@@ -130,3 +130,71 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+/**
+ * @ngdoc service
+ * @name dashboard
+ *
+ * @description
+ * Service that loads the conference.getDashboard API (profile, conferences to attend,
+ * announcement, featured speaker and the first conferences) once per page visited and shares
+ * it across the controllers of that page. Seats and other users' conferences are fresh on
+ * every navigation, as they were when each page made its own calls.
+ *
+ */
+app.factory('dashboard', function ($q, $rootScope, oauth2Provider) {
+    var dashboard = {};
+    var promise = null;
+    var loadedSignedIn = null;
+    // The signed-out dashboard main.py rendered into the landing page; used once, in place of
+    // the first API call.
+    var embedded = window.CONFERENCE_DASHBOARD || null;
+
+    // The next page loads the dashboard again; the embedded one only stands in for the first
+    // load.
+    $rootScope.$on('$routeChangeStart', function () {
+        if (promise) {
+            dashboard.invalidate();
+        }
+    });
+
+    /**
+     * Returns a promise of the dashboard, calling the API when it hasn't been loaded yet for
+     * the current page and sign in state.
+     *
+     * @returns {Promise}
+     */
+    dashboard.get = function () {
+        if (!promise || loadedSignedIn !== oauth2Provider.signedIn) {
+            var deferred = $q.defer();
+            loadedSignedIn = oauth2Provider.signedIn;
+            promise = deferred.promise;
+            if (embedded && !loadedSignedIn) {
+                deferred.resolve(embedded);
+                embedded = null;
+                return promise;
+            }
+            gapi.client.conference.getDashboard().execute(function (resp) {
+                $rootScope.$apply(function () {
+                    if (resp.error) {
+                        promise = null;
+                        deferred.reject(resp);
+                    } else {
+                        deferred.resolve(resp.result);
+                    }
+                });
+            });
+        }
+        return promise;
+    };
+
+    /**
+     * Drops the loaded dashboard, e.g. after the profile or the registrations changed.
+     */
+    dashboard.invalidate = function () {
+        promise = null;
+        embedded = null;
+    };
+
+    return dashboard;
+});
@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, dashboard, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -63,21 +63,18 @@ conferenceApp.controllers.controller('MyProfileCtrl',
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
-                    execute(function (resp) {
-                        $scope.$apply(function () {
-                            $scope.loading = false;
-                            if (resp.error) {
-                                // Failed to get a user profile.
-                            } else {
-                                // Succeeded to get the user profile.
-                                $scope.profile.displayName = resp.result.displayName;
-                                $scope.profile.teeShirtSize = resp.result.teeShirtSize;
-                                $scope.initialProfile = resp.result;
-                            }
-                        });
+                dashboard.get().then(function (result) {
+                    $scope.loading = false;
+                    if (result.profile) {
+                        // Succeeded to get the user profile.
+                        $scope.profile.displayName = result.profile.displayName;
+                        $scope.profile.teeShirtSize = result.profile.teeShirtSize;
+                        $scope.initialProfile = result.profile;
                     }
-                );
+                }, function () {
+                    // Failed to get a user profile.
+                    $scope.loading = false;
+                });
             };
             if (!oauth2Provider.signedIn) {
                 var modalInstance = oauth2Provider.showLoginModal();
@@ -111,6 +108,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            dashboard.invalidate();
                             $scope.messages = 'The profile has been updated';
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -135,7 +133,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
  * A controller used for the Create conferences page.
  */
 conferenceApp.controllers.controller('CreateConferenceCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, dashboard, HTTP_ERRORS) {
 
         /**
          * The conference object being edited in the page.
@@ -231,6 +229,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            dashboard.invalidate();
                             $scope.messages = 'The conference has been created : ' + resp.result.name;
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -249,7 +248,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, dashboard, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -293,6 +292,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the current announcement and featured speaker, from the dashboard.
+     * @type {string}
+     */
+    $scope.announcement = '';
+    $scope.featuredSpeaker = '';
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -424,9 +430,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Invokes the conference.queryConferences API, following the page token while the server
+     * returns partial results.
+     *
+     * @param {string=} pageToken where a partial result stopped; the results are appended.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (pageToken) {
         var sendFilters = {
             filters: []
         }
@@ -440,7 +449,30 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (pageToken) {
+            sendFilters.pageToken = pageToken;
+        }
         $scope.loading = true;
+        if (sendFilters.filters.length == 0 && !pageToken && !$scope.dashboardShown) {
+            // The first unfiltered list comes with the dashboard.
+            dashboard.get().then(function (result) {
+                $scope.dashboardShown = true;
+                $scope.announcement = result.announcement || '';
+                $scope.featuredSpeaker = result.featuredSpeaker || '';
+                $scope.conferences = result.conferences || [];
+                if (result.moreConferences) {
+                    // Only the first page came with it; fetch the rest.
+                    $scope.queryConferencesAll();
+                } else {
+                    $scope.loading = false;
+                    $scope.submitted = true;
+                }
+            }, function () {
+                $scope.dashboardShown = true;
+                $scope.queryConferencesAll();
+            });
+            return;
+        }
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
@@ -458,10 +490,18 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!pageToken) {
+                            $scope.conferences = [];
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        if (resp.result.partial && resp.result.nextPageToken) {
+                            // The server stopped early; fetch the rest.
+                            $scope.loading = true;
+                            $scope.queryConferencesAll(resp.result.nextPageToken);
+                            return;
+                        }
                     }
                     $scope.submitted = true;
                 });
@@ -511,31 +551,35 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
-            execute(function (resp) {
-                $scope.$apply(function () {
-                    if (resp.error) {
-                        // The request has failed.
-                        var errorMessage = resp.error.message || '';
-                        $scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
-                        $scope.alertStatus = 'warning';
-                        $log.error($scope.messages);
+        dashboard.get().then(function (result) {
+            if (!oauth2Provider.signedIn || !result.profile) {
+                // The dashboard answers signed-out users without their conferences.
+                $scope.loading = false;
+                $scope.messages = 'Failed to query the conferences to attend : Sign in required';
+                $scope.alertStatus = 'warning';
+                $log.error($scope.messages);
+                oauth2Provider.showLoginModal();
+                return;
+            }
+            // The request has succeeded.
+            $scope.conferences = result.conferencesToAttend || [];
+            $scope.loading = false;
+            $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
+            $scope.alertStatus = 'success';
+            $log.info($scope.messages);
+            $scope.submitted = true;
+        }, function (resp) {
+            // The request has failed.
+            var errorMessage = resp.error.message || '';
+            $scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
+            $scope.alertStatus = 'warning';
+            $log.error($scope.messages);
+            $scope.submitted = true;
 
-                        if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
-                            oauth2Provider.showLoginModal();
-                            return;
-                        }
-                    } else {
-                        // The request has succeeded.
-                        $scope.conferences = resp.result.items;
-                        $scope.loading = false;
-                        $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
-                        $scope.alertStatus = 'success';
-                        $log.info($scope.messages);
-                    }
-                    $scope.submitted = true;
-                });
-            });
+            if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+                oauth2Provider.showLoginModal();
+            }
+        });
     };
 });
 
@@ -547,7 +591,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, dashboard, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
@@ -581,23 +625,25 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
-                    }
+        dashboard.get().then(function (result) {
+            $scope.loading = false;
+            var profile = result.profile;
+            if (!profile) {
+                // Not signed in.
+                return;
+            }
+            var keys = profile.conferenceKeysToAttend || [];
+            for (var i = 0; i < keys.length; i++) {
+                if ($routeParams.websafeConferenceKey == keys[i]) {
+                    // The user is attending the conference.
+                    $scope.alertStatus = 'info';
+                    $scope.messages = 'You are attending this conference';
+                    $scope.isUserAttending = true;
                 }
-            });
+            }
+        }, function () {
+            // Failed to get a user profile.
+            $scope.loading = false;
         });
     };
 
@@ -626,6 +672,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Register succeeded.
+                        dashboard.invalidate();
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
                         $scope.isUserAttending = true;
@@ -662,6 +709,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Unregister succeeded.
+                        dashboard.invalidate();
                         $scope.messages = 'Unregistered from the conference';
                         $scope.alertStatus = 'success';
                         $scope.conference.seatsAvailable = $scope.conference.seatsAvailable + 1;
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+
+"""storage.py
+
+Repository layer between the API and the datastore.
+
+The API reads and writes Conferences, Sessions, Speakers and Profiles
+through `storage.repo` instead of calling ndb directly:
+
+    repo.get(key) / repo.get_multi(keys)
+    repo.get_multi_async(keys)      (returns ndb futures)
+    repo.put(entity) / repo.put_multi(entities) / repo.delete_multi(keys)
+    repo.put_multi_async(entities)  (returns ndb futures)
+    repo.allocateIds(model, size, parent=None)
+    repo.query(model, ancestor=None)
+        .filter(name, op, value)    op: = != < <= > >= in
+        .order(name)                '-name' for descending, '__key__'
+        .fetch(limit) / .fetch_page(size, start_cursor) / .get() / iter
+        .fetch_async(limit)         (returns an ndb future)
+    repo.cursor(page_token)
+    @transactional(xg=False), repo.callOnCommit(callback)
+    repo.addTask(task, queue_name)  (with the transaction, if any)
+
+Entities and keys are the ndb models and keys either way. Two
+repositories implement this:
+
+NdbRepository -- the datastore, through ndb (the default).
+
+MemoryRepository -- a dict in process memory, for tests and benchmarks
+that shouldn't need the SDK's service stubs. Queries are evaluated in
+Python with the datastore's rules for repeated properties, missing
+values and ordering, and are always strongly consistent. latency adds a
+fixed delay per call, and rpcs counts them, so a benchmark can put a
+cost on round trips.
+
+settings.STORAGE_BACKEND picks one at import; use() swaps it, e.g. in a
+test's setUp.
+
+Writes can be coalesced in a unit of work. While one is open (an
+endpoint decorated with @unitOfWork, or any @transactional function),
+putLater() only records entities, keeping the last version of each key,
+and afterWrite() holds callbacks such as cache invalidations. Both are
+flushed when the unit closes: the entities in a single
+repo.put_multi_async() batch, then the callbacks (on commit, for a
+transaction). flush() does it early, for code that reads back what it
+wrote. Outside a unit putLater() writes at once. A unit closed by an
+exception writes nothing.
+
+"""
+
+import collections
+import copy
+import functools
+import threading
+import time
+from datetime import date
+from datetime import datetime
+from datetime import time as time_of_day
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from settings import MEMORY_STORAGE_LATENCY
+from settings import STORAGE_BACKEND
+
+_KEY = '__key__'
+
+
+def _orderName(name):
+    """Return (property name, descending) for an order like '-name'."""
+    if name.startswith('-'):
+        return name[1:], True
+    return name, False
+
+
+# - - - ndb - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class NdbQuery(object):
+
+    """NdbQuery -- repository query running as an ndb query"""
+
+    def __init__(self, model, query):
+        self._model = model
+        self._query = query
+
+    def _property(self, name):
+        if name == _KEY:
+            return self._model.key
+        return self._model._properties.get(name) or ndb.GenericProperty(name)
+
+    def filter(self, name, op, value):
+        return NdbQuery(self._model, self._query.filter(
+            ndb.query.FilterNode(name, op, value)))
+
+    def order(self, name):
+        name, descending = _orderName(name)
+        prop = self._property(name)
+        return NdbQuery(self._model,
+                        self._query.order(-prop if descending else prop))
+
+    def fetch(self, limit=None, **options):
+        return self._query.fetch(limit, **options)
+
+    def fetch_async(self, limit=None, **options):
+        return self._query.fetch_async(limit, **options)
+
+    def fetch_page(self, page_size, start_cursor=None, **options):
+        return self._query.fetch_page(page_size, start_cursor=start_cursor,
+                                      **options)
+
+    def get(self, **options):
+        return self._query.get(**options)
+
+    def iter(self, **options):
+        return self._query.iter(**options)
+
+    def __iter__(self):
+        return iter(self._query)
+
+
+class NdbRepository(object):
+
+    """NdbRepository -- the datastore, through ndb"""
+
+    # entities are shared by every instance, so may be cached in memcache
+    shared = True
+
+    def get(self, key):
+        return key.get()
+
+    def get_multi(self, keys):
+        return ndb.get_multi(keys)
+
+    def get_multi_async(self, keys):
+        return ndb.get_multi_async(keys)
+
+    def put(self, entity):
+        return entity.put()
+
+    def put_multi(self, entities):
+        return ndb.put_multi(entities)
+
+    def put_multi_async(self, entities):
+        return ndb.put_multi_async(entities)
+
+    def delete_multi(self, keys):
+        ndb.delete_multi(keys)
+
+    def allocateIds(self, model, size=1, parent=None):
+        first, last = model.allocate_ids(size=size, parent=parent)
+        return range(first, last + 1)
+
+    def query(self, model, ancestor=None):
+        return NdbQuery(model, model.query(ancestor=ancestor))
+
+    def cursor(self, page_token):
+        """Return the cursor for a page token; ValueError if invalid."""
+        try:
+            return Cursor(urlsafe=page_token)
+        except datastore_errors.BadValueError:
+            raise ValueError('Invalid page token: %r' % page_token)
+
+    def transaction(self, func, xg=False):
+        # join a transaction already running, like @ndb.transactional
+        return ndb.transaction(
+            func, xg=xg, propagation=ndb.TransactionOptions.ALLOWED)
+
+    def callOnCommit(self, callback):
+        ndb.get_context().call_on_commit(callback)
+
+    def addTask(self, task, queue_name='default'):
+        """Add task to the queue, as part of the current transaction if
+        there is one (so it is only queued if that commits)."""
+        taskqueue.Queue(queue_name).add(
+            task, transactional=ndb.in_transaction())
+
+
+# - - - memory - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _indexValue(value):
+    """Return value as the datastore indexes it (dates and times are
+    stored as datetimes)."""
+    if isinstance(value, ndb.Key):
+        return _keyOrder(value)
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    if isinstance(value, time_of_day):
+        return datetime.combine(date(1970, 1, 1), value)
+    return value
+
+
+def _done(result):
+    """Return an ndb future already holding result."""
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+def _keyOrder(key):
+    """Return a sort key ordering keys like the datastore: by path, with
+    numeric IDs before names."""
+    return tuple((kind, (0, id_) if isinstance(id_, (int, long)) else (1, id_))
+                 for kind, id_ in key.pairs())
+
+
+def _values(entity, name):
+    """Return the indexed values of property name (none when unset)."""
+    if name == _KEY:
+        return [_keyOrder(entity.key)]
+    prop = entity._properties.get(name)
+    if prop is None:
+        return []
+    value = getattr(entity, prop._code_name)
+    if prop._repeated:
+        return [_indexValue(v) for v in value]
+    return [_indexValue(value)]
+
+
+_COMPARE = {
+    '=': lambda a, b: a == b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    '!=': lambda a, b: a is not None and a != b,
+    'in': lambda a, b: a in b,
+}
+
+
+class MemoryCursor(object):
+
+    """MemoryCursor -- position in a MemoryQuery's results"""
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def urlsafe(self):
+        return str(self.offset)
+
+
+class MemoryQuery(object):
+
+    """MemoryQuery -- repository query evaluated over a MemoryRepository"""
+
+    def __init__(self, repo, model, ancestor=None, filters=(), orders=()):
+        self._repo = repo
+        self._model = model
+        self._ancestor = ancestor
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+
+    def filter(self, name, op, value):
+        if op not in _COMPARE:
+            raise ValueError('Unsupported filter operator: %s' % op)
+        if op == 'in':
+            value = [_indexValue(v) for v in value]
+        else:
+            value = _indexValue(value)
+        return MemoryQuery(self._repo, self._model, self._ancestor,
+                           self._filters + ((name, op, value),), self._orders)
+
+    def order(self, name):
+        return MemoryQuery(self._repo, self._model, self._ancestor,
+                           self._filters, self._orders + (_orderName(name),))
+
+    def _matches(self, entity):
+        if self._ancestor is not None:
+            depth = len(self._ancestor.pairs())
+            if entity.key.pairs()[:depth] != self._ancestor.pairs():
+                return False
+        for name, op, value in self._filters:
+            if not any(_COMPARE[op](v, value) for v in _values(entity, name)):
+                return False
+        return True
+
+    def _run(self):
+        results = [entity for entity in self._repo._scan(self._model)
+                   if self._matches(entity)]
+        # sort by key, then by each order from the last to the first;
+        # repeated properties sort by their smallest (or largest) value
+        results.sort(key=lambda entity: _keyOrder(entity.key))
+        for name, descending in reversed(self._orders):
+            pick = max if descending else min
+            results = [entity for entity in results if _values(entity, name)]
+            results.sort(key=lambda entity: pick(_values(entity, name)),
+                         reverse=descending)
+        return results
+
+    def fetch_page(self, page_size, start_cursor=None, keys_only=False,
+                   **options):
+        self._repo._rpc()
+        results = self._run()
+        offset = start_cursor.offset if start_cursor else 0
+        page = results[offset:offset + page_size]
+        end = offset + len(page)
+        if keys_only:
+            page = [entity.key for entity in page]
+        else:
+            page = [self._repo._clone(entity) for entity in page]
+        return page, MemoryCursor(end), end < len(results)
+
+    def fetch(self, limit=None, keys_only=False, **options):
+        self._repo._rpc()
+        results = self._run()[:limit]
+        if keys_only:
+            return [entity.key for entity in results]
+        return [self._repo._clone(entity) for entity in results]
+
+    def fetch_async(self, limit=None, **options):
+        return _done(self.fetch(limit, **options))
+
+    def get(self, **options):
+        results = self.fetch(1, **options)
+        return results[0] if results else None
+
+    def iter(self, **options):
+        return iter(self.fetch(**options))
+
+    def __iter__(self):
+        return self.iter()
+
+
+class MemoryRepository(object):
+
+    """MemoryRepository -- entities in a dict in process memory"""
+
+    # one process's data; a shared cache would mix it with others'
+    shared = False
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.rpcs = 0
+        self._entities = {}
+        self._next_id = collections.defaultdict(lambda: 1)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def _rpc(self):
+        self.rpcs += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _clone(entity):
+        values = dict((prop._code_name, getattr(entity, prop._code_name))
+                      for prop in entity._properties.values()
+                      if not isinstance(prop, ndb.ComputedProperty))
+        return entity.__class__(key=entity.key, **copy.deepcopy(values))
+
+    def _scan(self, model):
+        with self._lock:
+            return [entity for key, entity in self._entities.items()
+                    if key.kind() == model._get_kind()]
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        self._rpc()
+        with self._lock:
+            found = [self._entities.get(key) for key in keys]
+        return [self._clone(entity) if entity else None for entity in found]
+
+    def get_multi_async(self, keys):
+        return [_done(entity) for entity in self.get_multi(keys)]
+
+    def put(self, entity):
+        return self.put_multi([entity])[0]
+
+    def put_multi(self, entities):
+        self._rpc()
+        with self._lock:
+            for entity in entities:
+                key = entity.key
+                if key is None or key.id() is None:
+                    parent = key.parent() if key else None
+                    entity.key = ndb.Key(entity._get_kind(),
+                                         self.allocateIds(entity, 1, parent)[0],
+                                         parent=parent)
+                entity._prepare_for_put()
+                self._entities[entity.key] = self._clone(entity)
+        return [entity.key for entity in entities]
+
+    def put_multi_async(self, entities):
+        return [_done(key) for key in self.put_multi(entities)]
+
+    def delete_multi(self, keys):
+        self._rpc()
+        with self._lock:
+            for key in keys:
+                self._entities.pop(key, None)
+
+    def allocateIds(self, model, size=1, parent=None):
+        with self._lock:
+            counter = (model._get_kind(), parent)
+            first = self._next_id[counter]
+            self._next_id[counter] = first + size
+        return range(first, first + size)
+
+    def query(self, model, ancestor=None):
+        return MemoryQuery(self, model, ancestor=ancestor)
+
+    def cursor(self, page_token):
+        """Return the cursor for a page token; ValueError if invalid."""
+        try:
+            return MemoryCursor(int(page_token))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid page token: %r' % page_token)
+
+    def transaction(self, func, xg=False):
+        """Run func holding the store's lock; undo its writes if it raises."""
+        with self._lock:
+            outer = getattr(self._local, 'on_commit', None)
+            if outer is not None:
+                # already in a transaction
+                return func()
+            snapshot = dict(self._entities)
+            self._local.on_commit = []
+            try:
+                result = func()
+            except Exception:
+                self._entities = snapshot
+                raise
+            finally:
+                callbacks, self._local.on_commit = self._local.on_commit, None
+        for callback in callbacks:
+            callback()
+        return result
+
+    def callOnCommit(self, callback):
+        pending = getattr(self._local, 'on_commit', None)
+        if pending is None:
+            callback()
+        else:
+            pending.append(callback)
+
+    def addTask(self, task, queue_name='default'):
+        """Add task to the queue once the current transaction commits;
+        the datastore can't take part in a memory transaction."""
+        self.callOnCommit(lambda: taskqueue.Queue(queue_name).add(task))
+
+
+# - - - selection - - - - - - - - - - - - - - - - - - - - - - -
+
+def _defaultRepository():
+    if STORAGE_BACKEND == 'memory':
+        return MemoryRepository(latency=MEMORY_STORAGE_LATENCY)
+    return NdbRepository()
+
+
+repo = _defaultRepository()
+
+
+def use(repository):
+    """Make repository the one the API uses; return the previous one."""
+    global repo
+    previous, repo = repo, repository
+    return previous
+
+
+# - - - unit of work - - - - - - - - - - - - - - - - - - - - -
+
+class UnitOfWork(object):
+
+    """UnitOfWork -- writes and callbacks held until flush()"""
+
+    def __init__(self, transactional=False):
+        self.transactional = transactional
+        self._entities = collections.OrderedDict()
+        self._callbacks = []
+
+    def add(self, entity):
+        key = entity.key
+        if key is None or key.id() is None:
+            # no key yet: only the same object is the same entity
+            key = id(entity)
+        self._entities.pop(key, None)
+        self._entities[key] = entity
+
+    def afterWrite(self, callback):
+        self._callbacks.append(callback)
+
+    def flush(self):
+        entities = self._entities.values()
+        callbacks = self._callbacks
+        self._entities = collections.OrderedDict()
+        self._callbacks = []
+        if entities:
+            for future in repo.put_multi_async(entities):
+                future.get_result()
+        for callback in callbacks:
+            if self.transactional:
+                repo.callOnCommit(callback)
+            else:
+                callback()
+
+
+_units = threading.local()
+
+
+def _current():
+    stack = getattr(_units, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def _runInUnit(unit, func, args, kwargs):
+    if getattr(_units, 'stack', None) is None:
+        _units.stack = []
+    _units.stack.append(unit)
+    try:
+        result = func(*args, **kwargs)
+        unit.flush()
+        return result
+    finally:
+        _units.stack.pop()
+
+
+def putLater(*entities):
+    """Write entities when the current unit of work is flushed, or right
+    away outside of one."""
+    unit = _current()
+    if unit is None:
+        repo.put_multi(list(entities))
+        return
+    for entity in entities:
+        unit.add(entity)
+
+
+def afterWrite(callback):
+    """Call callback once the current unit of work's writes are done
+    (and committed), or on commit outside of one."""
+    unit = _current()
+    if unit is None:
+        repo.callOnCommit(callback)
+    else:
+        unit.afterWrite(callback)
+
+
+def flush():
+    """Write what the current unit of work holds now."""
+    unit = _current()
+    if unit is not None:
+        unit.flush()
+
+
+def unitOfWork(func):
+    """Decorator running a function (an endpoint) in a unit of work;
+    joins the unit of work already open, if any."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current() is not None:
+            return func(*args, **kwargs)
+        return _runInUnit(UnitOfWork(), func, args, kwargs)
+    return wrapper
+
+
+def transactional(xg=False):
+    """Decorator running a function in a transaction of the repository
+    in use when it is called, with its own unit of work flushed before
+    the commit."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            unit = _current()
+            if unit is not None and unit.transactional:
+                # already in a transaction: join it
+                return func(*args, **kwargs)
+            return repo.transaction(
+                lambda: _runInUnit(UnitOfWork(transactional=True),
+                                   func, args, kwargs), xg=xg)
+        return wrapper
+    return decorator
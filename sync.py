@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""sync.py
+
+Changes feed for offline-capable clients.
+
+Conference, Session and Speaker carry an `updated` timestamp that ndb
+stamps on every put, and deleting one of them leaves a Tombstone. A
+client syncs by paging through changes() until there is no next page
+token, then keeps the returned sync token and passes it as `since` next
+time. Without `since` it gets everything (a full sync) and should
+replace what it has.
+
+Pages hold one kind at a time, in the order of PHASES. The window ends
+SYNC_LAG_SECONDS in the past so writes not yet visible to the
+(eventually consistent) timestamp queries are left for the next sync
+rather than skipped; a change may therefore be sent twice, and clients
+apply changes by websafe key.
+
+Tombstones older than TOMBSTONE_RETENTION_DAYS are pruned; a client
+whose sync token is older than that gets a full sync instead.
+
+"""
+
+import base64
+import collections
+import json
+from datetime import datetime
+from datetime import timedelta
+
+import storage
+from models import Conference
+from models import Session
+from models import Speaker
+from models import Tombstone
+
+PHASES = (Conference, Session, Speaker, Tombstone)
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# how far behind the present a sync window ends
+SYNC_LAG_SECONDS = 10
+TOMBSTONE_RETENTION_DAYS = 30
+TOKEN_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# one page of the feed: entities all of model kind, nextPageToken None
+# on the last page, full True for a full sync
+Changes = collections.namedtuple(
+    'Changes', 'kind entities nextPageToken syncToken full')
+
+
+def recordDeletions(keys):
+    """Leave a Tombstone for each deleted entity key."""
+    storage.putLater(*[Tombstone(id=key.urlsafe(), kindName=key.kind())
+                       for key in keys])
+
+
+def _parseTime(text):
+    try:
+        return datetime.strptime(text, TOKEN_FORMAT)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid sync token: %r' % text)
+
+
+def _encodePageToken(state):
+    return base64.urlsafe_b64encode(json.dumps(state))
+
+
+def _decodePageToken(token):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+        return (int(state['phase']), state.get('cursor'),
+                state.get('since'), state['until'])
+    except (TypeError, ValueError, KeyError):
+        raise ValueError('Invalid page token: %r' % token)
+
+
+def _query(model, since, until):
+    query = storage.repo.query(model)
+    if since is None:
+        return query
+    stamp = 'deleted' if model is Tombstone else 'updated'
+    return query.filter(stamp, '>=', since).filter(
+        stamp, '<', until).order(stamp)
+
+
+def changes(since=None, page_token=None, page_size=PAGE_SIZE):
+    """Return one page of changes as a Changes tuple.
+
+    since is a sync token from an earlier sync, or None for a full sync;
+    page_token continues a sync. Raises ValueError on a bad token.
+    """
+    page_size = min(page_size or PAGE_SIZE, MAX_PAGE_SIZE)
+    if page_token:
+        phase, cursor, since_text, until_text = _decodePageToken(page_token)
+        since = _parseTime(since_text) if since_text else None
+        until = _parseTime(until_text)
+    else:
+        phase, cursor = 0, None
+        since = _parseTime(since) if since else None
+        until = datetime.utcnow() - timedelta(seconds=SYNC_LAG_SECONDS)
+        retention = timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        if since is not None and since < until - retention:
+            # deletions may have been pruned since then
+            since = None
+
+    # a full sync has nothing to delete
+    phases = PHASES if since else PHASES[:-1]
+    if not 0 <= phase < len(phases):
+        raise ValueError('Invalid page token: %r' % page_token)
+    try:
+        start = storage.repo.cursor(cursor) if cursor else None
+    except ValueError:
+        raise ValueError('Invalid page token: %r' % page_token)
+
+    while True:
+        model = phases[phase]
+        results, next_cursor, more = _query(model, since, until).fetch_page(
+            page_size, start_cursor=start)
+        if more and next_cursor:
+            cursor = next_cursor.urlsafe()
+            break
+        phase, cursor, start = phase + 1, None, None
+        # skip ahead over kinds without changes
+        if results or phase == len(phases):
+            break
+
+    next_token = None
+    if phase < len(phases):
+        next_token = _encodePageToken({
+            'phase': phase,
+            'cursor': cursor,
+            'since': since.strftime(TOKEN_FORMAT) if since else None,
+            'until': until.strftime(TOKEN_FORMAT),
+        })
+    return Changes(model, results, next_token,
+                   until.strftime(TOKEN_FORMAT), since is None)
+
+
+def pruneTombstones():
+    """Delete tombstones past the retention period; return how many."""
+    cutoff = datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    keys = storage.repo.query(Tombstone).filter(
+        'deleted', '<', cutoff).fetch(keys_only=True)
+    storage.repo.delete_multi(keys)
+    return len(keys)
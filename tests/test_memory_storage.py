@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""test_memory_storage.py
+
+Runs API calls end to end on the memory repository (storage.py), with
+no datastore stub registered: any datastore call that bypasses
+storage.repo fails the test.
+
+Needs the App Engine SDK (for endpoints, memcache and the task queue
+stubs); from the app directory:
+
+    PYTHONPATH=/path/to/google_appengine python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+import cache
+import storage
+from conference import CONF_GET_REQUEST
+from conference import ConferenceApi
+from conference import SESSION_GET_REQUEST
+from models import ConferenceForm
+from models import Profile
+from models import SessionInputForm
+from models import TypeOfSession
+from outbox import OUTBOX_QUEUE
+
+ORGANIZER = 'organizer@example.com'
+
+
+class MemoryStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # signed in as ORGANIZER for endpoints.get_current_user()
+        self.testbed.setup_env(ENDPOINTS_AUTH_EMAIL=ORGANIZER,
+                               ENDPOINTS_AUTH_DOMAIN='gmail.com',
+                               overwrite=True)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.repo = storage.MemoryRepository()
+        self.previous = storage.use(self.repo)
+        # keys repeat from one memory repository to the next
+        cache.local.clear()
+        cache.entities.clear()
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        storage.use(self.previous)
+        cache.local.clear()
+        cache.entities.clear()
+        self.testbed.deactivate()
+
+    def _createConference(self):
+        self.api.createConference(ConferenceForm(
+            name='PyCon', city='Berlin', topics=['Python'],
+            startDate='2026-11-02', endDate='2026-11-04', maxAttendees=10))
+        created = self.api.getConferencesCreated(message_types.VoidMessage())
+        self.assertEqual(['PyCon'], [conf.name for conf in created.items])
+        return created.items[0].websafeKey
+
+    def _createSession(self, wsck, name, start_time):
+        return self.api.createSession(SessionInputForm(
+            name=name, speaker_name='Ada', speaker_email='ada@example.com',
+            speaker_speciality='Engines', duration=45,
+            type_of_session=TypeOfSession.LECTURE, date='2026-11-02',
+            start_time=start_time, conf_websafekey=wsck))
+
+    def testSessionsAndRegistration(self):
+        wsck = self._createConference()
+        self._createSession(wsck, 'Afternoon', '14:00')
+        self._createSession(wsck, 'Morning', '09:00')
+
+        sessions = self.api.getConferenceSessions(
+            SESSION_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=wsck))
+        self.assertEqual(['Morning', 'Afternoon'],
+                         [session.name for session in sessions.items])
+        self.assertEqual(['Ada', 'Ada'],
+                         [session.speaker_name for session in sessions.items])
+
+        registered = self.api.registerForConference(
+            CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=wsck))
+        self.assertTrue(registered.data)
+        attending = self.api.getConferencesToAttend(
+            message_types.VoidMessage())
+        self.assertEqual([wsck], [conf.websafeKey for conf in attending.items])
+        self.assertEqual(9, attending.items[0].seatsAvailable)
+        # the registration is an Attendance record, not a profile entry
+        profile = self.api.getProfile(message_types.VoidMessage())
+        self.assertEqual([wsck], profile.conferenceKeysToAttend)
+        self.assertEqual([[]], [prof.conferenceKeysToAttend
+                                for prof in self.repo.query(Profile)])
+
+        dashboard = self.api.getDashboard(message_types.VoidMessage())
+        self.assertEqual(ORGANIZER, dashboard.profile.mainEmail)
+        self.assertEqual([wsck], [conf.websafeKey
+                                  for conf in dashboard.conferencesToAttend])
+
+        # creation and registration emails, the latter queued on commit
+        self.assertEqual(2, len(self.taskqueue.GetTasks(OUTBOX_QUEUE)))
+        self.assertTrue(self.repo.rpcs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""throttle.py
+
+Admission control for expensive endpoints.
+
+Every caller (user ID, or client address when signed out) has one
+token bucket per throttled endpoint, kept in memcache so all instances
+share it. A bucket holds up to THROTTLE_CAPACITY tokens, refills at
+THROTTLE_REFILL_PER_SECOND and each call takes THROTTLE_COSTS[endpoint]
+tokens per unit of work; a call that finds too few tokens is refused
+with ThrottledException (HTTP 503, with 'Retry-After: N' in the
+message). Costs live in settings.py; endpoints
+not listed there are never throttled.
+
+Buckets are updated with compare-and-set. If memcache is unavailable
+or too contended, calls are let through rather than refused.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from models import ThrottledException
+from settings import THROTTLE_CAPACITY
+from settings import THROTTLE_COSTS
+from settings import THROTTLE_REFILL_PER_SECOND
+
+MEMCACHE_BUCKET_KEY = 'BUCKET:%s:%s'
+MEMCACHE_REJECTED_KEY = 'THROTTLED:%s'
+THROTTLE_CAS_RETRIES = 5
+
+# a bucket left alone this long is full again, so needn't be kept
+_BUCKET_TTL = int(THROTTLE_CAPACITY / THROTTLE_REFILL_PER_SECOND) + 1
+
+_lock = threading.Lock()
+_counts = collections.defaultdict(collections.Counter)
+
+
+def _count(endpoint, outcome):
+    with _lock:
+        _counts[endpoint][outcome] += 1
+
+
+def admit(caller, endpoint, units=1):
+    """Take the cost of a call to endpoint from caller's bucket, or raise
+    ThrottledException if the bucket doesn't hold enough.
+    """
+    cost = THROTTLE_COSTS.get(endpoint)
+    if not cost:
+        return
+    # never ask for more than a full bucket, or the call could never pass
+    cost = min(cost * max(units, 1), THROTTLE_CAPACITY)
+    key = MEMCACHE_BUCKET_KEY % (endpoint, caller)
+    client = memcache.Client()
+    for _ in range(THROTTLE_CAS_RETRIES):
+        now = time.time()
+        state = client.gets(key)
+        if state is None:
+            tokens = THROTTLE_CAPACITY
+        else:
+            tokens, stamp = state
+            tokens = min(THROTTLE_CAPACITY,
+                         tokens + (now - stamp) * THROTTLE_REFILL_PER_SECOND)
+        if tokens < cost:
+            _reject(caller, endpoint, (cost - tokens) / THROTTLE_REFILL_PER_SECOND)
+        state_new = (tokens - cost, now)
+        if state is None:
+            stored = client.add(key, state_new, time=_BUCKET_TTL)
+        else:
+            stored = client.cas(key, state_new, time=_BUCKET_TTL)
+        if stored:
+            _count(endpoint, 'admitted')
+            return
+    logging.warning('throttle: admitting %s to %s unmetered', caller, endpoint)
+    _count(endpoint, 'unmetered')
+
+
+def _reject(caller, endpoint, wait):
+    _count(endpoint, 'rejected')
+    memcache.incr(MEMCACHE_REJECTED_KEY % endpoint, initial_value=0)
+    logging.info('throttle: refused %s to %s', endpoint, caller)
+    raise ThrottledException(
+        'Too many %s requests; Retry-After: %d' % (endpoint, wait + 1))
+
+
+def stats():
+    """Return this instance's admitted/rejected counts per endpoint, and
+    rejections across all instances from memcache.
+    """
+    with _lock:
+        local_counts = dict((endpoint, dict(counts))
+                            for endpoint, counts in _counts.items())
+    rejected = memcache.get_multi(THROTTLE_COSTS.keys(),
+                                  key_prefix=MEMCACHE_REJECTED_KEY % '')
+    return {'instance': local_counts, 'rejected': rejected}
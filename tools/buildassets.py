@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""buildassets.py
+
+Bundle the web client's JavaScript, stylesheets and Angular partials
+into content-hashed files under static/dist, and point
+templates/index.html at them.
+
+    python tools/buildassets.py           # build, rewrite index.html
+    python tools/buildassets.py --check   # exit 1 if a build is due
+    python tools/buildassets.py --dev     # index.html loads the sources
+
+The bundles:
+
+    app.<hash>.js   static/js/app.js, static/js/controllers.js, and every
+                    partial in static/partials preloaded into Angular's
+                    $templateCache, so routes and modals need no request
+    app.<hash>.css  the local stylesheets index.html links to
+
+Comments and indentation are stripped; code is not otherwise rewritten,
+so the bundles behave exactly like the sources. A bundle's name changes
+with its content, which lets app.yaml serve /dist with a one year
+expiration: a deploy that changes a source produces a new name instead
+of waiting for caches to expire. index.html itself is cached briefly.
+
+The tags replaced are those between <!-- build:js --> (or build:css)
+and <!-- endbuild --> in index.html. Run the build after changing a
+source, and commit the output with it.
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_HTML = os.path.join(APP_DIR, 'templates', 'index.html')
+DIST_DIR = os.path.join(APP_DIR, 'static', 'dist')
+DIST_URL = '/dist/'
+PARTIALS_DIR = os.path.join(APP_DIR, 'static', 'partials')
+PARTIALS_URL = '/partials/'
+
+# (source file, URL app.yaml serves it at), in load order
+JS_SOURCES = [
+    ('static/js/app.js', '/js/app.js'),
+    ('static/js/controllers.js', '/js/controllers.js'),
+]
+CSS_SOURCES = [
+    ('static/bootstrap/css/bootstrap-cosmo.css', '/css/bootstrap-cosmo.css'),
+    ('static/bootstrap/css/main.css', '/css/main.css'),
+    ('static/bootstrap/css/offcanvas.css', '/css/offcanvas.css'),
+]
+
+TAGS = {
+    'js': '<script src="%s"></script>',
+    'css': '<link rel="stylesheet" href="%s">',
+}
+BUILD_BLOCK = re.compile(
+    r'(?P<indent>[ \t]*)<!-- build:(?P<kind>\w+) -->\n.*?<!-- endbuild -->',
+    re.DOTALL)
+
+TEMPLATES_JS = '''angular.module('conferenceApp').run(['$templateCache',
+function ($templateCache) {
+%s
+}]);
+'''
+
+CSS_TOKEN = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+                       r'''|(/\*.*?\*/)|(\s+)|([^"'/\s]+|/)''', re.DOTALL)
+# whitespace is never needed next to these
+CSS_PUNCTUATION = '{};,'
+
+
+def read(path):
+    with open(os.path.join(APP_DIR, path)) as f:
+        return f.read()
+
+
+def minifyJs(source):
+    """Drop comment lines and indentation. Only comments that start a
+    line are removed, so string and regex literals are left alone; code
+    after a block comment closed on the same line is kept.
+    """
+    lines = []
+    in_comment = False
+    for line in source.splitlines():
+        line = line.strip()
+        if in_comment:
+            end = line.find('*/')
+            if end < 0:
+                continue
+            in_comment = False
+            line = line[end + 2:].strip()
+        while line.startswith('/*'):
+            end = line.find('*/', 2)
+            if end < 0:
+                in_comment = True
+                line = ''
+            else:
+                line = line[end + 2:].strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def minifyCss(source):
+    """Drop comments and collapse whitespace outside strings."""
+    tokens = [string or other or (' ' if space else '')
+              for string, comment, space, other in CSS_TOKEN.findall(source)]
+    tokens = [token for token in tokens if token]
+    out = []
+    for i, token in enumerate(tokens):
+        if token == ' ':
+            # a space is only needed between words, and before ':' in
+            # selectors
+            before = out[-1][-1] if out else ''
+            after = tokens[i + 1][0] if i + 1 < len(tokens) else ''
+            if (not before or not after or before in CSS_PUNCTUATION + ':' or
+                    after in CSS_PUNCTUATION or after == ' '):
+                continue
+        out.append(token)
+    return ''.join(out) + '\n'
+
+
+def minifyHtml(source):
+    """Drop indentation and blank lines from a partial."""
+    lines = [line.strip() for line in source.splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def partialsJs():
+    """Return a script putting every partial in $templateCache."""
+    puts = []
+    for name in sorted(os.listdir(PARTIALS_DIR)):
+        if name.endswith('.html'):
+            with open(os.path.join(PARTIALS_DIR, name)) as f:
+                puts.append('$templateCache.put(%s, %s);' % (
+                    json.dumps(PARTIALS_URL + name),
+                    json.dumps(minifyHtml(f.read()))))
+    return TEMPLATES_JS % '\n'.join(puts)
+
+
+def bundles():
+    """Return {kind: (file name, content)} for this checkout."""
+    js = ';\n'.join([minifyJs(read(path)) for path, _ in JS_SOURCES] +
+                    [partialsJs()])
+    css = ''.join(minifyCss(read(path)) for path, _ in CSS_SOURCES)
+    built = {}
+    for kind, content in (('js', js), ('css', css)):
+        digest = hashlib.sha1(content).hexdigest()[:12]
+        built[kind] = ('app.%s.%s' % (digest, kind), content)
+    return built
+
+
+def rewriteIndex(html, urls):
+    """Return html with each build block loading urls[kind]."""
+    def replace(match):
+        indent, kind = match.group('indent'), match.group('kind')
+        lines = ['<!-- build:%s -->' % kind]
+        lines.extend(TAGS[kind] % url for url in urls[kind])
+        lines.append('<!-- endbuild -->')
+        return '\n'.join(indent + line for line in lines)
+    return BUILD_BLOCK.sub(replace, html)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true',
+                        help='only report whether the build is out of date')
+    parser.add_argument('--dev', action='store_true',
+                        help='point index.html at the unbundled sources')
+    args = parser.parse_args()
+
+    with open(INDEX_HTML) as f:
+        html = f.read()
+    if args.dev:
+        urls = {'js': [url for _, url in JS_SOURCES],
+                'css': [url for _, url in CSS_SOURCES]}
+        built = {}
+    else:
+        built = bundles()
+        urls = dict((kind, [DIST_URL + name])
+                    for kind, (name, _) in built.items())
+    new_html = rewriteIndex(html, urls)
+
+    if args.check:
+        stale = new_html != html or any(
+            not os.path.exists(os.path.join(DIST_DIR, name))
+            for name, _ in built.values())
+        print 'out of date' if stale else 'up to date'
+        sys.exit(1 if stale else 0)
+
+    if built:
+        if not os.path.isdir(DIST_DIR):
+            os.makedirs(DIST_DIR)
+        names = set(name for name, _ in built.values())
+        for name in os.listdir(DIST_DIR):
+            if name not in names:
+                os.remove(os.path.join(DIST_DIR, name))
+        for kind, (name, content) in sorted(built.items()):
+            with open(os.path.join(DIST_DIR, name), 'w') as f:
+                f.write(content)
+            sources = [path for path, _ in
+                       (JS_SOURCES if kind == 'js' else CSS_SOURCES)]
+            if kind == 'js':
+                sources.extend(os.path.join(PARTIALS_DIR, name)
+                               for name in os.listdir(PARTIALS_DIR))
+            size = sum(len(read(path)) for path in sources)
+            print '%s: %d bytes (sources %d)' % (name, len(content), size)
+    with open(INDEX_HTML, 'w') as f:
+        f.write(new_html)
+
+
+if __name__ == '__main__':
+    main()
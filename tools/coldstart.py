@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""coldstart.py
+
+Measure what a fresh instance pays before it can answer its first
+request: the time to import each WSGI module, in a brand new
+interpreter every run, plus (with --url) the time to the first response
+from a freshly started dev_appserver.
+
+Run it on two checkouts to compare before/after, e.g.
+
+    python tools/coldstart.py --sdk ~/google_appengine main conference
+    python tools/coldstart.py --url http://localhost:8080/crons/set_announcement
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = '''
+import sys, time
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(app)r)
+start = time.time()
+import %(module)s
+sys.stdout.write('%%f' %% (time.time() - start))
+'''
+
+
+def timeImport(sdk, module):
+    """Return seconds to import module in a new interpreter."""
+    code = IMPORT_SNIPPET % {'sdk': sdk, 'app': APP_DIR, 'module': module}
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=APP_DIR)
+    return float(out.strip().splitlines()[-1])
+
+
+def timeFirstResponse(url, timeout):
+    """Return seconds until url first answers, polling from now."""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            urllib2.urlopen(url, timeout=timeout).read()
+            return time.time() - start
+        except urllib2.HTTPError:
+            # the app answered, even if not with a 2xx
+            return time.time() - start
+        except Exception:
+            time.sleep(0.05)
+    raise RuntimeError('no response from %s within %ss' % (url, timeout))
+
+
+def summarize(label, samples):
+    samples = sorted(samples)
+    median = samples[len(samples) // 2]
+    print '%-24s min %7.1f ms   median %7.1f ms   max %7.1f ms' % (
+        label, samples[0] * 1000, median * 1000, samples[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('modules', nargs='*', default=['main', 'conference'])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--url',
+                        help='time first response from a server that is '
+                             'being started right now')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    if args.url:
+        summarize(args.url, [timeFirstResponse(args.url, args.timeout)])
+        return
+    if not args.sdk:
+        parser.error('--sdk (or APPENGINE_SDK) is required to time imports')
+    for module in args.modules:
+        summarize('import %s' % module,
+                  [timeImport(args.sdk, module) for _ in range(args.runs)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""indexadvisor.py
+
+Propose a minimal index.yaml for the filtered listing queries
+(queryConferences, querySessions), weighed against the queries actually
+run, and report what the indexes cost in datastore writes per entity.
+
+The query shapes come from the filters the API accepts (FIELDS and
+FIELDS_SESSION in conference.py): any set of equality filters and at
+most one inequality filter (the rest are applied in memory), ordered by
+the inequality property, then name, then key. Sessions are queried by
+ancestor (legacy layout) or by conferenceKey (flat layout).
+
+Rather than one composite index per combination of filters, the
+proposal relies on the datastore's merge join: a query with equality
+filters on city and topics, ordered by name, is answered by zigzagging
+(city, name) and (topics, name). That is one index per filter property
+and sort order instead of one per subset of filters. A merge join slows
+down when every filter alone matches many entities, so shapes that make
+up a large share of the logged queries (--dedicated) also get an index
+of their own.
+
+By default every possible shape stays answerable. With --cover observed
+only the shapes seen in the logs are; any other query then fails with
+NeedIndexError until its indexes are added, so use it only with logs
+from a representative period.
+
+conference.py logs the shape of every filtered query; pass the app's
+request logs with --logs, e.g. saved with
+
+    gcloud app logs read --limit 100000 > queries.log
+    python tools/indexadvisor.py --sdk ~/google_appengine --logs queries.log
+
+--write replaces the indexes below index.yaml's AUTOGENERATED marker
+with the proposal; the ones above it are maintained by hand and left
+alone. Indexes dropped from index.yaml keep being written until they are
+deleted with `appcfg.py vacuum_indexes`.
+
+Write costs follow the datastore's counts: a new entity takes 2 writes,
+plus 2 per indexed property value and 1 per composite index row; an
+update takes 1 write, plus 4 per changed indexed property value and 2
+per composite index row over a changed property.
+
+"""
+
+import argparse
+import collections
+import itertools
+import os
+import re
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_YAML = os.path.join(APP_DIR, 'index.yaml')
+MARKER = '# AUTOGENERATED'
+
+AUTOGENERATED_HEADER = '''# AUTOGENERATED
+
+# This index.yaml is automatically updated whenever the dev_appserver
+# detects that a new type of query is run.  If you want to manage the
+# index.yaml file manually, remove the above marker line (the line
+# saying "# AUTOGENERATED").  If you want to manage some indexes
+# manually, move them above the marker line.  The index.yaml file is
+# automatically uploaded to the admin console when you next deploy
+# your application using appcfg.py.
+'''
+
+SHAPE_LOG = re.compile(
+    r'query shape: (\w+) ancestor=(yes|no) eq=([\w,]*) ineq=(\w*)')
+
+# equality filter every query of a kind has in the flat layout
+FLAT_PREFIX = {'Session': ('conferenceKey',)}
+# keys in an entity's path in the legacy layout; an ancestor index has a
+# row for each
+PATH_DEPTH = {'Conference': 2, 'Session': 3}
+# values assumed in a repeated property unless given with --values
+DEFAULT_REPEATED_VALUES = 3
+# properties changed by the commonest update of each kind (registration)
+DEFAULT_CHANGED = 'Conference=seatsAvailable,updated'
+
+Index = collections.namedtuple('Index', 'kind ancestor properties')
+Shape = collections.namedtuple('Shape',
+                               'kind ancestor prefix equalities inequality')
+
+
+def loadApp(sdk):
+    """Import the app (conference, models, settings) and yaml from sdk."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    import conference
+    import models
+    import settings
+    import yaml
+    return conference, models, settings, yaml
+
+
+# - - - query shapes - - - - - - - - - - - - - - - - - - - - -
+
+def queryShapes(kind, fields, ancestor, prefix=()):
+    """Yield every shape of query the API can run over fields."""
+    fields = sorted(fields)
+    for inequality in [None] + fields:
+        others = [field for field in fields if field != inequality]
+        for n in range(len(others) + 1):
+            for equalities in itertools.combinations(others, n):
+                yield Shape(kind, ancestor, prefix, frozenset(equalities),
+                            inequality)
+
+
+def sortOrder(shape):
+    return ((shape.inequality,) if shape.inequality else ()) + ('name',)
+
+
+def parseLogs(lines):
+    """Return a Counter of the query shapes logged in lines."""
+    counts = collections.Counter()
+    for line in lines:
+        match = SHAPE_LOG.search(line)
+        if not match:
+            continue
+        kind, ancestor, equalities, inequality = match.groups()
+        equalities = set(filter(None, equalities.split(',')))
+        prefix = FLAT_PREFIX.get(kind, ())
+        if prefix and equalities.issuperset(prefix):
+            equalities.difference_update(prefix)
+        else:
+            prefix = ()
+        counts[Shape(kind, ancestor == 'yes', prefix, frozenset(equalities),
+                     inequality or None)] += 1
+    return counts
+
+
+def describe(shape):
+    text = ', '.join(sorted(shape.equalities)) or '-'
+    if shape.inequality:
+        text += ' | ' + shape.inequality
+    if shape.ancestor:
+        text += ' (ancestor)'
+    elif shape.prefix:
+        text += ' (%s)' % ', '.join(shape.prefix)
+    return text
+
+
+# - - - indexes - - - - - - - - - - - - - - - - - - - - - - - -
+
+def isBuiltIn(index):
+    """True if the datastore's single-property indexes serve index."""
+    return not index.ancestor and len(index.properties) <= 1
+
+
+def dedicatedIndex(shape):
+    """Return the one composite index serving shape alone, or None."""
+    index = Index(shape.kind, shape.ancestor,
+                  shape.prefix + tuple(sorted(shape.equalities)) +
+                  sortOrder(shape))
+    return None if isBuiltIn(index) else index
+
+
+def mergeIndexes(shape):
+    """Return the indexes serving shape by merge join, one per equality."""
+    if not shape.equalities:
+        return filter(None, [dedicatedIndex(shape)])
+    return [Index(shape.kind, shape.ancestor,
+                  shape.prefix + (field,) + sortOrder(shape))
+            for field in sorted(shape.equalities)]
+
+
+def servedBy(shape, indexes):
+    """Return 'dedicated', 'merge join of N', or None if no combination
+    of indexes answers shape.
+    """
+    index = dedicatedIndex(shape)
+    if index is None or index in indexes:
+        return 'dedicated'
+    prefix, suffix = shape.prefix, sortOrder(shape)
+    usable = []
+    for index in indexes:
+        props = index.properties
+        middle = props[len(prefix):len(props) - len(suffix)]
+        if (index.kind == shape.kind and index.ancestor == shape.ancestor and
+                props[:len(prefix)] == prefix and
+                props[len(props) - len(suffix):] == suffix and
+                middle and shape.equalities.issuperset(middle)):
+            usable.append(middle)
+    if set(itertools.chain(*usable)) != shape.equalities:
+        return None
+    return 'merge join of %d' % len(usable)
+
+
+def propose(shapes, counts, dedicated_share):
+    """Return the index set serving every shape in shapes and counts."""
+    total = sum(counts.values())
+    dedicated = set(shape for shape, n in counts.items()
+                    if len(shape.equalities) > 1 and
+                    n >= dedicated_share * total)
+    proposed = set(dedicatedIndex(shape) for shape in dedicated)
+    for shape in (set(shapes) | set(counts)) - dedicated:
+        proposed.update(mergeIndexes(shape))
+    return proposed
+
+
+def parseIndexes(yaml, text):
+    indexes = []
+    for entry in (yaml.safe_load(text) or {}).get('indexes') or []:
+        props = tuple(p['name'] if p.get('direction', 'asc') == 'asc'
+                      else '-' + p['name'] for p in entry.get('properties', []))
+        indexes.append(Index(entry['kind'], bool(entry.get('ancestor')), props))
+    return indexes
+
+
+def readIndexYaml(yaml, path):
+    """Return (text above the marker, indexes above it, indexes below it)."""
+    with open(path) as f:
+        text = f.read()
+    manual, marker, generated = text.partition(MARKER)
+    if not marker:
+        manual, generated = text, ''
+    return manual, parseIndexes(yaml, manual), parseIndexes(
+        yaml, 'indexes:\n' + generated)
+
+
+def formatIndex(index):
+    lines = ['- kind: %s' % index.kind]
+    if index.ancestor:
+        lines.append('  ancestor: yes')
+    lines.append('  properties:')
+    for prop in index.properties:
+        if prop.startswith('-'):
+            lines.append('  - name: %s\n    direction: desc' % prop[1:])
+        else:
+            lines.append('  - name: %s' % prop)
+    return '\n'.join(lines) + '\n'
+
+
+def writeIndexYaml(path, manual, indexes):
+    with open(path, 'w') as f:
+        f.write(manual.rstrip('\n') + '\n\n' + AUTOGENERATED_HEADER)
+        for index in sorted(indexes):
+            f.write('\n' + formatIndex(index))
+
+
+# - - - write cost - - - - - - - - - - - - - - - - - - - - - - -
+
+class WriteCost(object):
+
+    """WriteCost -- datastore writes of one entity of a model"""
+
+    def __init__(self, model, repeated_values):
+        self.model = model
+        self.repeated_values = repeated_values
+        self.indexed = [name for name, prop in model._properties.items()
+                        if prop._indexed]
+
+    def values(self, name):
+        """Index values of property name in a typical entity."""
+        name = name.lstrip('-')
+        prop = self.model._properties.get(name)
+        if prop is not None and prop._repeated:
+            return self.repeated_values.get(name, DEFAULT_REPEATED_VALUES)
+        return 1
+
+    def rows(self, index):
+        rows = PATH_DEPTH.get(index.kind, 1) if index.ancestor else 1
+        for name in index.properties:
+            rows *= self.values(name)
+        return rows
+
+    def newEntity(self, composites):
+        return (2 + 2 * sum(self.values(name) for name in self.indexed) +
+                sum(self.rows(index) for index in composites))
+
+    def update(self, composites, changed):
+        changed = set(changed)
+        touched = [index for index in composites
+                   if changed.intersection(p.lstrip('-')
+                                           for p in index.properties)]
+        return (1 + 4 * sum(self.values(name) for name in self.indexed
+                            if name in changed) +
+                2 * sum(self.rows(index) for index in touched))
+
+
+# - - - report - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def report(kind, shapes, counts, current, proposed, manual, cost, changed):
+    print '== %s ==' % kind
+    seen = sum(counts.values())
+    print 'query shapes: %d possible, %d seen in logs (%d queries)' % (
+        len(set(shapes)), len(counts), seen)
+    if counts:
+        print '  %8s  %-44s %-18s %s' % ('queries', 'filters (eq | ineq)',
+                                         'now', 'proposed')
+        for shape, n in counts.most_common():
+            print '  %8d  %-44s %-18s %s' % (
+                n, describe(shape), servedBy(shape, current) or 'NO INDEX',
+                servedBy(shape, proposed))
+    for label, indexes in (('now', current), ('proposed', proposed)):
+        missing = [shape for shape in set(shapes)
+                   if not servedBy(shape, indexes | manual)]
+        if missing:
+            print '  %d possible shapes have no index %s, e.g. %s' % (
+                len(missing), label, describe(missing[0]))
+
+    kept = current & proposed
+    print 'composite indexes: %d now, %d proposed (%d kept)' % (
+        len(current), len(proposed), len(kept))
+    for index in sorted(proposed - current):
+        print '  + %s(%s)' % ('ancestor, ' if index.ancestor else '',
+                              ', '.join(index.properties))
+    for index in sorted(current - proposed):
+        print '  - %s(%s)' % ('ancestor, ' if index.ancestor else '',
+                              ', '.join(index.properties))
+
+    # hand-maintained indexes are written either way
+    current, proposed = current | manual, proposed | manual
+    print '  %-36s %6s  %8s' % ('writes per entity', 'now', 'proposed')
+    print '  %-36s %6d  %8d' % ('new entity', cost.newEntity(current),
+                                cost.newEntity(proposed))
+    if changed:
+        print '  %-36s %6d  %8d' % (
+            'update of ' + ','.join(changed), cost.update(current, changed),
+            cost.update(proposed, changed))
+    print
+
+
+def parsePairs(text, convert):
+    """Parse 'Kind=a,b Other=c' / 'topics=3' style option values."""
+    pairs = {}
+    for item in (text or '').split():
+        name, _, value = item.partition('=')
+        pairs[name] = convert(value)
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--logs', nargs='*', default=[],
+                        help='request logs with query shape lines')
+    parser.add_argument('--dedicated', type=float, default=0.05,
+                        help='share of logged queries above which a '
+                             'multi-filter shape gets its own index')
+    parser.add_argument('--cover', choices=['all', 'observed'],
+                        default='all',
+                        help='shapes the proposal must answer')
+    parser.add_argument('--values', default='',
+                        help='values per repeated property, e.g. topics=5')
+    parser.add_argument('--changed', default=DEFAULT_CHANGED,
+                        help='properties changed by a typical update, '
+                             'e.g. "Conference=seatsAvailable,updated"')
+    parser.add_argument('--index-yaml', default=INDEX_YAML)
+    parser.add_argument('--write', action='store_true',
+                        help='write the proposal to index.yaml')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk (or APPENGINE_SDK) is required')
+
+    conference, models, settings, yaml = loadApp(args.sdk)
+    shapes = list(queryShapes('Conference', conference.FIELDS.values(), False))
+    shapes.extend(queryShapes('Session', conference.FIELDS_SESSION.values(),
+                              True))
+    if settings.FLAT_ENTITY_GROUPS:
+        shapes.extend(queryShapes('Session',
+                                  conference.FIELDS_SESSION.values(), False,
+                                  FLAT_PREFIX['Session']))
+    counts = collections.Counter()
+    for path in args.logs:
+        with open(path) as f:
+            counts.update(parseLogs(f))
+
+    manual_text, manual, current = readIndexYaml(yaml, args.index_yaml)
+    if args.cover == 'observed' and not counts:
+        parser.error('--cover observed needs --logs with query shapes')
+    proposed = propose(shapes if args.cover == 'all' else [], counts,
+                       args.dedicated)
+    repeated_values = parsePairs(args.values, int)
+    changed = parsePairs(args.changed, lambda value: value.split(','))
+
+    kinds = sorted(set(shape.kind for shape in shapes))
+    for kind in kinds:
+        report(kind,
+               [shape for shape in shapes if shape.kind == kind],
+               collections.Counter(dict((shape, n)
+                                        for shape, n in counts.items()
+                                        if shape.kind == kind)),
+               set(index for index in current if index.kind == kind),
+               set(index for index in proposed if index.kind == kind),
+               set(index for index in manual if index.kind == kind),
+               WriteCost(getattr(models, kind), repeated_values),
+               changed.get(kind))
+
+    if args.write:
+        # indexes of other kinds below the marker are kept as they are
+        others = [index for index in current if index.kind not in kinds]
+        writeIndexYaml(args.index_yaml, manual_text, list(proposed) + others)
+        print 'wrote %s; run appcfg.py vacuum_indexes after deploying' % (
+            args.index_yaml)
+
+
+if __name__ == '__main__':
+    main()
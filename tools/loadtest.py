@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""loadtest.py
+
+Drive a running server (normally dev_appserver.py) with a realistic mix
+of Conference Central API calls at a fixed request rate, and report
+throughput, error and conflict rates and latency histograms per
+operation.
+
+Requests are issued open-loop: a scheduler releases them at the target
+rate whatever the server's speed, and latency is measured from the
+scheduled start, so a server falling behind shows up as latency rather
+than as a lower request rate.
+
+    # 60s of the default mix at 20 req/s (without register, which needs
+    # --conference)
+    python tools/loadtest.py --rate 20 --duration 60
+
+    # everyone registers for one conference at once
+    python tools/loadtest.py --mix register=1 --conference KEY --rate 50
+
+    # record a run, then replay it (twice as fast)
+    python tools/loadtest.py --record run.jsonl
+    python tools/loadtest.py --replay run.jsonl --speed 2
+
+Each line of a request log is a JSON object:
+    {"t": 0.25, "op": "register", "method": "POST",
+     "path": "conference/KEY", "body": {}, "token": "..."}
+where t is seconds from the start of the run.
+
+The dev server's OAuth stub treats every bearer token as the same user,
+so registration storms against it mostly measure the conflict path;
+pass real tokens (--tokens, one per line) against a deployed test app
+to register distinct users.
+
+"""
+
+import argparse
+import collections
+import json
+import math
+import Queue
+import random
+import sys
+import threading
+import time
+import urllib2
+
+DEFAULT_BASE = 'http://localhost:8080/_ah/api/conference/v1'
+DEFAULT_MIX = 'browse=50,sessions=30,wishlist=10,register=10'
+# response text that means the datastore gave up retrying a transaction
+CONTENTION_MARKERS = ('TransactionFailedError', 'too much contention',
+                      'Concurrency exception')
+# throttled calls answer 503 with the wait in the message (throttle.py)
+THROTTLED_MARKER = 'Retry-After:'
+
+
+class Workload(object):
+
+    """Workload -- turns a traffic mix into concrete requests"""
+
+    def __init__(self, mix, conferences, sessions, target, tokens):
+        self.ops = []
+        self.weights = []
+        for op, weight in mix.items():
+            if not hasattr(self, 'op_' + op):
+                raise ValueError('Unknown operation in mix: %s' % op)
+            self.ops.append(op)
+            self.weights.append(weight)
+        self.conferences = conferences
+        self.sessions = sessions
+        self.target = target
+        self.tokens = tokens
+
+    def next(self):
+        op = self._pick()
+        method, path, body = getattr(self, 'op_' + op)()
+        return {'op': op, 'method': method, 'path': path, 'body': body,
+                'token': random.choice(self.tokens)}
+
+    def _pick(self):
+        point = random.uniform(0, sum(self.weights))
+        for op, weight in zip(self.ops, self.weights):
+            point -= weight
+            if point <= 0:
+                return op
+        return self.ops[-1]
+
+    def op_browse(self):
+        filters = []
+        if random.random() < 0.3:
+            filters.append({'field': 'MONTH', 'operator': 'GT',
+                            'value': str(random.randint(1, 11))})
+        return 'POST', 'queryConferences', {'filters': filters}
+
+    def op_sessions(self):
+        conf = self.target or random.choice(self.conferences)
+        return 'GET', 'conference/%s/sessions' % conf, None
+
+    def op_wishlist(self):
+        return ('POST', 'sessions/addToWishList/%s' %
+                random.choice(self.sessions), {})
+
+    def op_register(self):
+        return 'POST', 'conference/%s' % self.target, {}
+
+
+class Stats(object):
+
+    """Stats -- thread-safe per-operation counters and latency histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.defaultdict(collections.Counter)
+        self.latencies = collections.defaultdict(list)
+
+    def record(self, op, outcome, latency):
+        with self._lock:
+            self.counts[op][outcome] += 1
+            self.counts[op]['total'] += 1
+            self.latencies[op].append(latency)
+
+    def report(self, elapsed):
+        lines = []
+        ops = sorted(self.counts)
+        for op in ops + ['ALL']:
+            if op == 'ALL':
+                counts = sum((self.counts[o] for o in ops),
+                             collections.Counter())
+                latencies = sorted(sum((self.latencies[o] for o in ops), []))
+            else:
+                counts = self.counts[op]
+                latencies = sorted(self.latencies[op])
+            total = counts['total'] or 1
+            lines.append(
+                '%-10s %6d req %7.1f req/s  ok %5.1f%%  conflict %5.1f%%  '
+                'contention %5.1f%%  throttled %5.1f%%  error %5.1f%%' % (
+                    op, counts['total'], counts['total'] / elapsed,
+                    100.0 * counts['ok'] / total,
+                    100.0 * counts['conflict'] / total,
+                    100.0 * counts['contention'] / total,
+                    100.0 * counts['throttled'] / total,
+                    100.0 * counts['error'] / total))
+            if latencies:
+                lines.append('%-10s p50 %7.1f  p90 %7.1f  p99 %7.1f  '
+                             'max %7.1f ms' % (
+                                 '', _percentile(latencies, 50),
+                                 _percentile(latencies, 90),
+                                 _percentile(latencies, 99),
+                                 latencies[-1]))
+                lines.extend(_histogram(latencies))
+        return '\n'.join(lines)
+
+    def asDict(self, elapsed):
+        result = {'elapsed': elapsed, 'operations': {}}
+        for op in self.counts:
+            latencies = sorted(self.latencies[op])
+            result['operations'][op] = {
+                'counts': dict(self.counts[op]),
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+            }
+        return result
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(math.ceil(pct / 100.0 * len(values))) - 1)
+    return values[max(index, 0)]
+
+
+def _histogram(latencies, width=40):
+    """Return text histogram lines over power-of-two millisecond buckets."""
+    buckets = collections.Counter(
+        int(math.log(max(latency, 1), 2)) for latency in latencies)
+    peak = max(buckets.values())
+    lines = []
+    for bucket in range(min(buckets), max(buckets) + 1):
+        count = buckets[bucket]
+        lines.append('%10s <%6d ms %6d %s' % (
+            '', 2 ** (bucket + 1), count, '#' * (width * count // peak)))
+    return lines
+
+
+def classify(status, body):
+    """Return ok, conflict, contention, throttled or error for a
+    response."""
+    if 200 <= status < 300:
+        return 'ok'
+    if any(marker in body for marker in CONTENTION_MARKERS):
+        return 'contention'
+    if status == 409:
+        return 'conflict'
+    if status == 503 and THROTTLED_MARKER in body:
+        return 'throttled'
+    return 'error'
+
+
+def send(base, request, timeout):
+    """Issue one request; return (status, body)."""
+    data = None
+    if request.get('body') is not None:
+        data = json.dumps(request['body'])
+    http = urllib2.Request('%s/%s' % (base, request['path']), data=data)
+    http.get_method = lambda: request['method']
+    http.add_header('Content-Type', 'application/json')
+    if request.get('token'):
+        http.add_header('Authorization', 'Bearer %s' % request['token'])
+    try:
+        response = urllib2.urlopen(http, timeout=timeout)
+        return response.getcode(), response.read()
+    except urllib2.HTTPError as e:
+        return e.code, e.read()
+    except Exception as e:
+        return 0, repr(e)
+
+
+def worker(base, timeout, pending, stats):
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        scheduled, request = item
+        status, body = send(base, request, timeout)
+        stats.record(request['op'], classify(status, body),
+                     (time.time() - scheduled) * 1000)
+
+
+def discover(base, token, timeout):
+    """Return (conference keys, session keys) visible on the server."""
+    status, body = send(base, {'method': 'POST', 'path': 'queryConferences',
+                               'body': {'filters': []}, 'token': token},
+                        timeout)
+    if status != 200:
+        raise RuntimeError('queryConferences failed (%s): %s' % (status, body))
+    conferences = [c['websafeKey']
+                   for c in json.loads(body).get('items', [])]
+    sessions = []
+    for conf in conferences[:20]:
+        status, body = send(base, {'method': 'GET',
+                                   'path': 'conference/%s/sessions' % conf,
+                                   'token': token}, timeout)
+        if status == 200:
+            sessions.extend(s['sess_websafekey']
+                            for s in json.loads(body).get('items', []))
+    return conferences, sessions
+
+
+def synthetic(workload, rate, duration):
+    """Yield (offset, request) at rate requests/second for duration."""
+    count = int(rate * duration)
+    for i in range(count):
+        yield i / float(rate), workload.next()
+
+
+def replayed(path, speed):
+    """Yield (offset, request) from a recorded request log."""
+    with open(path) as log:
+        for line in log:
+            if line.strip():
+                request = json.loads(line)
+                yield request.pop('t') / speed, request
+
+
+def parseMix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base', default=DEFAULT_BASE,
+                        help='API root (default %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='op=weight,... from browse, sessions, wishlist, '
+                             'register (default %(default)s, without '
+                             'register if --conference is not given)')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='target requests per second')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run a synthetic workload')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--conference',
+                        help='websafe key that sessions/register target; '
+                             'required for register')
+    parser.add_argument('--tokens',
+                        help='file of OAuth bearer tokens, one per line')
+    parser.add_argument('--record', help='write issued requests to this log')
+    parser.add_argument('--replay', help='replay a recorded request log')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier')
+    parser.add_argument('--json', help='also write the results as JSON here')
+    args = parser.parse_args()
+
+    tokens = ['loadtest']
+    if args.tokens:
+        with open(args.tokens) as f:
+            tokens = [line.strip() for line in f if line.strip()]
+
+    if args.replay:
+        schedule = replayed(args.replay, args.speed)
+    else:
+        mix = parseMix(args.mix)
+        if args.mix == DEFAULT_MIX and not args.conference:
+            del mix['register']
+        if 'register' in mix and not args.conference:
+            parser.error('--conference is required for register')
+        conferences, sessions = discover(args.base, tokens[0], args.timeout)
+        if 'sessions' in mix and not (conferences or args.conference):
+            parser.error('no conferences on the server for sessions')
+        if 'wishlist' in mix and not sessions:
+            parser.error('no sessions on the server for wishlist')
+        workload = Workload(mix, conferences, sessions, args.conference,
+                            tokens)
+        schedule = synthetic(workload, args.rate, args.duration)
+
+    stats = Stats()
+    pending = Queue.Queue()
+    threads = [threading.Thread(target=worker,
+                                args=(args.base, args.timeout, pending, stats))
+               for _ in range(args.workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    record = open(args.record, 'w') if args.record else None
+    start = time.time()
+    for offset, request in schedule:
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((start + offset, request))
+        if record:
+            record.write(json.dumps(dict(request, t=offset)) + '\n')
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if record:
+        record.close()
+
+    print stats.report(elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats.asDict(elapsed), f, indent=2)
+    errors = sum(stats.counts[op]['error'] for op in stats.counts)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""upcoming.py
+
+"What's on next" across the conferences a user attends.
+
+Each conference's schedule document (schedule.py) is already sorted by
+date and start time, so every conference is a time-ordered stream of
+sessions. upcomingSessions() merges the streams (heapq.merge, a k-way
+merge) and stops after the page it needs: a stream is only advanced as
+far as the merge reads it, and nothing is sorted as a whole. All the
+schedules come from one batched entity-cache lookup; a conference
+without one has it built from its sessions on first use.
+
+Sessions are ordered by (date, start_time, name, session key), the
+order of the schedule documents. A page token is the position of the
+last session returned, so the next page resumes right after it even
+when sessions were added in between.
+
+"""
+
+import base64
+import bisect
+import heapq
+import itertools
+import json
+from datetime import datetime
+
+from cache import entities
+from layout import movedKey
+from schedule import entryForm
+from schedule import getSchedule
+from schedule import scheduleKey
+
+UPCOMING_PAGE_SIZE = 10
+UPCOMING_MAX_PAGE_SIZE = 50
+
+
+def _position(entry):
+    return (entry['date'], entry['start_time'], entry.get('name') or '',
+            entry['sess_websafekey'])
+
+
+def encodeToken(position):
+    return base64.urlsafe_b64encode(json.dumps(list(position)))
+
+
+def decodeToken(token):
+    """Return the position in a page token; ValueError if invalid."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page token: %r' % token)
+    if not (isinstance(position, list) and len(position) == 4):
+        raise ValueError('Invalid page token: %r' % token)
+    return tuple(position)
+
+
+def _stream(schedule, after):
+    """Yield (position, entry) for a schedule's sessions after position
+    after, in order.
+    """
+    days = schedule.days or []
+    first = bisect.bisect_left([day['date'] for day in days], after[0])
+    for day in itertools.islice(days, first, None):
+        for entry in day['sessions']:
+            position = _position(entry)
+            if position > after:
+                yield position, entry
+
+
+def _schedules(conf_keys):
+    """Return the schedules of the conferences at conf_keys, building
+    missing ones; conferences that no longer exist are skipped.
+    """
+    schedules = entities.get_multi([scheduleKey(key) for key in conf_keys])
+    found = []
+    for key, schedule in zip(conf_keys, schedules):
+        if schedule is None:
+            conf = entities.get(key)
+            if not conf:
+                moved = movedKey(key)
+                conf = entities.get(moved) if moved else None
+            if not conf:
+                continue
+            schedule = getSchedule(conf)
+        found.append(schedule)
+    return found
+
+
+def upcomingSessions(conf_keys, page_size=UPCOMING_PAGE_SIZE,
+                     page_token=None, now=None):
+    """Return (SessionForms of the next page_size sessions, next page
+    token or None) across the conferences at conf_keys.
+
+    Without a page token the feed starts at now (UTC). Raises ValueError
+    on a bad page token.
+    """
+    page_size = max(1, min(page_size or UPCOMING_PAGE_SIZE,
+                           UPCOMING_MAX_PAGE_SIZE))
+    if page_token:
+        after = decodeToken(page_token)
+    else:
+        now = now or datetime.utcnow()
+        after = (now.strftime('%Y-%m-%d'), now.strftime('%H:%M'), '', '')
+    streams = [_stream(schedule, after)
+               for schedule in _schedules(list(set(conf_keys)))]
+    # one more than needed tells whether there is a next page
+    merged = list(itertools.islice(heapq.merge(*streams), page_size + 1))
+    page = merged[:page_size]
+    token = None
+    if len(merged) > page_size:
+        token = encodeToken(page[-1][0])
+    return [entryForm(entry) for _, entry in page], token
+
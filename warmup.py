@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""warmup.py
+
+Instance start-up helpers: the /_ah/warmup work and a one-off log line
+recording how long a fresh instance took to send its first response.
+
+Nothing here imports the API modules at load time; warm() pulls them in
+when App Engine asks the instance to warm up, so the task and cron
+handlers in main.py don't pay for endpoints/protorpc.
+
+"""
+
+import logging
+import threading
+import time
+
+# roughly when this instance started loading application code
+INSTANCE_START = time.time()
+
+_state = {'warmed': False, 'reported': False}
+_lock = threading.Lock()
+
+
+def warm():
+    """Import the API and prime the instance caches.
+
+    Reading memcache and the datastore here also opens those RPC
+    stubs before the first user request arrives.
+    """
+    from cache import memcacheValue
+    from conference import ConferenceApi
+    from conference import MEMCACHE_ANNOUNCEMENTS_KEY
+    from conference import MEMCACHE_FEATURED_KEY
+
+    memcacheValue(MEMCACHE_ANNOUNCEMENTS_KEY,
+                  fallback=ConferenceApi._rebuildAnnouncement)
+    memcacheValue(MEMCACHE_FEATURED_KEY)
+    ConferenceApi._cacheHotConferences()
+    _state['warmed'] = True
+    logging.info('instance warmed up %.0f ms after start',
+                 (time.time() - INSTANCE_START) * 1000)
+
+
+def timeFirstResponse(app):
+    """Wrap a WSGI app to log time-to-first-response once per instance."""
+    def timed(environ, start_response):
+        result = app(environ, start_response)
+        if not _state['reported']:
+            with _lock:
+                report = not _state['reported']
+                _state['reported'] = True
+            if report:
+                logging.info(
+                    'first response (%s) %.0f ms after instance start, '
+                    'warmed up: %s', environ.get('PATH_INFO'),
+                    (time.time() - INSTANCE_START) * 1000, _state['warmed'])
+        return result
+    return timed